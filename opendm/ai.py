@@ -3,6 +3,7 @@ from opendm.net import download
 from opendm import log
 import zipfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 def get_model(namespace, url, version, name = "model.onnx"):
     version = version.replace(".", "_")
@@ -48,4 +49,76 @@ def get_model(namespace, url, version, name = "model.onnx"):
         else:
             return model_file
     else:
-        return model_file
\ No newline at end of file
+        return model_file
+
+def session_options(threads=None):
+    """
+    :param threads number of threads to use for running a single inference, None to let onnxruntime decide
+    :return onnxruntime.SessionOptions for sessions that are shared by multiple threads
+    """
+    import onnxruntime as ort
+
+    opts = ort.SessionOptions()
+    if threads is not None:
+        opts.intra_op_num_threads = max(1, threads)
+    opts.inter_op_num_threads = 1
+    opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    return opts
+
+def get_batch_size(session, batch_size):
+    """
+    :return batch_size if the model accepts batches of any size, otherwise the (fixed) batch size of the model
+    """
+    dim = session.get_inputs()[0].shape[0]
+    return dim if isinstance(dim, int) and dim > 0 else batch_size
+
+def batch_inference(items, preprocess, infer, postprocess, batch_size=1, max_workers=1):
+    """
+    Run a model on a list of items, in batches. Pre-processing of the next batch and
+    post-processing of the previous batches run in a thread pool while a batch is being inferred.
+    :param preprocess function called with an item, returning a (model input, context) tuple or None to skip the item
+    :param infer function called with a list of model inputs, returning the list of outputs
+    :param postprocess function called with (output, context), returning the result for the item
+    :return list of results (None for items that were skipped or failed), in the same order as items
+    """
+    results = [None] * len(items)
+    batches = [list(range(i, min(len(items), i + batch_size))) for i in range(0, len(items), batch_size)]
+
+    def safe(func, i, *args):
+        try:
+            return func(*args)
+        except Exception as e:
+            log.ODM_WARNING("Cannot process %s: %s" % (items[i], str(e)))
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        postprocessing = {}
+        prepared = [executor.submit(safe, preprocess, i, items[i]) for i in batches[0]] if batches else []
+
+        for b, batch in enumerate(batches):
+            inputs = [f.result() for f in prepared]
+
+            # Limit the number of images in memory
+            while len(postprocessing) > batch_size:
+                i = min(postprocessing)
+                results[i] = postprocessing.pop(i).result()
+
+            if b + 1 < len(batches):
+                prepared = [executor.submit(safe, preprocess, i, items[i]) for i in batches[b + 1]]
+
+            valid = [(i, inp) for i, inp in zip(batch, inputs) if inp is not None]
+            if len(valid) == 0:
+                continue
+            
+            try:
+                outputs = infer([inp[0] for _, inp in valid])
+            except Exception as e:
+                log.ODM_WARNING("Cannot run inference on batch: %s" % str(e))
+                continue
+            
+            for (i, inp), output in zip(valid, outputs):
+                postprocessing[i] = executor.submit(safe, postprocess, i, output, inp[1])
+        
+        for i in postprocessing:
+            results[i] = postprocessing[i].result()
+
+    return results
@@ -12,6 +12,7 @@ from opendm import log
 from opendm import io
 from opendm import system
 from opendm.concurrency import get_max_memory
+from opendm.objio import read_obj, rewrite_obj
 
 def get_point_cloud_crs(file):
     pipeline = pdal.Pipeline(json.dumps([ file ]))
@@ -135,13 +136,8 @@ def transform_point_cloud(input_laz, a_matrix, output_laz):
 def transform_obj(input_obj, a_matrix, geo_offset, output_obj):
     g_off = np.array([geo_offset[0], geo_offset[1], 0, 0])
 
-    with open(input_obj, 'r') as fin:
-        with open(output_obj, 'w') as fout:
-            lines = fin.readlines()
-            for line in lines:
-                if line.startswith("v "):
-                    v = np.fromstring(line.strip()[2:] + " 1",  sep=' ', dtype=float)
-                    vt = (a_matrix.dot((v + g_off)) - g_off)[:3]
-                    fout.write("v " + " ".join(map(str, list(vt))) + '\n')
-                else:
-                    fout.write(line)
\ No newline at end of file
+    vertices = read_obj(input_obj, elements=('v', ))['vertices']
+    v = np.column_stack((vertices, np.ones(len(vertices)))) + g_off
+    vt = np.einsum('ij,nj->ni', a_matrix[:3], v) - g_off[:3]
+
+    rewrite_obj(input_obj, output_obj, vertices=vt)
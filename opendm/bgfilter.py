@@ -5,9 +5,7 @@ import cv2
 import os
 import onnxruntime as ort
 from opendm import log
-from threading import Lock
-
-mutex = Lock()
+from opendm.ai import session_options, get_batch_size, batch_inference
 
 # Implementation based on https://github.com/danielgatis/rembg by Daniel Gatis
 
@@ -15,8 +13,9 @@ mutex = Lock()
 provider = "CUDAExecutionProvider" if "CUDAExecutionProvider" in ort.get_available_providers() else "CPUExecutionProvider"
 
 class BgFilter():
-    def __init__(self, model):
+    def __init__(self, model, threads = None):
         self.model = model
+        self.threads = threads
 
         log.ODM_INFO(' ?> Using provider %s' % provider)
         self.load_model()
@@ -25,7 +24,8 @@ class BgFilter():
     def load_model(self):
         log.ODM_INFO(' -> Loading the model')
 
-        self.session = ort.InferenceSession(self.model, providers=[provider])
+        # Sessions are thread-safe and shared by all threads
+        self.session = ort.InferenceSession(self.model, sess_options=session_options(self.threads), providers=[provider])
 
     def normalize(self, img, mean, std, size):
         im = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
@@ -39,24 +39,19 @@ class BgFilter():
 
         tmpImg = tmpImg.transpose((2, 0, 1))
 
-        return {
-            self.session.get_inputs()[0]
-            .name: np.expand_dims(tmpImg, 0)
-            .astype(np.float32)
-        }
+        return tmpImg.astype(np.float32)
 
-    def get_mask(self, img):
-        height, width, c = img.shape
+    def preprocess(self, img):
+        return self.normalize(
+            img, (0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320) # <-- image size
+        )
 
-        with mutex:
-            ort_outs = self.session.run(
-                None,
-                self.normalize(
-                    img, (0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320) # <-- image size
-                ),
-            )
+    def infer(self, inputs):
+        ort_outs = self.session.run(None, {self.session.get_inputs()[0].name: np.stack(inputs)})
+        return list(ort_outs[0][:, 0, :, :])
 
-        pred = ort_outs[0][:, 0, :, :]
+    def postprocess(self, pred, img):
+        height, width, c = img.shape
 
         ma = np.max(pred)
         mi = np.min(pred)
@@ -72,14 +67,17 @@ class BgFilter():
 
         return output
 
-    def run_img(self, img_path, dest):
+    def get_mask(self, img):
+        return self.postprocess(self.infer([self.preprocess(img)])[0], img)
+
+    def load_img(self, img_path):
         img = cv2.imread(img_path, cv2.IMREAD_COLOR)
         if img is None:
             return None
 
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        mask  = self.get_mask(img)
-        
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+    def write_mask(self, mask, img_path, dest):
         img_name = os.path.basename(img_path)
         fpath = os.path.join(dest, img_name)
 
@@ -88,3 +86,32 @@ class BgFilter():
         cv2.imwrite(mask_name, mask)
 
         return mask_name
+
+    def run_img(self, img_path, dest):
+        img = self.load_img(img_path)
+        if img is None:
+            return None
+
+        mask  = self.get_mask(img)
+        
+        return self.write_mask(mask, img_path, dest)
+
+    def run_imgs(self, img_paths, dest, max_workers=1, batch_size=4):
+        """
+        Generate masks for multiple images, running the model on batches of images
+        and loading/post-processing the images concurrently
+        :return list of mask paths (None for the images that could not be processed)
+        """
+        def preprocess(img_path):
+            img = self.load_img(img_path)
+            if img is None:
+                return None
+            return self.preprocess(img), (img, img_path)
+        
+        def postprocess(output, ctx):
+            img, img_path = ctx
+            return self.write_mask(self.postprocess(output, img), img_path, dest)
+
+        return batch_inference(img_paths, preprocess, self.infer, postprocess, 
+                               batch_size=get_batch_size(self.session, batch_size), 
+                               max_workers=max_workers)
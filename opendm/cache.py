@@ -0,0 +1,60 @@
+import os
+
+from opendm import log
+
+def get_cache_dir(project_path, name):
+    """
+    :param project_path path of the project (used unless the ODM_CACHE_DIR environment variable is set)
+    :param name name of the cache
+    :return directory where to store the cache. By default caches are stored
+        in the project, ODM_CACHE_DIR can be set to share them between projects
+    """
+    base_dir = os.environ.get('ODM_CACHE_DIR')
+    if not base_dir:
+        base_dir = os.path.join(project_path, "cache")
+    return os.path.join(base_dir, name)
+
+def touch(path):
+    """
+    Mark a cache entry as recently used
+    """
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def prune(cache_dir, max_size_mb):
+    """
+    Delete the least recently used entries of a cache
+    until its size is below max_size_mb
+    :return number of deleted entries
+    """
+    entries = []
+    total_size = 0
+    for root, dirs, files in os.walk(cache_dir):
+        for f in files:
+            path = os.path.join(root, f)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, path))
+            total_size += st.st_size
+
+    max_size = max_size_mb * 1024 * 1024
+    if total_size <= max_size:
+        return 0
+
+    deleted = 0
+    for mtime, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+            deleted += 1
+        except OSError:
+            pass
+        total_size -= size
+
+    log.ODM_INFO("Removed %s old entries from %s" % (deleted, cache_dir))
+    return deleted
@@ -1,12 +1,10 @@
 from vmem import virtual_memory
 import os
 import sys
-try:
-    import Queue as queue
-except:
-    import queue
-import threading
-import time
+import cloudpickle
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from opendm import log
 
 def get_max_memory(minimum = 5, use_at_most = 0.5):
@@ -25,76 +23,123 @@ def get_max_memory_mb(minimum = 100, use_at_most = 0.5):
     """
     return max(minimum, (virtual_memory().available / 1024 / 1024) * use_at_most)
 
-def parallel_map(func, items, max_workers=1, single_thread_fallback=True):
+def _get_process_context():
+    """
+    :return a multiprocessing context that does not fork the current process.
+        Forking while other threads hold locks (logging, GDAL, ...) can deadlock the children
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+def _init_process_worker(pickled_func):
+    global _process_worker_func
+    _process_worker_func = cloudpickle.loads(pickled_func)
+
+def _run_process_worker(item):
+    return _process_worker_func(item)
+
+def parallel_map(func, items, max_workers=1, single_thread_fallback=True, use_processes=False, memory_estimate=None):
     """
     Our own implementation for parallel processing
     which handles gracefully CTRL+C and reverts to 
     single thread processing in case of errors
     :param items list of objects
     :param func function to execute on each object
+    :param max_workers maximum number of tasks to run concurrently
+    :param single_thread_fallback when tasks fail, retry the failed tasks
+        one at a time (useful in case of memory errors). When False, the
+        exception of the first failed task is raised
+    :param use_processes run tasks in a pool of processes instead of threads.
+        func can be a closure, but side effects on the parent's state are lost
+        (use the return values instead)
+    :param memory_estimate estimated memory (in MB) needed by each task, either
+        a number or a function called with each item. Tasks are not started
+        if they would exceed the memory budget returned by get_max_memory_mb
+    :return list of return values of func, in the same order as items
     """
-    global error
-    error = None
+    items = list(items)
+    results = [None] * len(items)
+    failed = list(range(len(items)))
 
-    def process_one(q):
-        func(q)
+    if max_workers > 1 and len(items) > 1:
+        executor = None
+        if use_processes:
+            try:
+                pickled_func = cloudpickle.dumps(func)
+                executor = ProcessPoolExecutor(max_workers=max_workers, 
+                                               mp_context=_get_process_context(),
+                                               initializer=_init_process_worker, 
+                                               initargs=(pickled_func, ))
+                run_func = _run_process_worker
+            except Exception as e:
+                log.ODM_WARNING("Cannot use process pool (%s), using threads" % str(e))
+        
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=max_workers, 
+                                          initializer=log.logger.set_stage, 
+                                          initargs=(log.logger.get_stage(), ))
+            run_func = func
 
-    def worker():
-        global error
+        if memory_estimate is None:
+            estimate = lambda item: 0
+        elif callable(memory_estimate):
+            estimate = memory_estimate
+        else:
+            estimate = lambda item: memory_estimate
+        memory_budget = get_max_memory_mb()
 
-        while True:
-            (num, q) = pq.get()
-            if q is None or error is not None:
-                pq.task_done()
-                break
+        pending = deque(range(len(items)))
+        running = {}
+        memory_in_use = 0
+        errors = {}
 
-            try:
-                process_one(q)
-            except Exception as e:
-                error = e
-            finally:
-                pq.task_done()
-
-    if max_workers > 1:
-        use_single_thread = False
-        pq = queue.PriorityQueue()
-        threads = []
-        for i in range(max_workers):
-            t = threading.Thread(target=worker)
-            t.start()
-            threads.append(t)
-
-        i = 1
-        for t in items:
-            pq.put((i, t))
-            i += 1
-
-        def stop_workers():
-            for i in range(len(threads)):
-                pq.put((-1, None))
-            for t in threads:
-                t.join()
-
-        # block until all tasks are done
         try:
-            while pq.unfinished_tasks > 0:
-                time.sleep(0.5)
+            while pending or running:
+                # Admit as many tasks as workers and memory allow.
+                # At least one task always runs, even if it exceeds the budget.
+                while pending and len(running) < max_workers and not (errors and not single_thread_fallback):
+                    task_memory = estimate(items[pending[0]])
+                    if running and memory_in_use + task_memory > memory_budget:
+                        break
+
+                    i = pending.popleft()
+                    try:
+                        running[executor.submit(run_func, items[i])] = (i, task_memory)
+                        memory_in_use += task_memory
+                    except Exception as e:
+                        # e.g. broken process pool after a worker got killed
+                        errors[i] = e
+                
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i, task_memory = running.pop(future)
+                    memory_in_use -= task_memory
+
+                    try:
+                        results[i] = future.result()
+                    except Exception as e:
+                        errors[i] = e
         except KeyboardInterrupt:
             print("CTRL+C terminating...")
-            stop_workers()
+            executor.shutdown(wait=False)
             sys.exit(1)
 
-        stop_workers()
+        executor.shutdown()
+
+        failed = sorted(errors) + list(pending)
+        if errors:
+            if single_thread_fallback:
+                # Try to reprocess the failed tasks using a single thread
+                # in case this was a memory error
+                log.ODM_WARNING("Failed to run %s tasks in parallel (%s), retrying with a single thread..." % (len(errors), str(errors[failed[0]])))
+            else:
+                raise errors[failed[0]]
 
-        if error is not None and single_thread_fallback:
-            # Try to reprocess using a single thread
-            # in case this was a memory error
-            log.ODM_WARNING("Failed to run process in parallel, retrying with a single thread...")
-            use_single_thread = True
-    else:
-        use_single_thread = True
+    # Boring, single thread processing
+    for i in failed:
+        results[i] = func(items[i])
 
-    if use_single_thread:
-        # Boring, single thread processing
-        for q in items:
-            process_one(q)
\ No newline at end of file
+    return results
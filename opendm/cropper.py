@@ -1,8 +1,8 @@
 from opendm import context
 from opendm.system import run
 from opendm import log
-from opendm.point_cloud import export_summary_json
-from osgeo import ogr
+from opendm.point_cloud import export_summary_json, get_metadata, get_convex_hull
+from osgeo import ogr, osr
 import json, os
 from opendm.concurrency import get_max_memory
 from opendm.utils import double_quote
@@ -132,6 +132,62 @@ class Cropper:
             log.ODM_WARNING('Point cloud does not exist, cannot generate bounds {}'.format(pointcloud_path))
             return ''
 
+        convexhull = self.create_convex_hull(pointcloud_path, buffer_distance, decimation_step)
+        if convexhull is None:
+            return ''
+
+        # Save to a new file
+        bounds_geojson_path = self.path('bounds.geojson')
+        if os.path.exists(bounds_geojson_path):
+            os.remove(bounds_geojson_path)
+
+        self.write_polygon(convexhull, bounds_geojson_path, 'GeoJSON')
+
+        return bounds_geojson_path
+
+    def create_convex_hull(self, pointcloud_path, buffer_distance = 0, decimation_step=40):
+        """
+        Compute a buffered convex hull around the data extents of the given point cloud.
+
+        @return OGR polygon, or None on failure
+        """
+        convexhull = None
+
+        try:
+            # Single streaming pass over the point cloud, equivalent
+            # to the hull of PDAL's hexbin boundary with edge_size=1
+            hull = get_convex_hull(pointcloud_path, decimation_step, hexbin_edge_size=1)
+            ring = ogr.Geometry(ogr.wkbLinearRing)
+            for x, y in hull:
+                ring.AddPoint_2D(float(x), float(y))
+            ring.AddPoint_2D(float(hull[0][0]), float(hull[0][1]))
+            convexhull = ogr.Geometry(ogr.wkbPolygon)
+            convexhull.AddGeometry(ring)
+        except Exception as e:
+            log.ODM_WARNING("Cannot compute convex hull in-process (%s), falling back to PDAL" % str(e))
+            convexhull = self.create_convex_hull_pdal(pointcloud_path, decimation_step)
+            if convexhull is None:
+                return None
+
+        # If buffer distance is specified
+        # Create two buffers, one shrunk by
+        # N + 3 and then that buffer expanded by 3
+        # so that we get smooth corners. \m/
+        BUFFER_SMOOTH_DISTANCE = 3
+
+        if buffer_distance > 0:
+            # For small areas, check that buffering doesn't obliterate 
+            # our hull
+            tmp = convexhull.Buffer(-(buffer_distance + BUFFER_SMOOTH_DISTANCE))
+            tmp = tmp.Buffer(BUFFER_SMOOTH_DISTANCE)
+            if tmp.Area() > 0:
+                convexhull = tmp
+            else:
+                log.ODM_WARNING("Very small crop area detected, we will not smooth it.")
+
+        return convexhull
+
+    def create_convex_hull_pdal(self, pointcloud_path, decimation_step=40):
         # Do decimation prior to extracting boundary information
         decimated_pointcloud_path = self.path('decimated.las')
 
@@ -142,7 +198,7 @@ class Cropper:
 
         if not os.path.exists(decimated_pointcloud_path):
             log.ODM_WARNING('Could not decimate point cloud, thus cannot generate GPKG bounds {}'.format(decimated_pointcloud_path))
-            return ''
+            return None
 
         # Use PDAL to dump boundary information
         # then read the information back
@@ -159,74 +215,30 @@ class Cropper:
 
         if pc_geojson_boundary_feature is None: raise RuntimeError("Could not determine point cloud boundaries")
 
-        # Write bounds to GeoJSON
-        tmp_bounds_geojson_path = self.path('tmp-bounds.geojson')
-        with open(tmp_bounds_geojson_path, "w") as f:
-            f.write(json.dumps({
-                "type": "FeatureCollection",
-                "features": [{
-                    "type": "Feature",
-                    "geometry": pc_geojson_boundary_feature
-                }]
-            }))
-
         # Create a convex hull around the boundary
         # as to encompass the entire area (no holes)    
-        driver = ogr.GetDriverByName('GeoJSON')
-        ds = driver.Open(tmp_bounds_geojson_path, 0) # ready-only
-        layer = ds.GetLayer()
-
-        # Collect all Geometry
-        geomcol = ogr.Geometry(ogr.wkbGeometryCollection)
-        for feature in layer:
-            geomcol.AddGeometry(feature.GetGeometryRef())
+        convexhull = ogr.CreateGeometryFromJson(json.dumps(pc_geojson_boundary_feature)).ConvexHull()
 
-        # Calculate convex hull
-        convexhull = geomcol.ConvexHull()
-
-        # If buffer distance is specified
-        # Create two buffers, one shrunk by
-        # N + 3 and then that buffer expanded by 3
-        # so that we get smooth corners. \m/
-        BUFFER_SMOOTH_DISTANCE = 3
-
-        if buffer_distance > 0:
-            # For small areas, check that buffering doesn't obliterate 
-            # our hull
-            tmp = convexhull.Buffer(-(buffer_distance + BUFFER_SMOOTH_DISTANCE))
-            tmp = tmp.Buffer(BUFFER_SMOOTH_DISTANCE)
-            if tmp.Area() > 0:
-                convexhull = tmp
-            else:
-                log.ODM_WARNING("Very small crop area detected, we will not smooth it.")
+        # Remove decimated point cloud
+        if os.path.exists(decimated_pointcloud_path):
+            os.remove(decimated_pointcloud_path)
 
-        # Save to a new file
-        bounds_geojson_path = self.path('bounds.geojson')
-        if os.path.exists(bounds_geojson_path):
-            os.remove(bounds_geojson_path)
+        return convexhull
 
-        out_ds = driver.CreateDataSource(bounds_geojson_path)
-        layer = out_ds.CreateLayer("convexhull", geom_type=ogr.wkbPolygon)
+    @staticmethod
+    def write_polygon(polygon, output_path, driver_name, srs=None):
+        driver = ogr.GetDriverByName(driver_name)
+        out_ds = driver.CreateDataSource(output_path)
+        layer = out_ds.CreateLayer("convexhull", srs=srs, geom_type=ogr.wkbPolygon)
 
         feature_def = layer.GetLayerDefn()
         feature = ogr.Feature(feature_def)
-        feature.SetGeometry(convexhull)
+        feature.SetGeometry(polygon)
         layer.CreateFeature(feature)
         feature = None
 
-        # Save and close data sources
-        out_ds = ds = None
-
-        # Remove decimated point cloud
-        if os.path.exists(decimated_pointcloud_path):
-            os.remove(decimated_pointcloud_path)
-        
-        # Remove tmp bounds
-        if os.path.exists(tmp_bounds_geojson_path):
-            os.remove(tmp_bounds_geojson_path)
-
-        return bounds_geojson_path
-
+        # Save and close output data source
+        out_ds = None
 
     def create_bounds_gpkg(self, pointcloud_path, buffer_distance = 0, decimation_step=40):
         """
@@ -239,15 +251,29 @@ class Cropper:
             log.ODM_WARNING('Point cloud does not exist, cannot generate GPKG bounds {}'.format(pointcloud_path))
             return ''
 
-        bounds_geojson_path = self.create_bounds_geojson(pointcloud_path, buffer_distance, decimation_step)
+        convexhull = self.create_convex_hull(pointcloud_path, buffer_distance, decimation_step)
+        if convexhull is None:
+            return ''
+
+        # Also write the GeoJSON bounds (no SRS)
+        bounds_geojson_path = self.path('bounds.geojson')
+        if os.path.exists(bounds_geojson_path):
+            os.remove(bounds_geojson_path)
+        self.write_polygon(convexhull, bounds_geojson_path, 'GeoJSON')
 
-        summary_file_path = os.path.join(self.storage_dir, '{}.summary.json'.format(self.files_prefix))
-        export_summary_json(pointcloud_path, summary_file_path)
-        
         pc_proj4 = None
-        with open(summary_file_path, 'r') as f:
-            json_f = json.loads(f.read())
-            pc_proj4 = json_f['summary']['srs']['proj4']
+        try:
+            pc_proj4 = get_metadata(pointcloud_path)['srs']
+        except Exception as e:
+            log.ODM_WARNING("Cannot read point cloud metadata: %s" % str(e))
+
+        if not pc_proj4:
+            summary_file_path = os.path.join(self.storage_dir, '{}.summary.json'.format(self.files_prefix))
+            export_summary_json(pointcloud_path, summary_file_path)
+            
+            with open(summary_file_path, 'r') as f:
+                json_f = json.loads(f.read())
+                pc_proj4 = json_f['summary']['srs']['proj4']
 
         if pc_proj4 is None: raise RuntimeError("Could not determine point cloud proj4 declaration")
 
@@ -256,14 +282,8 @@ class Cropper:
         if os.path.isfile(bounds_gpkg_path):
             os.remove(bounds_gpkg_path)
 
-        # Convert bounds to GPKG
-        kwargs = {
-            'input': double_quote(bounds_geojson_path),
-            'output': double_quote(bounds_gpkg_path),
-            'proj4': pc_proj4
-        }
-
-        run('ogr2ogr -overwrite -f GPKG -a_srs "{proj4}" {output} {input}'.format(**kwargs))
+        srs = osr.SpatialReference()
+        srs.ImportFromProj4(pc_proj4)
+        self.write_polygon(convexhull, bounds_gpkg_path, 'GPKG', srs)
 
         return bounds_gpkg_path
-
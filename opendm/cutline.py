@@ -17,6 +17,7 @@ from skimage.graph import route_through_array
 import shapely
 from shapely.geometry import LineString, mapping, shape
 from shapely.ops import polygonize, unary_union
+from shapely.prepared import prep
 
 if sys.platform == 'win32':
     # Temporary fix for: ValueError: GEOSGeom_createLinearRing_r returned a NULL pointer  
@@ -38,6 +39,11 @@ def write_raster(data, file):
     with rasterio.open(file, 'w', BIGTIFF="IF_SAFER", **profile) as wout:
         wout.write(data, 1)
 
+def route_line(cost_map_file, shape, start, end):
+    cost_map = np.memmap(cost_map_file, dtype=np.float32, mode='r', shape=shape)
+    line_coords, cost = route_through_array(cost_map, start, end, fully_connected=True, geometric=True)
+    return line_coords
+
 def compute_cutline(orthophoto_file, crop_area_file, destination, max_concurrency=1, scale=1):
     if io.file_exists(orthophoto_file) and io.file_exists(crop_area_file):
         log.ODM_INFO("Computing cutline")
@@ -82,15 +88,23 @@ def compute_cutline(orthophoto_file, crop_area_file, destination, max_concurrenc
         crop_poly = shape(crop_f[1]['geometry'])
         crop_f.close()
 
-        linestrings = []
-
         # Compute canny edges on first band
         edges = canny(rast)
+        del rast
+
+        # Cost maps are stored on disk and memory mapped, so that
+        # they can be shared by the processes computing the routes
+        cost_map_files = []
+        routes = []
+
+        def compute_cost_map(direction):
+            log.ODM_INFO("Computing %s cost map" % direction)
+            cost_map_file = os.path.splitext(destination)[0] + "_%s_cost.bin" % direction
+            cost_map_files.append(cost_map_file)
 
-        def compute_linestrings(direction):
-            log.ODM_INFO("Computing %s cutlines" % direction)
             # Initialize cost map
-            cost_map = np.full((height, width), 1, dtype=np.float32)
+            cost_map = np.memmap(cost_map_file, dtype=np.float32, mode='w+', shape=(height, width))
+            cost_map[:] = 1
 
             # Write edges to cost map
             cost_map[edges==True] = 0 # Low cost
@@ -119,24 +133,42 @@ def compute_cutline(orthophoto_file, crop_area_file, destination, max_concurrenc
                 rr,cc = line(*a, *b)
                 cost_map[cc, rr] = 9999 # Lava
             
-            # Calculate route
+            cost_map.flush()
+            del cost_map
+
             for a, b in points:
-                line_coords, cost = route_through_array(cost_map, (a[1], a[0]), (b[1], b[0]), fully_connected=True, geometric=True)
+                routes.append((cost_map_file, (height, width), (a[1], a[0]), (b[1], b[0])))
+                
+        try:
+            compute_cost_map('vertical')
+            compute_cost_map('horizontal')
+            del edges
+
+            # Calculate routes, each route needs a float64 copy of the cost map
+            # plus the MCP state, so limit the number of concurrent routes by memory
+            log.ODM_INFO("Computing %s cutlines" % len(routes))
+            route_memory_mb = height * width * 32 / 1024 / 1024
+            all_line_coords = concurrency.parallel_map(lambda r: route_line(*r), routes, max_concurrency, 
+                                                       use_processes=True, memory_estimate=route_memory_mb)
+        finally:
+            # Cost maps can be very large, never leave them behind
+            for cost_map_file in cost_map_files:
+                if os.path.exists(cost_map_file):
+                    os.remove(cost_map_file)
 
-                # Convert to geographic
-                geo_line_coords = [f.xy(*c) for c in line_coords]
+        linestrings = []
+        for line_coords in all_line_coords:
+            # Convert to geographic
+            geo_line_coords = [f.xy(*c) for c in line_coords]
 
-                # Simplify
-                ls = LineString(geo_line_coords)
-                linestrings.append(ls.simplify(0.05, preserve_topology=False))
-                
-        compute_linestrings('vertical')
-        compute_linestrings('horizontal')
+            # Simplify
+            ls = LineString(geo_line_coords)
+            linestrings.append(ls.simplify(0.05, preserve_topology=False))
 
-                    
         # Generate polygons and keep only those inside the crop area
         log.ODM_INFO("Generating polygons... this could take a bit.")
         polygons = []
+        crop_poly = prep(crop_poly)
         for p in polygonize(unary_union(linestrings)):
             if crop_poly.contains(p):
                 polygons.append(p)
@@ -148,7 +180,9 @@ def compute_cutline(orthophoto_file, crop_area_file, destination, max_concurrenc
 
         log.ODM_INFO("Merging polygons")
         cutline_polygons = unary_union(polygons)
-        if not hasattr(cutline_polygons, '__getitem__'):
+        if hasattr(cutline_polygons, 'geoms'):
+            cutline_polygons = list(cutline_polygons.geoms)
+        else:
             cutline_polygons = [cutline_polygons]
 
         largest_cutline = cutline_polygons[0]
@@ -0,0 +1,116 @@
+import threading
+from opendm import log
+
+class Task:
+    def __init__(self, name, func, depends_on, cpus, memory):
+        self.name = name
+        self.func = func
+        self.depends_on = depends_on
+        self.cpus = cpus
+        self.memory = memory
+
+class TaskGraph:
+    """
+    Runs a set of tasks with dependencies, starting every task
+    as soon as its dependencies have completed and there are enough
+    CPU and memory resources available. Tasks run in threads
+    (they are expected to spend most of their time in subprocesses
+    or in code that releases the GIL).
+    """
+    def __init__(self, max_cpus, max_memory=None):
+        """
+        :param max_cpus total number of CPUs that running tasks can use
+        :param max_memory total memory (MB) that running tasks can use, None for no limit
+        """
+        self.max_cpus = max(1, max_cpus)
+        self.max_memory = max_memory
+        self.tasks = []
+        self.task_names = set()
+
+    def add(self, name, func, depends_on=[], cpus=1, memory=0):
+        """
+        :param name unique task name
+        :param func function to execute (without arguments)
+        :param depends_on list of task names that must complete before this task starts
+        :param cpus number of CPUs used by the task
+        :param memory estimated memory (MB) used by the task
+        """
+        if name in self.task_names:
+            raise ValueError("Task %s already exists" % name)
+
+        for d in depends_on:
+            if not d in self.task_names:
+                raise ValueError("Task %s depends on %s, but %s was not added" % (name, d, d))
+
+        # Since dependencies must be added first, the graph cannot have cycles
+        self.tasks.append(Task(name, func, list(depends_on), min(self.max_cpus, cpus), memory))
+        self.task_names.add(name)
+
+    def run(self):
+        """
+        Run all tasks. If a task fails, tasks that depend on it are not started,
+        tasks that are already running are allowed to finish and the exception
+        of the first failed task is raised.
+        """
+        cond = threading.Condition()
+        pending = list(self.tasks)
+        completed = set()
+        errors = []
+
+        class nonloc:
+            running = 0
+            cpus = 0
+            memory = 0
+
+        # Messages logged by the tasks belong to the caller's stage
+        stage = log.logger.get_stage()
+
+        def execute(task):
+            log.logger.set_stage(stage)
+            try:
+                task.func()
+            except BaseException as e:
+                with cond:
+                    errors.append(e)
+            else:
+                with cond:
+                    completed.add(task.name)
+            finally:
+                with cond:
+                    nonloc.running -= 1
+                    nonloc.cpus -= task.cpus
+                    nonloc.memory -= task.memory
+                    cond.notify_all()
+
+        def fits(task):
+            # Always allow at least one task to run
+            if nonloc.running == 0:
+                return True
+            if nonloc.cpus + task.cpus > self.max_cpus:
+                return False
+            if self.max_memory is not None and nonloc.memory + task.memory > self.max_memory:
+                return False
+            return True
+
+        with cond:
+            while True:
+                if not errors:
+                    for task in list(pending):
+                        if all([d in completed for d in task.depends_on]) and fits(task):
+                            pending.remove(task)
+                            nonloc.running += 1
+                            nonloc.cpus += task.cpus
+                            nonloc.memory += task.memory
+
+                            t = threading.Thread(target=execute, args=(task, ), daemon=True)
+                            t.start()
+
+                if nonloc.running == 0:
+                    break
+
+                cond.wait()
+
+        if errors:
+            if pending:
+                log.ODM_WARNING("Skipped %s because of errors" % ", ".join([t.name for t in pending]))
+            raise errors[0]
@@ -6,12 +6,13 @@ import math
 import time
 import shutil
 import functools
-from joblib import delayed, Parallel
+from rasterio.windows import Window
 from opendm.system import run
 from opendm import point_cloud
 from opendm import io
 from opendm import system
 from opendm.concurrency import get_max_memory, parallel_map
+from vmem import virtual_memory
 from scipy import ndimage
 from datetime import datetime
 from opendm.vendor.gdal_fillnodata import main as gdal_fillnodata
@@ -24,6 +25,7 @@ import threading
 
 from .ground_rectification.rectify import run_rectification
 from . import pdal
+from . import grid
 
 try:
     # GDAL >= 3.3
@@ -67,7 +69,7 @@ error = None
 def create_dem(input_point_cloud, dem_type, output_type='max', radiuses=['0.56'], gapfill=True,
                 outdir='', resolution=0.1, max_workers=1, max_tile_size=4096,
                 decimation=None, keep_unfilled_copy=False,
-                apply_smoothing=True):
+                apply_smoothing=True, max_memory=None):
     """ Create DEM from multiple radii, and optionally gapfill """
     
     global error
@@ -107,111 +109,133 @@ def create_dem(input_point_cloud, dem_type, output_type='max', radiuses=['0.56']
         
     final_dem_pixels = w * h
 
-    num_splits = int(max(1, math.ceil(math.log(math.ceil(final_dem_pixels / float(max_tile_size * max_tile_size)))/math.log(2))))
-    num_tiles = num_splits * num_splits
-    log.ODM_INFO("DEM resolution is %s, max tile size is %s, will split DEM generation into %s tiles" % ((h, w), max_tile_size, num_tiles))
-
-    tile_bounds_width = ext_width / float(num_splits)
-    tile_bounds_height = ext_height / float(num_splits)
-
-    tiles = []
-
-    for r in radiuses:
-        minx = extent['minx']
+    output_file = "%s.tif" % dem_type
+    output_path = os.path.abspath(os.path.join(outdir, output_file))
 
-        for x in range(num_splits):
-            miny = extent['miny']
-            if x == num_splits - 1:
-                maxx = extent['maxx']
-            else:
-                maxx = minx + tile_bounds_width
+    # Intermediate files are prefixed with dem_type, so that
+    # multiple DEMs can be created concurrently in the same outdir
+    tiles_vrt_path = os.path.abspath(os.path.join(outdir, "%s.tiles.vrt" % dem_type))
+    tiles_file_list = os.path.abspath(os.path.join(outdir, "%s.tiles_list.txt" % dem_type))
+    merged_vrt_path = os.path.abspath(os.path.join(outdir, "%s.merged.vrt" % dem_type))
+    geotiff_tmp_path = os.path.abspath(os.path.join(outdir, '%s.tiles.tmp.tif' % dem_type))
+    geotiff_small_path = os.path.abspath(os.path.join(outdir, '%s.tiles.small.tif' % dem_type))
+    geotiff_small_filled_path = os.path.abspath(os.path.join(outdir, '%s.tiles.small_filled.tif' % dem_type))
+    geotiff_path = os.path.abspath(os.path.join(outdir, '%s.tiles.tif' % dem_type))
 
-            for y in range(num_splits):
-                if y == num_splits - 1:
-                    maxy = extent['maxy']
-                else:
-                    maxy = miny + tile_bounds_height
+    # Build GeoTIFF
+    kwargs = {
+        'max_memory': max_memory if max_memory is not None else get_max_memory(),
+        'threads': max_workers if max_workers else 'ALL_CPUS',
+        'tiles_vrt': tiles_vrt_path,
+        'merged_vrt': merged_vrt_path,
+        'geotiff': geotiff_path,
+        'geotiff_tmp': geotiff_tmp_path,
+        'geotiff_small': geotiff_small_path,
+        'geotiff_small_filled': geotiff_small_filled_path
+    }
 
-                filename = os.path.join(os.path.abspath(outdir), '%s_r%s_x%s_y%s.tif' % (dem_type, r, x, y))
+    tiles = []
 
-                tiles.append({
-                    'radius': r,
-                    'bounds': {
-                        'minx': minx,
-                        'maxx': maxx,
-                        'miny': miny,
-                        'maxy': maxy 
-                    },
-                    'filename': filename
-                })
+    if grid.is_supported(input_point_cloud):
+        # Grid all radiuses in-process, reading the point cloud only once
+        grid.create_grid(input_point_cloud, 
+                         geotiff_tmp_path if gapfill else geotiff_path,
+                         output_type, 
+                         radiuses, 
+                         resolution, 
+                         extent, 
+                         classification=2 if dem_type == 'dtm' else None, 
+                         decimation=decimation,
+                         max_memory_mb=virtual_memory().total / 1024 / 1024 * max_memory / 100.0 if max_memory is not None else None)
+    else:
+        num_splits = int(max(1, math.ceil(math.log(math.ceil(final_dem_pixels / float(max_tile_size * max_tile_size)))/math.log(2))))
+        num_tiles = num_splits * num_splits
+        log.ODM_INFO("DEM resolution is %s, max tile size is %s, will split DEM generation into %s tiles" % ((h, w), max_tile_size, num_tiles))
 
-                miny = maxy
-            minx = maxx
+        tile_bounds_width = ext_width / float(num_splits)
+        tile_bounds_height = ext_height / float(num_splits)
 
-    # Sort tiles by increasing radius
-    tiles.sort(key=lambda t: float(t['radius']), reverse=True)
+        for r in radiuses:
+            minx = extent['minx']
 
-    def process_tile(q):
-        log.ODM_INFO("Generating %s (%s, radius: %s, resolution: %s)" % (q['filename'], output_type, q['radius'], resolution))
+            for x in range(num_splits):
+                miny = extent['miny']
+                if x == num_splits - 1:
+                    maxx = extent['maxx']
+                else:
+                    maxx = minx + tile_bounds_width
+
+                for y in range(num_splits):
+                    if y == num_splits - 1:
+                        maxy = extent['maxy']
+                    else:
+                        maxy = miny + tile_bounds_height
+
+                    filename = os.path.join(os.path.abspath(outdir), '%s_r%s_x%s_y%s.tif' % (dem_type, r, x, y))
+
+                    tiles.append({
+                        'radius': r,
+                        'bounds': {
+                            'minx': minx,
+                            'maxx': maxx,
+                            'miny': miny,
+                            'maxy': maxy 
+                        },
+                        'filename': filename
+                    })
+
+                    miny = maxy
+                minx = maxx
+
+        # Sort tiles by increasing radius
+        tiles.sort(key=lambda t: float(t['radius']), reverse=True)
+
+        def process_tile(q):
+            log.ODM_INFO("Generating %s (%s, radius: %s, resolution: %s)" % (q['filename'], output_type, q['radius'], resolution))
         
-        d = pdal.json_gdal_base(q['filename'], output_type, q['radius'], resolution, q['bounds'])
-
-        if dem_type == 'dtm':
-            d = pdal.json_add_classification_filter(d, 2)
+            d = pdal.json_gdal_base(q['filename'], output_type, q['radius'], resolution, q['bounds'])
 
-        if decimation is not None:
-            d = pdal.json_add_decimation_filter(d, decimation)
+            if dem_type == 'dtm':
+                d = pdal.json_add_classification_filter(d, 2)
 
-        pdal.json_add_readers(d, [input_point_cloud])
-        pdal.run_pipeline(d)
+            if decimation is not None:
+                d = pdal.json_add_decimation_filter(d, decimation)
 
-    parallel_map(process_tile, tiles, max_workers)
+            pdal.json_add_readers(d, [input_point_cloud])
+            pdal.run_pipeline(d)
 
-    output_file = "%s.tif" % dem_type
-    output_path = os.path.abspath(os.path.join(outdir, output_file))
+        parallel_map(process_tile, tiles, max_workers)
 
-    # Verify tile results
-    for t in tiles: 
-        if not os.path.exists(t['filename']):
-            raise Exception("Error creating %s, %s failed to be created" % (output_file, t['filename']))
+        # Verify tile results
+        for t in tiles: 
+            if not os.path.exists(t['filename']):
+                raise Exception("Error creating %s, %s failed to be created" % (output_file, t['filename']))
 
-    # Create virtual raster
-    tiles_vrt_path = os.path.abspath(os.path.join(outdir, "tiles.vrt"))
-    tiles_file_list = os.path.abspath(os.path.join(outdir, "tiles_list.txt"))
-    with open(tiles_file_list, 'w') as f:
-        for t in tiles:
-            f.write(t['filename'] + '\n')
+        with open(tiles_file_list, 'w') as f:
+            for t in tiles:
+                f.write(t['filename'] + '\n')
 
-    run('gdalbuildvrt -input_file_list "%s" "%s" ' % (tiles_file_list, tiles_vrt_path))
+        run('gdalbuildvrt -input_file_list "%s" "%s" ' % (tiles_file_list, tiles_vrt_path))
 
-    merged_vrt_path = os.path.abspath(os.path.join(outdir, "merged.vrt"))
-    geotiff_tmp_path = os.path.abspath(os.path.join(outdir, 'tiles.tmp.tif'))
-    geotiff_small_path = os.path.abspath(os.path.join(outdir, 'tiles.small.tif'))
-    geotiff_small_filled_path = os.path.abspath(os.path.join(outdir, 'tiles.small_filled.tif'))
-    geotiff_path = os.path.abspath(os.path.join(outdir, 'tiles.tif'))
-
-    # Build GeoTIFF
-    kwargs = {
-        'max_memory': get_max_memory(),
-        'threads': max_workers if max_workers else 'ALL_CPUS',
-        'tiles_vrt': tiles_vrt_path,
-        'merged_vrt': merged_vrt_path,
-        'geotiff': geotiff_path,
-        'geotiff_tmp': geotiff_tmp_path,
-        'geotiff_small': geotiff_small_path,
-        'geotiff_small_filled': geotiff_small_filled_path
-    }
+        if gapfill:
+            # Sometimes, for some reason gdal_fillnodata.py
+            # behaves strangely when reading data directly from a .VRT
+            # so we need to convert to GeoTIFF first.
+            run('gdal_translate '
+                    '-co NUM_THREADS={threads} '
+                    '-co BIGTIFF=IF_SAFER '
+                    '--config GDAL_CACHEMAX {max_memory}% '
+                    '"{tiles_vrt}" "{geotiff_tmp}"'.format(**kwargs))
+        else:
+            run('gdal_translate '
+                    '-co NUM_THREADS={threads} '
+                    '-co TILED=YES '
+                    '-co BIGTIFF=IF_SAFER '
+                    '-co COMPRESS=DEFLATE '
+                    '--config GDAL_CACHEMAX {max_memory}% '
+                    '"{tiles_vrt}" "{geotiff}"'.format(**kwargs))
 
     if gapfill:
-        # Sometimes, for some reason gdal_fillnodata.py
-        # behaves strangely when reading data directly from a .VRT
-        # so we need to convert to GeoTIFF first.
-        run('gdal_translate '
-                '-co NUM_THREADS={threads} '
-                '-co BIGTIFF=IF_SAFER '
-                '--config GDAL_CACHEMAX {max_memory}% '
-                '"{tiles_vrt}" "{geotiff_tmp}"'.format(**kwargs))
-
         # Scale to 10% size
         run('gdal_translate '
             '-co NUM_THREADS={threads} '
@@ -238,15 +262,6 @@ def create_dem(input_point_cloud, dem_type, output_type='max', radiuses=['0.56']
             '-co COMPRESS=DEFLATE '
             '--config GDAL_CACHEMAX {max_memory}% '
             '"{merged_vrt}" "{geotiff}"'.format(**kwargs))
-    else:
-        run('gdal_translate '
-                '-co NUM_THREADS={threads} '
-                '-co TILED=YES '
-                '-co BIGTIFF=IF_SAFER '
-                '-co COMPRESS=DEFLATE '
-                '--config GDAL_CACHEMAX {max_memory}% '
-                '"{tiles_vrt}" "{geotiff}"'.format(**kwargs))
-
     if apply_smoothing:
         median_smoothing(geotiff_path, output_path, num_workers=max_workers)
         os.remove(geotiff_path)
@@ -306,33 +321,72 @@ def median_smoothing(geotiff_path, output_path, smoothing_iterations=1, window_s
 
     log.ODM_INFO('Starting smoothing...')
 
+    if smoothing_iterations < 1:
+        shutil.copyfile(geotiff_path, output_path)
+        return output_path
+
+    input_path = geotiff_path
+    for i in range(smoothing_iterations):
+        log.ODM_INFO("Smoothing iteration %s" % str(i + 1))
+
+        # Each iteration filters the output of the previous one,
+        # intermediate results are written to temporary files
+        if i == smoothing_iterations - 1:
+            iteration_path = output_path
+        else:
+            iteration_path = io.related_file_path(output_path, postfix=".smoothing%s" % i)
+
+        median_filter_raster(input_path, iteration_path, kernel_size=9, window_size=window_size, num_workers=num_workers)
+
+        if input_path != geotiff_path:
+            os.remove(input_path)
+        input_path = iteration_path
+
+    log.ODM_INFO('Completed smoothing to create %s in %s' % (output_path, datetime.now() - start))
+    return output_path
+
+
+def median_filter_raster(geotiff_path, output_path, kernel_size=9, window_size=512, num_workers=1):
+    """
+    Apply a median filter to the first band of a raster, one window at a time.
+    Windows are read with enough overlap for the kernel, so results are identical 
+    to filtering the whole raster at once, but memory usage is bounded
+    by window_size and num_workers rather than by the size of the raster.
+    """
     with rasterio.open(geotiff_path) as img:
         nodata = img.nodatavals[0]
         dtype = img.dtypes[0]
         shape = img.shape
-        arr = img.read()[0]
-        for i in range(smoothing_iterations):
-            log.ODM_INFO("Smoothing iteration %s" % str(i + 1))
-            rows, cols = numpy.meshgrid(numpy.arange(0, shape[0], window_size), numpy.arange(0, shape[1], window_size))
-            rows = rows.flatten()
-            cols = cols.flatten()
-            rows_end = numpy.minimum(rows + window_size, shape[0])
-            cols_end= numpy.minimum(cols + window_size, shape[1])
-            windows = numpy.dstack((rows, cols, rows_end, cols_end)).reshape(-1, 4)
-
-            filter = functools.partial(ndimage.median_filter, size=9, output=dtype, mode='nearest')
-
-            # threading backend and GIL released filter are important for memory efficiency and multi-core performance
-            window_arrays = Parallel(n_jobs=num_workers, backend='threading')(delayed(window_filter_2d)(arr, nodata , window, 9, filter) for window in windows)
-
-            for window, win_arr in zip(windows, window_arrays):
-                arr[window[0]:window[2], window[1]:window[3]] = win_arr
-        log.ODM_INFO("Smoothing completed in %s" % str(datetime.now() - start))
-        # write output
-        with rasterio.open(output_path, 'w', BIGTIFF="IF_SAFER", **img.profile) as imgout:
-            imgout.write(arr, 1)
+        profile = img.profile
+
+        rows, cols = numpy.meshgrid(numpy.arange(0, shape[0], window_size), numpy.arange(0, shape[1], window_size))
+        rows = rows.flatten()
+        cols = cols.flatten()
+        rows_end = numpy.minimum(rows + window_size, shape[0])
+        cols_end= numpy.minimum(cols + window_size, shape[1])
+        windows = numpy.dstack((rows, cols, rows_end, cols_end)).reshape(-1, 4)
+
+        filter = functools.partial(ndimage.median_filter, size=kernel_size, output=dtype, mode='nearest')
+
+        # Datasets cannot be shared between threads, but filtering
+        # (which releases the GIL) runs in parallel
+        read_lock = threading.Lock()
+        write_lock = threading.Lock()
+
+        with rasterio.open(output_path, 'w', BIGTIFF="IF_SAFER", **profile) as imgout:
+            def process_window(window):
+                expanded_window = [ max(0, window[0] - kernel_size // 2), max(0, window[1] - kernel_size // 2), min(shape[0], window[2] + kernel_size // 2), min(shape[1], window[3] + kernel_size // 2) ]
+                with read_lock:
+                    arr = img.read(1, window=Window.from_slices((expanded_window[0], expanded_window[2]), (expanded_window[1], expanded_window[3])))
+                
+                relative_window = [window[0] - expanded_window[0], window[1] - expanded_window[1], window[2] - expanded_window[0], window[3] - expanded_window[1]]
+                win_arr = window_filter_2d(arr, nodata, relative_window, kernel_size, filter)
+
+                with write_lock:
+                    imgout.write(win_arr, 1, window=Window.from_slices((window[0], window[2]), (window[1], window[3])))
+
+            parallel_map(process_window, windows, num_workers, single_thread_fallback=False)
 
-    log.ODM_INFO('Completed smoothing to create %s in %s' % (output_path, datetime.now() - start))
     return output_path
 
 
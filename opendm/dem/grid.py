@@ -0,0 +1,245 @@
+"""
+In-process gridding of LAS/LAZ point clouds, following the same rules as
+PDAL's writers.gdal, but computing all radii with a single read
+of the point cloud and writing the result directly to a GeoTIFF.
+"""
+import os
+import math
+import numpy as np
+import laspy
+import rasterio
+from rasterio.transform import Affine
+from rasterio.windows import Window
+from opendm import log
+from opendm.concurrency import get_max_memory_mb
+
+NODATA = -9999
+BLOCK_SIZE = 256
+
+# Bytes needed per cell for each radius
+ACCUMULATOR_BYTES = {
+    'max': 8,
+    'min': 8,
+    'mean': 16,
+    'idw': 24
+}
+
+def is_supported(input_point_cloud):
+    return os.path.splitext(input_point_cloud)[1].lower() in ['.las', '.laz']
+
+def grid_size(bounds, resolution):
+    """
+    :return (width, height) of the grid, using the same rounding as PDAL
+    """
+    return (int((bounds['maxx'] - bounds['minx']) / resolution) + 1,
+            int((bounds['maxy'] - bounds['miny']) / resolution) + 1)
+
+class Accumulator:
+    """
+    Accumulates point values for a range of rows of the grid, for a single radius.
+    Rows (j) are counted from the bottom of the grid, like in PDAL
+    """
+    def __init__(self, output_type, radius, resolution, width, j_start, j_end):
+        self.output_type = output_type
+        self.radius = radius
+        self.resolution = resolution
+        self.width = width
+        self.j_start = j_start
+        self.j_end = j_end
+
+        cells = width * (j_end - j_start)
+        if output_type == 'max':
+            self.values = np.full(cells, -np.inf)
+        elif output_type == 'min':
+            self.values = np.full(cells, np.inf)
+        elif output_type == 'mean':
+            self.sums = np.zeros(cells)
+            self.counts = np.zeros(cells)
+        elif output_type == 'idw':
+            self.sums = np.zeros(cells)
+            self.weights = np.zeros(cells)
+            self.exact = np.full(cells, np.nan)
+        else:
+            raise ValueError("Unsupported output type: %s" % output_type)
+
+        # Cell offsets that can be within radius of a point
+        k = int(math.ceil(radius / resolution))
+        self.offsets = []
+        for di in range(-k, k + 1):
+            for dj in range(-k, k + 1):
+                dx = max(0, abs(di) - 0.5) * resolution
+                dy = max(0, abs(dj) - 0.5) * resolution
+                if math.sqrt(dx * dx + dy * dy) < radius:
+                    self.offsets.append((di, dj))
+
+    def add(self, x, y, z, i, j):
+        """
+        :param x, y point coordinates, relative to the grid origin
+        :param z point values
+        :param i, j indexes of the cells containing the points
+        """
+        for di, dj in self.offsets:
+            ci = i + di
+            cj = j + dj
+            dist = np.hypot(x - (ci + 0.5) * self.resolution, y - (cj + 0.5) * self.resolution)
+            m = (dist < self.radius) & (ci >= 0) & (ci < self.width) & (cj >= self.j_start) & (cj < self.j_end)
+            if not np.any(m):
+                continue
+
+            idx = (cj[m] - self.j_start) * self.width + ci[m]
+            zm = z[m]
+
+            if self.output_type == 'max':
+                np.maximum.at(self.values, idx, zm)
+            elif self.output_type == 'min':
+                np.minimum.at(self.values, idx, zm)
+            elif self.output_type == 'mean':
+                np.add.at(self.sums, idx, zm)
+                np.add.at(self.counts, idx, 1)
+            elif self.output_type == 'idw':
+                dm = dist[m]
+                zero = dm == 0
+                if np.any(zero):
+                    self.exact[idx[zero]] = zm[zero]
+                nz = ~zero
+                np.add.at(self.sums, idx[nz], zm[nz] / dm[nz])
+                np.add.at(self.weights, idx[nz], 1.0 / dm[nz])
+
+    def result(self):
+        """
+        :return array of cell values (NaN for empty cells), bottom row first
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.output_type in ['max', 'min']:
+                res = np.where(np.isinf(self.values), np.nan, self.values)
+            elif self.output_type == 'mean':
+                res = np.where(self.counts > 0, self.sums / self.counts, np.nan)
+            elif self.output_type == 'idw':
+                res = np.where(self.weights > 0, self.sums / self.weights, np.nan)
+                has_exact = ~np.isnan(self.exact)
+                res[has_exact] = self.exact[has_exact]
+
+        return res.reshape((self.j_end - self.j_start, self.width))
+
+def read_points(input_point_cloud, classification=None, decimation=None, chunk_size=2000000):
+    """
+    Generator of (x, y, z) arrays, read in chunks
+    """
+    index = 0
+    with laspy.open(input_point_cloud) as f:
+        for points in f.chunk_iterator(chunk_size):
+            x = np.asarray(points.x)
+            y = np.asarray(points.y)
+            z = np.asarray(points.z)
+            keep = None
+
+            # Same order as the PDAL pipeline: decimation first, then classification
+            if decimation is not None and decimation > 1:
+                keep = (np.arange(index, index + len(x)) % decimation) == 0
+            if classification is not None:
+                cm = np.asarray(points.classification) == classification
+                keep = cm if keep is None else (keep & cm)
+
+            index += len(x)
+            if keep is not None:
+                x, y, z = x[keep], y[keep], z[keep]
+
+            yield x, y, z
+
+def get_crs(input_point_cloud):
+    try:
+        with laspy.open(input_point_cloud) as f:
+            crs = f.header.parse_crs()
+            if crs is not None:
+                return crs.to_wkt()
+    except Exception as e:
+        log.ODM_WARNING("Cannot read CRS from %s: %s" % (input_point_cloud, str(e)))
+
+def create_grid(input_point_cloud, output_path, output_type, radiuses, resolution, bounds,
+                classification=None, decimation=None, max_memory_mb=None):
+    """
+    Grid a point cloud using multiple radii. Cells are assigned the value computed with the
+    smallest radius for which they received points, which is equivalent to stacking
+    the rasters generated by PDAL with decreasing radii.
+    :param input_point_cloud path to a LAS/LAZ file
+    :param output_path path to the GeoTIFF to write
+    :param output_type one of max, min, mean, idw
+    :param radiuses list of radii
+    :param resolution cell size
+    :param bounds dictionary with minx, maxx, miny, maxy keys
+    :param classification only use points with this classification, None for all points
+    :param decimation only use one point every N points
+    :param max_memory_mb memory to use for the accumulators, by default
+        a fraction of the available memory. If the grid doesn't fit, it's
+        created in multiple bands of rows, reading the point cloud once per band
+    """
+    radiuses = sorted([float(r) for r in radiuses])
+    resolution = float(resolution)
+    width, height = grid_size(bounds, resolution)
+
+    if max_memory_mb is None:
+        max_memory_mb = get_max_memory_mb()
+
+    row_bytes = width * ACCUMULATOR_BYTES[output_type] * len(radiuses)
+    band_rows = int(max_memory_mb * 1024 * 1024 // row_bytes)
+    band_rows = max(BLOCK_SIZE, band_rows // BLOCK_SIZE * BLOCK_SIZE)
+    num_bands = int(math.ceil(height / float(band_rows)))
+
+    log.ODM_INFO("Gridding %s (%s, radiuses: %s, resolution: %s, size: %sx%s, %s pass%s)" %
+        (input_point_cloud, output_type, radiuses, resolution, width, height, num_bands, "es" if num_bands > 1 else ""))
+
+    profile = {
+        'driver': 'GTiff',
+        'width': width,
+        'height': height,
+        'count': 1,
+        'dtype': 'float32',
+        'nodata': NODATA,
+        'transform': Affine(resolution, 0, bounds['minx'], 0, -resolution, bounds['miny'] + height * resolution),
+        'tiled': True,
+        'blockxsize': BLOCK_SIZE,
+        'blockysize': BLOCK_SIZE,
+        'compress': 'deflate',
+        'BIGTIFF': 'IF_SAFER'
+    }
+    crs = get_crs(input_point_cloud)
+    if crs is not None:
+        profile['crs'] = crs
+
+    with rasterio.open(output_path, 'w', **profile) as dst:
+        # Bands of rows, from the top of the raster
+        for row_start in range(0, height, band_rows):
+            row_end = min(height, row_start + band_rows)
+            j_start, j_end = height - row_end, height - row_start
+
+            accumulators = [Accumulator(output_type, r, resolution, width, j_start, j_end) for r in radiuses]
+
+            for x, y, z in read_points(input_point_cloud, classification, decimation):
+                x = x - bounds['minx']
+                y = y - bounds['miny']
+                i = (x / resolution).astype(np.int64)
+                j = (y / resolution).astype(np.int64)
+
+                # Only points that can reach this band
+                reach = int(math.ceil(radiuses[-1] / resolution))
+                m = (j >= j_start - reach) & (j < j_end + reach)
+                if not np.all(m):
+                    x, y, z, i, j = x[m], y[m], z[m], i[m], j[m]
+
+                for acc in accumulators:
+                    acc.add(x, y, z, i, j)
+
+            # Smallest radius wins
+            band = None
+            for acc in accumulators:
+                res = acc.result()
+                if band is None:
+                    band = res
+                else:
+                    empty = np.isnan(band)
+                    band[empty] = res[empty]
+
+            band[np.isnan(band)] = NODATA
+            dst.write(band[::-1].astype(np.float32), 1, window=Window(0, row_start, width, row_end - row_start))
+
+    return output_path
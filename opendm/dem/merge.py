@@ -8,8 +8,24 @@ from opendm.dem.commands import compute_euclidean_map
 from opendm import log
 from opendm import io
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
 
-def euclidean_merge_dems(input_dems, output_dem, creation_options={}, euclidean_map_source=None):
+def max_open_files():
+    """
+    :return maximum number of files that this process can open
+    """
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != resource.RLIM_INFINITY:
+            return soft
+    except (ImportError, ValueError, OSError):
+        pass
+    return 1024
+
+def euclidean_merge_dems(input_dems, output_dem, creation_options={}, euclidean_map_source=None, max_workers=1):
     """
     Based on https://github.com/mapbox/rio-merge-rgba
     and ideas from Anna Petrasova
@@ -18,6 +34,11 @@ def euclidean_merge_dems(input_dems, output_dem, creation_options={}, euclidean_
     Computes a merged DEM by computing/using a euclidean 
     distance to NODATA cells map for all DEMs and then blending all overlapping DEM cells 
     by a weighted average based on such euclidean distance.
+
+    Blocks are processed by max_workers threads, each block only
+    reads the DEMs that intersect it. Each thread keeps a limited number
+    of DEMs open, so that the number of open files stays within
+    the process limits regardless of the number of inputs.
     """
     inputs = []
     bounds=None
@@ -39,6 +60,7 @@ def euclidean_merge_dems(input_dems, output_dem, creation_options={}, euclidean_
         res = first.res
         dtype = first.dtypes[0]
         profile = first.profile
+        band_count = first.count
 
     for dem in existing_dems:
         eumap = compute_euclidean_map(dem, io.related_file_path(dem, postfix=".euclideand", replace_base=euclidean_map_source), overwrite=False)
@@ -47,7 +69,46 @@ def euclidean_merge_dems(input_dems, output_dem, creation_options={}, euclidean_
 
     log.ODM_INFO("%s valid DEM rasters to merge" % len(inputs))
 
-    sources = [(rasterio.open(d), rasterio.open(e)) for d,e in inputs]
+    # Read the metadata of the sources, without keeping them open
+    src_bounds = []
+    always_read = []
+    for d, e in inputs:
+        with rasterio.open(d) as src_d, rasterio.open(e) as src_e:
+            if src_d.profile["count"] != 1 or src_e.profile["count"] != 1:
+                raise ValueError("Inputs must be 1-band rasters")
+            src_bounds.append(src_d.bounds)
+
+            # Sources without a nodata value always contribute
+            # to a block (even outside of their bounds), so they are always read
+            always_read.append(src_d.nodatavals[0] is None)
+    src_bounds = np.array(src_bounds)
+    always_read = np.array(always_read)
+
+    # Datasets cannot be shared between threads, each worker
+    # opens the sources it needs, up to max_open pairs at a time
+    max_workers = max(1, max_workers)
+    max_open = max(1, (max_open_files() // 2) // (2 * max_workers))
+    thread_sources = threading.local()
+    opened_sources = []
+    opened_lock = threading.Lock()
+
+    def get_source(i):
+        if not hasattr(thread_sources, 'sources'):
+            thread_sources.sources = OrderedDict()
+            with opened_lock:
+                opened_sources.append(thread_sources.sources)
+
+        srcs = thread_sources.sources
+        if i in srcs:
+            srcs.move_to_end(i)
+        else:
+            if len(srcs) >= max_open:
+                _, (src_d, src_e) = srcs.popitem(last=False)
+                src_d.close()
+                src_e.close()
+            d, e = inputs[i]
+            srcs[i] = (rasterio.open(d), rasterio.open(e))
+        return srcs[i]
 
     # Extent from option or extent of all inputs.
     if bounds:
@@ -55,15 +116,8 @@ def euclidean_merge_dems(input_dems, output_dem, creation_options={}, euclidean_
     else:
         # scan input files.
         # while we're at it, validate assumptions about inputs
-        xs = []
-        ys = []
-        for src_d, src_e in sources:
-            left, bottom, right, top = src_d.bounds
-            xs.extend([left, right])
-            ys.extend([bottom, top])
-            if src_d.profile["count"] != 1 or src_e.profile["count"] != 1:
-                raise ValueError("Inputs must be 1-band rasters")
-        dst_w, dst_s, dst_e, dst_n = min(xs), min(ys), max(xs), max(ys)
+        dst_w, dst_s = src_bounds[:,0].min(), src_bounds[:,1].min()
+        dst_e, dst_n = src_bounds[:,2].max(), src_bounds[:,3].max()
     log.ODM_INFO("Output bounds: %r %r %r %r" % (dst_w, dst_s, dst_e, dst_n))
 
     output_transform = Affine.translation(dst_w, dst_n)
@@ -91,85 +145,113 @@ def euclidean_merge_dems(input_dems, output_dem, creation_options={}, euclidean_
     # Creation opts
     profile.update(creation_options)
 
+    def intersecting(left, bottom, right, top):
+        return np.nonzero(always_read | 
+                          ((src_bounds[:,0] < right) & (src_bounds[:,2] > left) & 
+                           (src_bounds[:,1] < top) & (src_bounds[:,3] > bottom)))[0]
+
+    def process_block(dst_window, left, bottom, right, top):
+        blocksize = dst_window.width
+        dst_rows, dst_cols = (dst_window.height, dst_window.width)
+
+        # initialize array destined for the block
+        dst_count = band_count
+        dst_shape = (dst_count, dst_rows, dst_cols)
+
+        dstarr = np.zeros(dst_shape, dtype=dtype)
+        distsum = np.zeros(dst_shape, dtype=dtype)
+        small_distance = 0.001953125
+
+        for i in intersecting(left, bottom, right, top):
+            src_d, src_e = get_source(i)
+
+            # The full_cover behavior is problematic here as it includes
+            # extra pixels along the bottom right when the sources are
+            # slightly misaligned
+            #
+            # src_window = get_window(left, bottom, right, top,
+            #                         src.transform, precision=precision)
+            #
+            # With rio merge this just adds an extra row, but when the
+            # imprecision occurs at each block, you get artifacts
+
+            nodata = src_d.nodatavals[0]
+
+            # Alternative, custom get_window using rounding
+            src_window_d = tuple(zip(rowcol(
+                    src_d.transform, left, top, op=round, precision=precision
+                ), rowcol(
+                    src_d.transform, right, bottom, op=round, precision=precision
+                )))
+
+            src_window_e = tuple(zip(rowcol(
+                    src_e.transform, left, top, op=round, precision=precision
+                ), rowcol(
+                    src_e.transform, right, bottom, op=round, precision=precision
+                )))
+
+            temp_d = np.zeros(dst_shape, dtype=dtype)
+            temp_d = src_d.read(
+                out=temp_d, window=src_window_d, boundless=True, masked=False
+            )
+
+            temp_e = np.zeros(dst_shape, dtype=dtype)
+            temp_e = src_e.read(
+                out=temp_e, window=src_window_e, boundless=True, masked=False
+            )
+
+            # Set NODATA areas in the euclidean map to a very low value
+            # so that:
+            #  - Areas with overlap prioritize DEM layers' cells that 
+            #    are far away from NODATA areas
+            #  - Areas that have no overlap are included in the final result
+            #    even if they are very close to a NODATA cell
+            temp_e[temp_e==0] = small_distance
+            temp_e[temp_d==nodata] = 0
+
+            np.multiply(temp_d, temp_e, out=temp_d)
+            np.add(dstarr, temp_d, out=dstarr)
+            np.add(distsum, temp_e, out=distsum)
+
+        np.divide(dstarr, distsum, out=dstarr, where=distsum[0] != 0.0)
+
+        # Perform nearest neighbor interpolation on areas where two or more rasters overlap
+        # but where both rasters have only interpolated data. This prevents the creation
+        # of artifacts that average areas of interpolation.
+        indices = ndimage.distance_transform_edt(np.logical_and(distsum < 1, distsum > small_distance), 
+                                            return_distances=False, 
+                                            return_indices=True)
+        dstarr = dstarr[tuple(indices)]
+
+        dstarr[dstarr == 0.0] = src_nodata
+
+        return dstarr
+
     # create destination file
-    with rasterio.open(output_dem, "w", **profile) as dstrast:
+    with rasterio.open(output_dem, "w", **profile) as dstrast, \
+         ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Limit the number of blocks in memory
+        max_in_flight = max_workers * 2
+        running = {}
 
-        for idx, dst_window in dstrast.block_windows():
+        def write_completed(return_when):
+            done, _ = wait(running, return_when=return_when)
+            for future in done:
+                dstrast.write(future.result(), window=running.pop(future))
 
+        for idx, dst_window in dstrast.block_windows():
             left, bottom, right, top = dstrast.window_bounds(dst_window)
+            running[executor.submit(process_block, dst_window, left, bottom, right, top)] = dst_window
+
+            if len(running) >= max_in_flight:
+                write_completed(FIRST_COMPLETED)
+
+        while running:
+            write_completed(ALL_COMPLETED)
 
-            blocksize = dst_window.width
-            dst_rows, dst_cols = (dst_window.height, dst_window.width)
-
-            # initialize array destined for the block
-            dst_count = first.count
-            dst_shape = (dst_count, dst_rows, dst_cols)
-
-            dstarr = np.zeros(dst_shape, dtype=dtype)
-            distsum = np.zeros(dst_shape, dtype=dtype)
-            small_distance = 0.001953125
-
-            for src_d, src_e in sources:
-                # The full_cover behavior is problematic here as it includes
-                # extra pixels along the bottom right when the sources are
-                # slightly misaligned
-                #
-                # src_window = get_window(left, bottom, right, top,
-                #                         src.transform, precision=precision)
-                #
-                # With rio merge this just adds an extra row, but when the
-                # imprecision occurs at each block, you get artifacts
-
-                nodata = src_d.nodatavals[0]
-
-                # Alternative, custom get_window using rounding
-                src_window_d = tuple(zip(rowcol(
-                        src_d.transform, left, top, op=round, precision=precision
-                    ), rowcol(
-                        src_d.transform, right, bottom, op=round, precision=precision
-                    )))
-
-                src_window_e = tuple(zip(rowcol(
-                        src_e.transform, left, top, op=round, precision=precision
-                    ), rowcol(
-                        src_e.transform, right, bottom, op=round, precision=precision
-                    )))
-
-                temp_d = np.zeros(dst_shape, dtype=dtype)
-                temp_d = src_d.read(
-                    out=temp_d, window=src_window_d, boundless=True, masked=False
-                )
-
-                temp_e = np.zeros(dst_shape, dtype=dtype)
-                temp_e = src_e.read(
-                    out=temp_e, window=src_window_e, boundless=True, masked=False
-                )
-
-                # Set NODATA areas in the euclidean map to a very low value
-                # so that:
-                #  - Areas with overlap prioritize DEM layers' cells that 
-                #    are far away from NODATA areas
-                #  - Areas that have no overlap are included in the final result
-                #    even if they are very close to a NODATA cell
-                temp_e[temp_e==0] = small_distance
-                temp_e[temp_d==nodata] = 0
-
-                np.multiply(temp_d, temp_e, out=temp_d)
-                np.add(dstarr, temp_d, out=dstarr)
-                np.add(distsum, temp_e, out=distsum)
-
-            np.divide(dstarr, distsum, out=dstarr, where=distsum[0] != 0.0)
-
-            # Perform nearest neighbor interpolation on areas where two or more rasters overlap
-            # but where both rasters have only interpolated data. This prevents the creation
-            # of artifacts that average areas of interpolation.
-            indices = ndimage.distance_transform_edt(np.logical_and(distsum < 1, distsum > small_distance), 
-                                                return_distances=False, 
-                                                return_indices=True)
-            dstarr = dstarr[tuple(indices)]
-
-            dstarr[dstarr == 0.0] = src_nodata
-
-            dstrast.write(dstarr, window=dst_window)
+    for srcs in opened_sources:
+        for src_d, src_e in srcs.values():
+            src_d.close()
+            src_e.close()
 
     return output_dem
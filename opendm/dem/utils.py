@@ -1,10 +1,10 @@
 
-def get_dem_vars(args):
+def get_dem_vars(args, max_concurrency=None):
     return {
         'TILED': 'YES',
         'COMPRESS': 'DEFLATE',
         'BLOCKXSIZE': 512,
         'BLOCKYSIZE': 512,
         'BIGTIFF': 'IF_SAFER',
-        'NUM_THREADS': args.max_concurrency,
+        'NUM_THREADS': max_concurrency if max_concurrency is not None else args.max_concurrency,
     }
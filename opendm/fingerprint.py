@@ -0,0 +1,103 @@
+import os
+import json
+import hashlib
+
+from opendm import log
+
+def file_signature(path):
+    """
+    Cheap signature of a file (name, size and modification time).
+    :return signature or None if the file does not exist
+    """
+    try:
+        st = os.stat(path)
+        return [os.path.basename(path), st.st_size, st.st_mtime_ns]
+    except OSError:
+        return None
+
+class Fingerprint:
+    """
+    Records the parameters and inputs used to generate an output file,
+    so that the output can be reused only if neither has changed.
+    The fingerprint is stored in a hidden file next to the output.
+    """
+    def __init__(self, output_file, params={}, inputs=[]):
+        """
+        :param output_file path to the output file
+        :param params JSON-serializable dictionary of the parameters that affect the output
+        :param inputs list of input file paths that affect the output
+        """
+        self.output_file = output_file
+        self.params = json.loads(json.dumps(params, sort_keys=True, default=str))
+
+        # Signatures are taken now, before any processing
+        # modifies the inputs
+        self.inputs = [file_signature(f) for f in inputs]
+
+    def path(self):
+        d, f = os.path.split(self.output_file)
+        return os.path.join(d, ".%s.fingerprint" % f)
+
+    def params_digest(self):
+        return hashlib.sha1(json.dumps(self.params, sort_keys=True).encode('utf8')).hexdigest()
+
+    def matches(self):
+        """
+        :return True if the output exists and was generated
+            with the same parameters and inputs
+        """
+        if not os.path.exists(self.output_file):
+            return False
+
+        fp_file = self.path()
+        if not os.path.isfile(fp_file):
+            # We cannot know how the output was created
+            # (e.g. by a previous version), so it's regenerated
+            log.ODM_INFO("No fingerprint found for %s" % self.output_file)
+            return False
+
+        try:
+            with open(fp_file, 'r') as f:
+                saved = json.loads(f.read())
+        except Exception as e:
+            log.ODM_WARNING("Cannot read %s: %s" % (fp_file, str(e)))
+            return False
+
+        if saved.get('params') != self.params_digest():
+            log.ODM_INFO("Parameters for %s have changed" % self.output_file)
+            return False
+
+        saved_inputs = saved.get('inputs', [])
+        if len(saved_inputs) != len(self.inputs):
+            log.ODM_INFO("Inputs for %s have changed" % self.output_file)
+            return False
+
+        for current, previous in zip(self.inputs, saved_inputs):
+            # Inputs that have been removed since (e.g. by --optimize-disk-space)
+            # cannot be compared and are ignored
+            if current is not None and current != previous:
+                log.ODM_INFO("Input %s for %s has changed" % (current[0], self.output_file))
+                return False
+
+        return True
+
+    def save(self):
+        try:
+            with open(self.path(), 'w') as f:
+                f.write(json.dumps({
+                    'params': self.params_digest(),
+                    'inputs': self.inputs
+                }))
+        except Exception as e:
+            log.ODM_WARNING("Cannot write fingerprint for %s: %s" % (self.output_file, str(e)))
+
+    def invalidate(self):
+        """
+        Mark the output as incomplete, so that it's regenerated
+        if processing is interrupted before save() is called
+        """
+        try:
+            with open(self.path(), 'w') as f:
+                f.write(json.dumps({'params': None, 'inputs': []}))
+        except Exception as e:
+            log.ODM_WARNING("Cannot write fingerprint for %s: %s" % (self.output_file, str(e)))
@@ -6,6 +6,7 @@ import numpy as np
 import pygltflib
 from opendm import system
 from opendm import io
+from opendm.objio import read_obj
 
 warnings.filterwarnings("ignore", category=rasterio.errors.NotGeoreferencedWarning)
 
@@ -18,56 +19,27 @@ def load_obj(obj_path, _info=print):
     obj = {
         'materials': {},
     }
-    vertices = []
-    uvs = []
-    normals = []
 
-    faces = {}
-    current_material = "_"
+    _info("Loading %s" % obj_path)
+    geometry = read_obj(obj_path)
 
-    with open(obj_path) as f:
-        _info("Loading %s" % obj_path)
+    for mtl_file in geometry['mtllibs']:
+        obj['materials'].update(load_mtl(mtl_file, obj_base_path, _info=_info))
 
-        for line in f:
-            if line.startswith("mtllib "):
-                # Materials
-                mtl_file = "".join(line.split()[1:]).strip()
-                obj['materials'].update(load_mtl(mtl_file, obj_base_path, _info=_info))
-            elif line.startswith("v "):
-                # Vertices
-                vertices.append(list(map(float, line.split()[1:4])))
-            elif line.startswith("vt "):
-                # UVs
-                uvs.append(list(map(float, line.split()[1:3])))
-            elif line.startswith("vn "):
-                normals.append(list(map(float, line.split()[1:4])))
-            elif line.startswith("usemtl "):
-                mtl_name = "".join(line.split()[1:]).strip()
-                if not mtl_name in obj['materials']:
-                    raise Exception("%s material is missing" % mtl_name)
-
-                current_material = mtl_name
-            elif line.startswith("f "):
-                if current_material not in faces:
-                    faces[current_material] = []
-                
-                a,b,c = line.split()[1:]
-
-                if a.count("/") == 2:
-                    av, at, an = map(int, a.split("/")[0:3])
-                    bv, bt, bn = map(int, b.split("/")[0:3])
-                    cv, ct, cn = map(int, c.split("/")[0:3])
-
-                    faces[current_material].append((av - 1, bv - 1, cv - 1, at - 1, bt - 1, ct - 1, an - 1, bn - 1, cn - 1)) 
-                else:
-                    av, at = map(int, a.split("/")[0:2])
-                    bv, bt = map(int, b.split("/")[0:2])
-                    cv, ct = map(int, c.split("/")[0:2])
-                    faces[current_material].append((av - 1, bv - 1, cv - 1, at - 1, bt - 1, ct - 1)) 
-
-    obj['vertices'] = np.array(vertices, dtype=np.float32)
-    obj['uvs'] = np.array(uvs, dtype=np.float32)
-    obj['normals'] = np.array(normals, dtype=np.float32)
+    if not 'vt' in geometry['face_format']:
+        raise Exception("%s has no texture coordinates" % obj_path)
+
+    faces = {}
+    for mtl_name, f in geometry['faces'].items():
+        if mtl_name != "_" and not mtl_name in obj['materials']:
+            raise Exception("%s material is missing" % mtl_name)
+        
+        # (v1, v2, v3, t1, t2, t3[, n1, n2, n3])
+        faces[mtl_name] = f.transpose((0, 2, 1)).reshape((len(f), -1))
+
+    obj['vertices'] = geometry['vertices'].astype(np.float32)
+    obj['uvs'] = geometry['uvs'].astype(np.float32)
+    obj['normals'] = geometry['normals'].astype(np.float32)
     obj['faces'] = faces
 
     obj['materials'] = convert_materials_to_jpeg(obj['materials'])
@@ -45,18 +45,39 @@ class ODMLogger:
     def __init__(self):
         self.json = None
         self.json_output_file = None
+        self.json_stages = {}
+        self.stage_local = threading.local()
         self.start_time = datetime.datetime.now()
 
+    def set_stage(self, name):
+        """
+        Attribute the messages logged by the current thread to a stage.
+        Stages can run concurrently, so each thread keeps track of its own
+        """
+        self.stage_local.name = name
+
+    def get_stage(self):
+        return getattr(self.stage_local, 'name', None)
+
+    def _json_stage(self):
+        stage = self.json_stages.get(self.get_stage())
+        if stage is None and self.json['stages']:
+            # Messages from threads not tied to a stage
+            stage = self.json['stages'][-1]
+        return stage
+
     def log(self, startc, msg, level_name):
         level = ("[" + level_name + "]").ljust(9)
         with lock:
             print("%s%s %s%s" % (startc, level, msg, ENDC))
             sys.stdout.flush()
             if self.json is not None:
-                self.json['stages'][-1]['messages'].append({
-                    'message': msg,
-                    'type': level_name.lower()
-                })
+                stage = self._json_stage()
+                if stage is not None:
+                    stage['messages'].append({
+                        'message': msg,
+                        'type': level_name.lower()
+                    })
     
     def init_json_output(self, output_files, args):
         self.json_output_files = output_files
@@ -73,12 +94,23 @@ class ODMLogger:
         self.json['success'] = False
 
     def log_json_stage_run(self, name, start_time):
+        self.set_stage(name)
         if self.json is not None:
-            self.json['stages'].append({
-                'name': name,
-                'startTime': start_time.isoformat(),
-                'messages': [],
-            })
+            with lock:
+                stage = {
+                    'name': name,
+                    'startTime': start_time.isoformat(),
+                    'messages': [],
+                }
+                self.json['stages'].append(stage)
+                self.json_stages[name] = stage
+
+    def log_json_stage_end(self, name):
+        if self.json is not None:
+            with lock:
+                stage = self.json_stages.get(name)
+                if stage is not None:
+                    self._log_json_stage_end_time(stage, datetime.datetime.now())
     
     def log_json_images(self, count):
         if self.json is not None:
@@ -115,11 +147,15 @@ class ODMLogger:
             self.json['endTime'] = end_time.isoformat()
             self.json['totalTime'] = round((end_time - self.start_time).total_seconds(), 2)
 
-            if self.json['stages']:
-                last_stage = self.json['stages'][-1]
-                last_stage['endTime'] = end_time.isoformat()
-                start_time = dateutil.parser.isoparse(last_stage['startTime'])
-                last_stage['totalTime'] = round((end_time - start_time).total_seconds(), 2)
+            # Stages that were still running (e.g. the one that failed)
+            for stage in self.json['stages']:
+                if not 'endTime' in stage:
+                    self._log_json_stage_end_time(stage, end_time)
+
+    def _log_json_stage_end_time(self, stage, end_time):
+        stage['endTime'] = end_time.isoformat()
+        start_time = dateutil.parser.isoparse(stage['startTime'])
+        stage['totalTime'] = round((end_time - start_time).total_seconds(), 2)
             
     def info(self, msg):
         self.log(DEFAULT, msg, "INFO")
@@ -2,9 +2,13 @@ import math
 import re
 import cv2
 import os
+import json
+import hashlib
+from threading import Lock
 from opendm import dls
 import numpy as np
 from opendm import log
+from opendm import cache
 from opendm.concurrency import parallel_map
 from opensfm.io import imread
 
@@ -14,11 +18,12 @@ from skimage.filters import rank, gaussian
 
 # Loosely based on https://github.com/micasense/imageprocessing/blob/master/micasense/utils.py
 
-def dn_to_radiance(photo, image):
+def dn_to_radiance(photo, image, cache_dir=None):
     """
     Convert Digital Number values to Radiance values
     :param photo ODM_Photo
     :param image numpy array containing image data
+    :param cache_dir optional directory where to store vignetting maps (see vignette_map)
     :return numpy array with radiance image values
     """
 
@@ -46,67 +51,92 @@ def dn_to_radiance(photo, image):
     if a1 is None and photometric_exp is not None:
         a1 = photometric_exp
 
-    V, x, y = vignette_map(photo)
-    if x is None:
-        x, y = np.meshgrid(np.arange(photo.width), np.arange(photo.height))
-
     if dark_level is not None:
         image -= dark_level
 
-    # Normalize DN to 0 - 1.0
+    # All scalar factors are combined in a single one:
+    # normalize DN to 0 - 1.0, then scale by the gain-exposure product and
+    # multiply with the radiometric calibration coefficient
+    scale = a1
+
     bit_depth_max = photo.get_bit_depth_max()
     if bit_depth_max:
-        image /= bit_depth_max
+        scale /= bit_depth_max
     else:
         log.ODM_WARNING("Cannot normalize DN for %s, bit depth is missing" % photo.filename)
     
-    if V is not None:
-        # vignette correction
-        V = np.repeat(V[:, :, np.newaxis], image.shape[2], axis=2)
-        image *= V
+    if gain is not None and exposure_time is not None:
+        scale /= (gain * exposure_time)
+
+    if gain_adjustment is not None:
+        scale *= gain_adjustment
+    
+    # Per-pixel factors: vignette correction (depends on the pixel)
+    # and row gradient correction (depends on the row only)
+    V = vignette_map(photo, cache_dir)
 
     if exposure_time and a2 is not None and a3 is not None:
-        # row gradient correction
-        R = 1.0 / (1.0 + a2 * y / exposure_time - a3 * y)
-        R = np.repeat(R[:, :, np.newaxis], image.shape[2], axis=2)
+        y = np.arange(image.shape[0], dtype=np.float64)
+        R = (scale / (1.0 + a2 * y / exposure_time - a3 * y)).astype(np.float32)[:, np.newaxis]
+    else:
+        R = np.float32(scale)
+
+    if V is not None:
+        image *= (V * R)[:, :, np.newaxis]
+    elif np.ndim(R) > 0:
+        image *= R[:, :, np.newaxis]
+    else:
         image *= R
     
     # Floor any negative radiances to zero (can happen due to noise around blackLevel)
     if dark_level is not None:
-        image[image < 0] = 0
-    
-    # apply the radiometric calibration - i.e. scale by the gain-exposure product and
-    # multiply with the radiometric calibration coefficient
-
-    if gain is not None and exposure_time is not None:
-        image /= (gain * exposure_time)
-    
-    image *= a1
-
-    if gain_adjustment is not None:
-        image *= gain_adjustment
+        np.maximum(image, 0, out=image)
 
     return image
 
-def vignette_map(photo):
+# Vignetting maps only depend on the camera calibration, not on the image
+vignette_cache = {}
+vignette_cache_lock = Lock()
+
+def vignette_map(photo, cache_dir=None):
+    """
+    Compute (or retrieve from cache) the vignetting correction map of a photo
+    :param photo ODM_Photo
+    :param cache_dir optional directory where to store the maps as .npy files, so that
+        they can be shared between processes and runs
+    :return float32 array of (height, width) or None if the photo has no vignetting information
+    """
     x_vc, y_vc = photo.get_vignetting_center()
     polynomial = photo.get_vignetting_polynomial()
 
-    if x_vc and polynomial:
+    if not (x_vc and polynomial):
+        return None
+    
+    key = (photo.width, photo.height, x_vc, y_vc, tuple(polynomial), photo.camera_make == "DJI")
+
+    with vignette_cache_lock:
+        vignette = vignette_cache.get(key)
+    if vignette is not None:
+        return vignette
+    
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, "vignette_%s.npy" % hashlib.sha1(str(key).encode('utf8')).hexdigest())
+        if os.path.isfile(cache_file):
+            try:
+                vignette = np.load(cache_file)
+            except Exception as e:
+                log.ODM_WARNING("Cannot read %s: %s" % (cache_file, str(e)))
+    
+    if vignette is None:
         # append 1., so that we can call with numpy polyval
-        polynomial.append(1.0)
-        vignette_poly = np.array(polynomial)
+        vignette_poly = np.array(polynomial + [1.0])
 
         # perform vignette correction
-        # get coordinate grid across image
-        x, y = np.meshgrid(np.arange(photo.width), np.arange(photo.height))
-
-        # meshgrid returns transposed arrays
-        # x = x.T
-        # y = y.T
-
         # compute matrix of distances from image center
-        r = np.hypot((x - x_vc), (y - y_vc))
+        x = np.arange(photo.width) - x_vc
+        y = np.arange(photo.height) - y_vc
+        r = np.hypot(x[np.newaxis, :], y[:, np.newaxis])
 
         # compute the vignette polynomial for each distance - we divide by the polynomial so that the
         # corrected image is image_corrected = image_original * vignetteCorrection
@@ -115,13 +145,25 @@ def vignette_map(photo):
         # DJI is special apparently
         if photo.camera_make != "DJI":
             vignette = 1.0 / vignette
+        
+        vignette = vignette.astype(np.float32)
 
-        return vignette, x, y
+        if cache_file is not None:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_file = cache_file + ".%s.tmp.npy" % os.getpid()
+                np.save(tmp_file, vignette)
+                os.replace(tmp_file, cache_file)
+            except Exception as e:
+                log.ODM_WARNING("Cannot write %s: %s" % (cache_file, str(e)))
+
+    with vignette_cache_lock:
+        vignette_cache[key] = vignette
     
-    return None, None, None
+    return vignette
 
-def dn_to_reflectance(photo, image, use_sun_sensor=True):
-    radiance = dn_to_radiance(photo, image)
+def dn_to_reflectance(photo, image, use_sun_sensor=True, cache_dir=None):
+    radiance = dn_to_radiance(photo, image, cache_dir)
     irradiance = compute_irradiance(photo, use_sun_sensor=use_sun_sensor)
     return radiance * math.pi / irradiance
 
@@ -279,10 +321,91 @@ def compute_band_maps(multi_camera, primary_band):
 
         return s2p, p2s
 
-def compute_alignment_matrices(multi_camera, primary_band_name, images_path, s2p, p2s, max_concurrency=1, max_samples=30):
+def stratified_order(n):
+    """
+    :return indexes from 0 to n - 1, ordered so that any prefix
+        is evenly spread over the whole range (van der Corput sequence)
+    """
+    order = []
+    seen = set()
+    bits = max(1, int(math.ceil(math.log2(max(1, n)))))
+    for k in range(2 ** bits):
+        # Reverse the bits of k
+        v = int(format(k, '0%sb' % bits)[::-1], 2) / float(2 ** bits)
+        i = int(v * n)
+        if i < n and not i in seen:
+            seen.add(i)
+            order.append(i)
+    return order
+
+def corner_points(warp_matrix, dimension):
+    """
+    :return flattened coordinates of the image corners, after applying the warp matrix
+    """
+    w, h = dimension
+    corners = np.array([[[0, 0], [w, 0], [w, h], [0, h]]], dtype=np.float64)
+    if warp_matrix.shape == (3, 3):
+        return cv2.perspectiveTransform(corners, warp_matrix)[0].ravel()
+    else:
+        return cv2.transform(corners, warp_matrix)[0].ravel()
+
+def warp_distance(m1, m2):
+    """
+    :return maximum distance (in pixels) between the image corners warped by two alignment matrices
+    """
+    return np.abs(corner_points(m1['warp_matrix'], m1['dimension']) - corner_points(m2['warp_matrix'], m2['dimension'])).max()
+
+def best_alignment_matrix(matrices):
+    """
+    Find the matrix that is closest to the (component-wise) median of all matrices,
+    comparing the position of the warped image corners. That should be the "best" alignment.
+    :return best matrix (with a score key, lower is better) or None
+    """
+    if len(matrices) == 0:
+        return None
+    
+    points = np.array([corner_points(m['warp_matrix'], m['dimension']) for m in matrices])
+    distances = np.abs(points - np.median(points, axis=0)).max(axis=1)
+    i = int(np.argmin(distances))
+    matrices[i]['score'] = float(distances[i])
+    return matrices[i]
+
+# Least recently used matrices are removed above this size
+ALIGNMENT_CACHE_MAX_SIZE_MB = 16
+
+def default_alignment_cache_dir(project_path):
+    return cache.get_cache_dir(project_path, "band_alignment")
+
+def alignment_cache_file(cache_dir, band, primary_band_name):
+    """
+    :return path to the file where the alignment matrix of a band is cached,
+        or None if the camera cannot be identified
+    """
+    if cache_dir is None or len(band['photos']) == 0:
+        return None
+    
+    p = band['photos'][0]
+    serial = getattr(p, 'camera_serial', None)
+    if not serial:
+        return None
+
+    key = json.dumps([p.camera_make, p.camera_model, serial, band['name'], primary_band_name, p.width, p.height])
+    return os.path.join(cache_dir, "%s.json" % hashlib.sha1(key.encode('utf8')).hexdigest())
+
+def compute_alignment_matrices(multi_camera, primary_band_name, images_path, s2p, p2s, max_concurrency=1, max_samples=30, 
+                                min_samples=5, tolerance=1.0, cache_dir=None):
+    """
+    Compute the matrices to align each secondary band to the primary band.
+    Homographies are computed for a sample of captures spread over the whole dataset, in rounds,
+    until the best matrix stops changing (by less than tolerance pixels) or max_samples are found.
+    :param cache_dir optional directory where to store the matrices of each band,
+        keyed by camera serial number. A cached matrix is reused if it agrees with
+        the matrices computed in the first round.
+    """
     log.ODM_INFO("Computing band alignment")
 
     alignment_info = {}
+    round_size = max(min_samples, max_concurrency)
 
     # For each secondary band
     for band in multi_camera:
@@ -291,10 +414,6 @@ def compute_alignment_matrices(multi_camera, primary_band_name, images_path, s2p
 
             def parallel_compute_homography(p):
                 try:
-                    if len(matrices) >= max_samples:
-                        # log.ODM_INFO("Got enough samples for %s (%s)" % (band['name'], max_samples))
-                        return
-
                     # Find good matrix candidates for alignment
                 
                     primary_band_photo = s2p.get(p['filename'])
@@ -308,36 +427,77 @@ def compute_alignment_matrices(multi_camera, primary_band_name, images_path, s2p
                     if warp_matrix is not None:
                         log.ODM_INFO("%s --> %s good match" % (p['filename'], primary_band_photo.filename))
 
-                        matrices.append({
+                        return {
                             'warp_matrix': warp_matrix,
-                            'eigvals': np.linalg.eigvals(warp_matrix),
                             'dimension': dimension,
                             'algo': algo
-                        })
+                        }
                     else:
                         log.ODM_INFO("%s --> %s cannot be matched" % (p['filename'], primary_band_photo.filename))
                 except Exception as e:
                     log.ODM_WARNING("Failed to compute homography for %s: %s" % (p['filename'], str(e)))
 
-            parallel_map(parallel_compute_homography, [{'filename': p.filename} for p in band['photos']], max_concurrency, single_thread_fallback=False)
-
-            # Find the matrix that has the most common eigvals
-            # among all matrices. That should be the "best" alignment.
-            for m1 in matrices:
-                acc = np.array([0.0,0.0,0.0])
-                e = m1['eigvals']
-
-                for m2 in matrices:
-                    acc += abs(e - m2['eigvals'])
+            cache_file = alignment_cache_file(cache_dir, band, primary_band_name)
+            cached = None
+            if cache_file is not None and os.path.isfile(cache_file):
+                try:
+                    with open(cache_file, 'r') as f:
+                        cached = json.loads(f.read())
+                    cache.touch(cache_file)
+                    cached['warp_matrix'] = np.array(cached['warp_matrix'], dtype=np.float64)
+                    cached['dimension'] = tuple(cached['dimension'])
+                except Exception as e:
+                    log.ODM_WARNING("Cannot read %s: %s" % (cache_file, str(e)))
+                    cached = None
+
+            # Process captures spread over the whole dataset first
+            photos = [band['photos'][i] for i in stratified_order(len(band['photos']))]
+            best = None
+            converged = False
+
+            for r in range(0, len(photos), round_size):
+                results = parallel_map(parallel_compute_homography, [{'filename': p.filename} for p in photos[r:r+round_size]], max_concurrency, single_thread_fallback=False)
+                matrices += [m for m in results if m is not None]
+
+                previous = best
+                best = best_alignment_matrix(matrices)
+                if best is None:
+                    continue
+
+                if cached is not None and r == 0:
+                    if len(matrices) >= min(3, min_samples) and warp_distance(cached, best) <= tolerance:
+                        log.ODM_INFO("Reusing cached alignment matrix for %s band" % band['name'])
+                        best = cached
+                        converged = True
+                        break
+                    else:
+                        log.ODM_INFO("Cached alignment matrix for %s band does not match this dataset, recomputing" % band['name'])
+                
+                if len(matrices) >= max_samples:
+                    break
 
-                m1['score'] = acc.sum()
+                if len(matrices) >= min_samples and previous is not None and warp_distance(previous, best) <= tolerance:
+                    log.ODM_INFO("Alignment matrix for %s band converged after %s samples" % (band['name'], len(matrices)))
+                    converged = True
+                    break
             
-            # Sort
-            matrices.sort(key=lambda x: x['score'], reverse=False)
-            
-            if len(matrices) > 0:
-                alignment_info[band['name']] = matrices[0]
-                log.ODM_INFO("%s band will be aligned using warp matrix %s (score: %s)" % (band['name'], matrices[0]['warp_matrix'], matrices[0]['score']))
+            if best is not None:
+                alignment_info[band['name']] = best
+                log.ODM_INFO("%s band will be aligned using warp matrix %s (score: %s)" % (band['name'], best['warp_matrix'], best.get('score')))
+
+                if cache_file is not None and best is not cached and converged:
+                    try:
+                        os.makedirs(cache_dir, exist_ok=True)
+                        with open(cache_file, 'w') as f:
+                            f.write(json.dumps({
+                                'warp_matrix': best['warp_matrix'].tolist(),
+                                'dimension': list(best['dimension']),
+                                'algo': best['algo'],
+                                'score': best.get('score')
+                            }))
+                        cache.prune(cache_dir, ALIGNMENT_CACHE_MAX_SIZE_MB)
+                    except Exception as e:
+                        log.ODM_WARNING("Cannot write %s: %s" % (cache_file, str(e)))
             else:
                 log.ODM_WARNING("Cannot find alignment matrix for band %s, The band might end up misaligned!" % band['name'])
 
@@ -562,11 +722,46 @@ def local_normalize(im):
     return im
 
 
+# Remap tables for perspective warps, one per band
+warp_maps_cache = {}
+warp_maps_cache_lock = Lock()
+WARP_MAPS_CACHE_SIZE = 16
+
+def warp_maps(warp_matrix, dimension):
+    """
+    :return (map1, map2) tables for cv2.remap, equivalent to
+        cv2.warpPerspective(image, warp_matrix, dimension)
+    """
+    key = (warp_matrix.tobytes(), tuple(dimension))
+
+    with warp_maps_cache_lock:
+        maps = warp_maps_cache.get(key)
+    if maps is not None:
+        return maps
+
+    w, h = dimension
+    m = np.linalg.inv(warp_matrix)
+    xs, ys = np.meshgrid(np.arange(w, dtype=np.float64), np.arange(h, dtype=np.float64))
+    d = m[2,0] * xs + m[2,1] * ys + m[2,2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = np.where(d != 0, 1.0 / d, 0)
+    map_x = ((m[0,0] * xs + m[0,1] * ys + m[0,2]) * d).astype(np.float32)
+    map_y = ((m[1,0] * xs + m[1,1] * ys + m[1,2]) * d).astype(np.float32)
+    maps = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+
+    with warp_maps_cache_lock:
+        if len(warp_maps_cache) >= WARP_MAPS_CACHE_SIZE:
+            warp_maps_cache.clear()
+        warp_maps_cache[key] = maps
+    
+    return maps
+
 def align_image(image, warp_matrix, dimension):
     image = resize_match(image, dimension)
 
     if warp_matrix.shape == (3, 3):
-        return cv2.warpPerspective(image, warp_matrix, dimension)
+        map1, map2 = warp_maps(warp_matrix, dimension)
+        return cv2.remap(image, map1, map2, cv2.INTER_LINEAR)
     else:
         return cv2.warpAffine(image, warp_matrix, dimension)
 
@@ -1,6 +1,18 @@
 import os
 from opendm import log
 
+def get_num_images(nvm_file):
+    """
+    :return number of images (cameras) in a NVM file
+    """
+    with open(nvm_file) as f:
+        lines = [f.readline().strip() for i in range(3)]
+
+    if lines[0] != "NVM_V3":
+        raise Exception("%s does not seem to be a valid NVM file" % nvm_file)
+
+    return int(lines[2])
+
 def replace_nvm_images(src_nvm_file, img_map, dst_nvm_file):
     """
     Create a new NVM file from an existing NVM file
@@ -0,0 +1,296 @@
+"""
+Vectorized reading and writing of Wavefront OBJ files.
+Files are memory mapped and tokenized in large chunks with numpy,
+instead of parsing them line by line.
+"""
+import os
+import numpy as np
+
+CHUNK_SIZE = 64 * 1024 * 1024
+FORMAT_ROWS = 100000
+MAX_RUNS = 1000
+
+# Line types
+OTHER = 0
+VERTEX = 1
+UV = 2
+NORMAL = 3
+FACE = 4
+
+SPACE = ord(' ')
+TAB = ord('\t')
+NEWLINE = ord('\n')
+
+def read_chunks(obj_path, chunk_size=CHUNK_SIZE):
+    """
+    Generator of uint8 arrays with the contents of a file,
+    split at line boundaries. Each chunk ends with a newline
+    """
+    if os.path.getsize(obj_path) == 0:
+        return
+
+    data = np.memmap(obj_path, dtype=np.uint8, mode='r')
+    size = len(data)
+    pos = 0
+
+    while pos < size:
+        end = min(size, pos + chunk_size)
+        if end < size:
+            nl = np.flatnonzero(data[pos:end] == NEWLINE)
+            if len(nl) > 0:
+                end = pos + nl[-1] + 1
+            else:
+                # Very long line
+                nl = np.flatnonzero(data[end:] == NEWLINE)
+                end = end + nl[0] + 1 if len(nl) > 0 else size
+
+        chunk = data[pos:end]
+        if chunk[-1] != NEWLINE:
+            chunk = np.append(chunk, np.uint8(NEWLINE))
+        yield chunk
+        pos = end
+
+    del data
+
+def line_types(buf):
+    """
+    :param buf uint8 array ending with a newline
+    :return (starts, ends, types) of each line (ends point to the newline characters)
+    """
+    ends = np.flatnonzero(buf == NEWLINE)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+
+    c0 = buf[starts]
+    c1 = buf[np.minimum(starts + 1, ends)]
+    c2 = buf[np.minimum(starts + 2, ends)]
+    sep1 = (c1 == SPACE) | (c1 == TAB)
+    sep2 = (c2 == SPACE) | (c2 == TAB)
+
+    types = np.zeros(len(starts), dtype=np.uint8)
+    is_v = c0 == ord('v')
+    types[is_v & sep1] = VERTEX
+    types[is_v & (c1 == ord('t')) & sep2] = UV
+    types[is_v & (c1 == ord('n')) & sep2] = NORMAL
+    types[(c0 == ord('f')) & sep1] = FACE
+
+    return starts, ends, types
+
+def line_mask(buf, starts, ends, selected):
+    """
+    :return boolean mask of the bytes of the selected lines (newlines included)
+    """
+    marks = np.zeros(len(buf) + 1, dtype=np.int8)
+    marks[starts[selected]] += 1
+    marks[ends[selected] + 1] -= 1
+    return np.cumsum(marks[:-1], dtype=np.int8).astype(bool)
+
+def parse_lines(buf, starts, ends, selected, prefix_len, dtype):
+    """
+    Parse the numbers in the selected lines (which must all have the same number of values)
+    :return array with one row per line
+    """
+    count = np.count_nonzero(selected)
+    if count == 0:
+        return None
+
+    # Lines of the same type are usually contiguous,
+    # copy them in runs when possible
+    idx = np.flatnonzero(selected)
+    breaks = np.flatnonzero(np.diff(idx) != 1) + 1
+    if len(breaks) < MAX_RUNS:
+        run_starts = np.concatenate(([0], breaks))
+        run_ends = np.concatenate((breaks, [len(idx)])) - 1
+        text = np.concatenate([buf[starts[idx[a]]:ends[idx[b]] + 1] for a, b in zip(run_starts, run_ends)])
+    else:
+        text = buf[line_mask(buf, starts, ends, selected)]
+
+    # Blank out the prefixes (v, vt, vn, f) and the slashes in faces
+    line_starts = np.flatnonzero(text == NEWLINE)[:-1] + 1
+    line_starts = np.concatenate(([0], line_starts))
+    for i in range(prefix_len):
+        text[line_starts + i] = SPACE
+    text[text == ord('/')] = SPACE
+
+    values = np.fromstring(text.tobytes(), dtype=dtype, sep=' ')
+    if len(values) % count != 0:
+        raise IOError("Inconsistent number of values in OBJ lines")
+
+    return values.reshape((count, -1))
+
+def read_obj(obj_path, elements=('v', 'vt', 'vn', 'f'), chunk_size=CHUNK_SIZE):
+    """
+    Read the geometry of an OBJ file. Only triangular faces are supported.
+    :param elements types of lines to read, the others are skipped
+    :return dictionary with:
+        vertices (n, 3) float64 array
+        uvs (n, 2) float64 array
+        normals (n, 3) float64 array
+        faces dictionary of material name --> (n, 3, k) int64 array of zero-based indexes,
+            where k is the number of elements in face_format (faces before any usemtl statement use the "_" material)
+        face_ids dictionary of material name --> indexes of the faces in the file
+        face_format tuple with the elements referenced by faces ('v', 'vt', 'vn')
+        mtllibs list of material libraries
+    """
+    if not os.path.isfile(obj_path):
+        raise IOError("Cannot open %s" % obj_path)
+
+    vertices = []
+    uvs = []
+    normals = []
+    faces = []
+    face_materials = []
+    material_names = []
+    material_ids = {}
+    mtllibs = []
+    face_format = None
+    current_material = -1
+
+    for buf in read_chunks(obj_path, chunk_size):
+        starts, ends, types = line_types(buf)
+
+        # Material statements (few)
+        usemtl = np.zeros(len(starts), dtype=np.int64)
+        for i in np.flatnonzero((types == OTHER) & ((buf[starts] == ord('u')) | (buf[starts] == ord('m')))):
+            line = buf[starts[i]:ends[i]].tobytes().decode('utf8').strip()
+            if line.startswith("usemtl "):
+                name = "".join(line.split()[1:]).strip()
+                if not name in material_ids:
+                    material_ids[name] = len(material_names)
+                    material_names.append(name)
+                usemtl[i] = material_ids[name] + 1
+            elif line.startswith("mtllib "):
+                mtllibs.append("".join(line.split()[1:]).strip())
+
+        for arr, t, prefix, cols in [(vertices, VERTEX, 1, 3), (uvs, UV, 2, 2), (normals, NORMAL, 2, 3)]:
+            if not ('v', 'vt', 'vn')[t - 1] in elements:
+                continue
+            values = parse_lines(buf, starts, ends, types == t, prefix, np.float64)
+            if values is not None:
+                arr.append(values[:,:cols])
+
+        is_face = types == FACE
+        if 'f' in elements and np.any(is_face):
+            if face_format is None:
+                first = np.flatnonzero(is_face)[0]
+                tokens = buf[starts[first]:ends[first]].tobytes().decode('utf8').split()[1:]
+                if len(tokens) != 3:
+                    raise IOError("Only triangular faces are supported")
+                parts = tokens[0].split("/")
+                face_format = ('v', 'vt', 'vn')[:len(parts)]
+                if len(parts) == 3 and parts[1] == '':
+                    face_format = ('v', 'vn')
+
+            f = parse_lines(buf, starts, ends, is_face, 1, np.int64)
+            if f.shape[1] != 3 * len(face_format):
+                raise IOError("Inconsistent face format in %s" % obj_path)
+            faces.append(f.reshape((-1, 3, len(face_format))) - 1)
+
+            # Material of each face (last usemtl statement before it)
+            idx = np.where(usemtl > 0, np.arange(len(usemtl)), -1)
+            np.maximum.accumulate(idx, out=idx)
+            mats = np.where(idx >= 0, usemtl[np.maximum(idx, 0)] - 1, current_material)
+            face_materials.append(mats[is_face])
+
+        last = np.flatnonzero(usemtl > 0)
+        if len(last) > 0:
+            current_material = usemtl[last[-1]] - 1
+
+    def stack(arrs, cols):
+        return np.concatenate(arrs) if len(arrs) > 0 else np.zeros((0, cols), dtype=np.float64)
+
+    obj = {
+        'vertices': stack(vertices, 3),
+        'uvs': stack(uvs, 2),
+        'normals': stack(normals, 3),
+        'faces': {},
+        'face_ids': {},
+        'face_format': face_format if face_format is not None else ('v', ),
+        'mtllibs': mtllibs,
+    }
+
+    if len(faces) > 0:
+        faces = np.concatenate(faces)
+        face_materials = np.concatenate(face_materials)
+
+        # Keep the order in which materials first appear
+        ids, first = np.unique(face_materials, return_index=True)
+        for m in ids[np.argsort(first)]:
+            name = material_names[m] if m >= 0 else "_"
+            ids = np.flatnonzero(face_materials == m)
+            obj['faces'][name] = faces[ids]
+            obj['face_ids'][name] = ids
+
+    return obj
+
+def format_rows(prefix, values):
+    """
+    :return OBJ lines (bytes) for the rows of values, using the shortest
+        representation that round-trips each number
+    """
+    values = np.asarray(values, dtype=np.float64)
+    line = prefix + " %r" * values.shape[1] + "\n"
+    out = []
+    for i in range(0, len(values), FORMAT_ROWS):
+        block = values[i:i+FORMAT_ROWS]
+        out.append(((line * len(block)) % tuple(block.ravel().tolist())).encode('utf8'))
+    return b"".join(out)
+
+def rewrite_obj(input_obj, output_obj, vertices=None, uvs=None, replace_line=None, chunk_size=CHUNK_SIZE):
+    """
+    Copy an OBJ file, replacing vertex and/or UV coordinates.
+    :param vertices (n, 3) array with one row for each vertex of input_obj, or None to keep them
+    :param uvs (n, 2) array with one row for each UV of input_obj, or None to keep them.
+        Rows with NaN values are copied unchanged
+    :param replace_line function called with each line (str) that is not a vertex, UV, normal
+        or face, returning the new line or None to keep it
+    """
+    replacements = {}
+    if vertices is not None:
+        replacements[VERTEX] = ("v", np.asarray(vertices))
+    if uvs is not None:
+        replacements[UV] = ("vt", np.asarray(uvs))
+    counters = {VERTEX: 0, UV: 0}
+
+    with open(output_obj, 'wb') as fout:
+        for buf in read_chunks(input_obj, chunk_size):
+            starts, ends, types = line_types(buf)
+
+            # Lines to replace
+            replace = np.zeros(len(starts), dtype=bool)
+            rows = np.zeros(len(starts), dtype=np.int64)
+            for t in [VERTEX, UV]:
+                is_t = types == t
+                n = np.count_nonzero(is_t)
+                if t in replacements:
+                    prefix, values = replacements[t]
+                    r = np.arange(counters[t], counters[t] + n)
+                    if counters[t] + n > len(values):
+                        raise IOError("Not enough %s values to rewrite %s" % (prefix, input_obj))
+                    rows[is_t] = r
+                    replace[is_t] = ~np.any(np.isnan(values[r]), axis=1) if values.dtype.kind == 'f' else True
+                counters[t] += n
+
+            new_lines = {}
+            if replace_line is not None:
+                for i in np.flatnonzero(types == OTHER):
+                    new_line = replace_line(buf[starts[i]:ends[i] + 1].tobytes().decode('utf8'))
+                    if new_line is not None:
+                        new_lines[i] = new_line
+                        replace[i] = True
+
+            # Runs of lines that are either copied or replaced
+            status = replace.astype(np.int8) * (types.astype(np.int8) + 1)
+            breaks = np.flatnonzero(np.diff(status)) + 1
+            run_starts = np.concatenate(([0], breaks))
+            run_ends = np.concatenate((breaks, [len(starts)]))
+
+            for a, b in zip(run_starts, run_ends):
+                if not replace[a]:
+                    fout.write(buf[starts[a]:ends[b - 1] + 1].tobytes())
+                elif types[a] in replacements:
+                    prefix, values = replacements[types[a]]
+                    fout.write(format_rows(prefix, values[rows[a]:rows[b - 1] + 1]))
+                else:
+                    fout.write("".join([new_lines[i] for i in range(a, b)]).encode('utf8'))
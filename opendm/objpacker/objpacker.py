@@ -2,6 +2,7 @@ import os
 import rasterio
 import warnings
 import numpy as np
+from opendm.objio import read_obj, rewrite_obj
 try:
     from .imagepacker.utils import AABB
     from .imagepacker import pack
@@ -22,45 +23,25 @@ def load_obj(obj_path, _info=print):
         'mtl_filenames': [],
         'materials': {},
     }
-    uvs = []
 
-    faces = {}
-    current_material = "_"
+    _info("Loading %s" % obj_path)
+    geometry = read_obj(obj_path, elements=('vt', 'f'))
 
-    with open(obj_path) as f:
-        _info("Loading %s" % obj_path)
+    for mtl_file in geometry['mtllibs']:
+        obj['materials'].update(load_mtl(mtl_file, obj_base_path, _info=_info))
+        obj['mtl_filenames'].append(mtl_file)
 
-        for line in f:
-            if line.startswith("mtllib "):
-                # Materials
-                mtl_file = "".join(line.split()[1:]).strip()
-                obj['materials'].update(load_mtl(mtl_file, obj_base_path, _info=_info))
-                obj['mtl_filenames'].append(mtl_file)
-            # elif line.startswith("v "):
-            #     # Vertices
-            #     vertices.append(list(map(float, line.split()[1:4])))
-            elif line.startswith("vt "):
-                # UVs
-                uvs.append(list(map(float, line.split()[1:3])))
-            # elif line.startswith("vn "):
-            #     normals.append(list(map(float, line.split()[1:4])))
-            elif line.startswith("usemtl "):
-                mtl_name = "".join(line.split()[1:]).strip()
-                if not mtl_name in obj['materials']:
-                    raise Exception("%s material is missing" % mtl_name)
-
-                current_material = mtl_name
-            elif line.startswith("f "):
-                if current_material not in faces:
-                    faces[current_material] = []
-
-                a,b,c = line.split()[1:]
-                at = int(a.split("/")[1])
-                bt = int(b.split("/")[1])
-                ct = int(c.split("/")[1])
-                faces[current_material].append((at - 1, bt - 1, ct - 1)) 
-
-    obj['uvs'] = np.array(uvs, dtype=np.float32)
+    if not 'vt' in geometry['face_format']:
+        raise Exception("%s has no texture coordinates" % obj_path)
+    uv_col = geometry['face_format'].index('vt')
+
+    faces = {}
+    for mtl_name, f in geometry['faces'].items():
+        if mtl_name != "_" and not mtl_name in obj['materials']:
+            raise Exception("%s material is missing" % mtl_name)
+        faces[mtl_name] = f[:,:,uv_col]
+
+    obj['uvs'] = geometry['uvs'].astype(np.float32)
     obj['faces'] = faces
 
     return obj
@@ -89,58 +70,50 @@ def load_mtl(mtl_file, obj_base_path, _info=print):
 
 
 def write_obj_changes(obj_file, mtl_file, uv_changes, single_mat, output_dir, _info=print):
-    with open(obj_file) as f:
-        obj_lines = f.readlines()
-    
-    out_lines = []
-    uv_lines = []
-    current_material = None
+    _info("Transforming UV coordinates")
 
-    printed_mtllib = False
-    printed_usemtl = False
+    geometry = read_obj(obj_file, elements=('vt', 'f'))
+    uvs = geometry['uvs']
+    uv_col = geometry['face_format'].index('vt')
 
-    _info("Transforming UV coordinates")
+    # Each UV is transformed according to the material
+    # of the last face that references it
+    materials = [m for m in geometry['faces'] if m in uv_changes]
+    new_uvs = np.full(uvs.shape, np.nan)
+
+    if materials:
+        uv_indexes = np.concatenate([geometry['faces'][m][:,:,uv_col].ravel() for m in materials])
+        face_ids = np.concatenate([np.repeat(geometry['face_ids'][m], 3) for m in materials])
+        mat_indexes = np.concatenate([np.full(geometry['faces'][m].shape[0] * 3, i) for i, m in enumerate(materials)])
 
-    for line_idx, line in enumerate(obj_lines):
+        # Last occurrence of each UV, in file order
+        order = np.argsort(face_ids, kind='stable')[::-1]
+        uv_indexes, first = np.unique(uv_indexes[order], return_index=True)
+        mat_indexes = mat_indexes[order][first]
+
+        aspect = np.array([uv_changes[m]["aspect"] for m in materials], dtype=np.float64)
+        offset = np.array([uv_changes[m]["offset"] for m in materials], dtype=np.float64)
+        new_uvs[uv_indexes] = uvs[uv_indexes] * aspect[mat_indexes] + offset[mat_indexes]
+
+    printed = {'mtllib': False, 'usemtl': False}
+    def replace_line(line):
         if line.startswith("mtllib"):
-            if not printed_mtllib:
-                out_lines.append("mtllib %s\n" % mtl_file)
-                printed_mtllib = True
+            if not printed['mtllib']:
+                printed['mtllib'] = True
+                return "mtllib %s\n" % mtl_file
             else:
-                out_lines.append("# \n")
+                return "# \n"
         elif line.startswith("usemtl"):
-            if not printed_usemtl:
-                out_lines.append("usemtl %s\n" % single_mat)
-                printed_usemtl = True
+            if not printed['usemtl']:
+                printed['usemtl'] = True
+                return "usemtl %s\n" % single_mat
             else:
-                out_lines.append("# \n")
-            current_material = line[7:].strip()
-        elif line.startswith("vt"):
-            uv_lines.append(line_idx)
-            out_lines.append(line)
-        elif line.startswith("f"):
-            for v in line[2:].split():
-                parts = v.split("/")
-                if len(parts) >= 2 and parts[1]:
-                    uv_idx = int(parts[1]) - 1 # uv indexes start from 1
-                    uv_line_idx = uv_lines[uv_idx]
-                    uv_line = obj_lines[uv_line_idx][3:]
-                    uv = [float(uv.strip()) for uv in uv_line.split()]
-
-                    if current_material and current_material in uv_changes:
-                        changes = uv_changes[current_material]
-                        uv[0] = uv[0] * changes["aspect"][0] + changes["offset"][0]
-                        uv[1] = uv[1] * changes["aspect"][1] + changes["offset"][1]
-                        out_lines[uv_line_idx] = "vt %s %s\n" % (uv[0], uv[1])
-            out_lines.append(line)
-        else:
-            out_lines.append(line)
+                return "# \n"
 
     out_file = os.path.join(output_dir, os.path.basename(obj_file))
     _info("Writing %s" % out_file)
 
-    with open(out_file, 'w') as f:
-        f.writelines(out_lines)
+    rewrite_obj(obj_file, out_file, uvs=new_uvs, replace_line=replace_line)
 
 def write_output_tex(img, profile, path, _info=print):
     _, w, h = img.shape
@@ -206,10 +179,10 @@ def obj_pack(obj_file, output_dir=None, _info=print):
         bounds = AABB()
 
         faces = obj['faces'][material]
-        for f in faces:
-            for uv_idx in f:
-                uv = obj['uvs'][uv_idx]
-                bounds.add(uv[0], uv[1])
+        if len(faces) > 0:
+            uvs = obj['uvs'][faces.ravel()]
+            bounds.add(*uvs.min(axis=0).tolist())
+            bounds.add(*uvs.max(axis=0).tolist())
 
         extents[material] = bounds
     
@@ -7,6 +7,7 @@ import math
 import numpy as np
 import rasterio
 import fiona
+from concurrent.futures import ThreadPoolExecutor
 from edt import edt
 from rasterio.transform import Affine, rowcol
 from rasterio.mask import mask
@@ -16,7 +17,7 @@ from opendm.cogeo import convert_to_cogeo
 from osgeo import gdal
 
 
-def get_orthophoto_vars(args):
+def get_orthophoto_vars(args, max_concurrency=None):
     return {
         'TILED': 'NO' if args.orthophoto_no_tiled else 'YES',
         'COMPRESS': args.orthophoto_compression,
@@ -24,7 +25,7 @@ def get_orthophoto_vars(args):
         'BIGTIFF': 'IF_SAFER',
         'BLOCKXSIZE': 512,
         'BLOCKYSIZE': 512,
-        'NUM_THREADS': args.max_concurrency
+        'NUM_THREADS': max_concurrency if max_concurrency is not None else args.max_concurrency
     }
 
 def build_overviews(orthophoto_file):
@@ -85,9 +86,12 @@ def generate_kmz(orthophoto_file, output_file=None, outsize=None):
     system.run('gdal_translate -of KMLSUPEROVERLAY -co FORMAT=PNG "%s" "%s" %s '
                '--config GDAL_CACHEMAX %s%% ' % (orthophoto_file, output_file, bandparam, get_max_memory()))    
     
-def post_orthophoto_steps(args, bounds_file_path, orthophoto_file, orthophoto_tiles_dir):
+def post_orthophoto_steps(args, bounds_file_path, orthophoto_file, orthophoto_tiles_dir, max_concurrency=None):
+    if max_concurrency is None:
+        max_concurrency = args.max_concurrency
+
     if args.crop > 0 or args.boundary:
-        Cropper.crop(bounds_file_path, orthophoto_file, get_orthophoto_vars(args), keep_original=not args.optimize_disk_space, warp_options=['-dstalpha'])
+        Cropper.crop(bounds_file_path, orthophoto_file, get_orthophoto_vars(args, max_concurrency), keep_original=not args.optimize_disk_space, warp_options=['-dstalpha'])
 
     if args.build_overviews and not args.cog:
         build_overviews(orthophoto_file)
@@ -99,10 +103,10 @@ def post_orthophoto_steps(args, bounds_file_path, orthophoto_file, orthophoto_ti
         generate_kmz(orthophoto_file)
 
     if args.tiles:
-        generate_orthophoto_tiles(orthophoto_file, orthophoto_tiles_dir, args.max_concurrency)
+        generate_orthophoto_tiles(orthophoto_file, orthophoto_tiles_dir, max_concurrency)
 
     if args.cog:
-        convert_to_cogeo(orthophoto_file, max_workers=args.max_concurrency, compression=args.orthophoto_compression)
+        convert_to_cogeo(orthophoto_file, max_workers=max_concurrency, compression=args.orthophoto_compression)
 
 def compute_mask_raster(input_raster, vector_mask, output_raster, blend_distance=20, only_max_coords_feature=False):
     if not os.path.exists(input_raster):
@@ -176,7 +180,7 @@ def feather_raster(input_raster, output_raster, blend_distance=20):
 
         return output_raster
 
-def merge(input_ortho_and_ortho_cuts, output_orthophoto, orthophoto_vars={}):
+def merge(input_ortho_and_ortho_cuts, output_orthophoto, orthophoto_vars={}, max_workers=1):
     """
     Based on https://github.com/mapbox/rio-merge-rgba/
     Merge orthophotos around cutlines using a blend buffer.
@@ -245,8 +249,31 @@ def merge(input_ortho_and_ortho_cuts, output_orthophoto, orthophoto_vars={}):
     profile["bigtiff"] = orthophoto_vars.get('BIGTIFF', 'IF_SAFER')
     profile.update()
 
+    # Index of the source bounds, so that each block
+    # only reads the sources that intersect it
+    src_bounds = np.array([src.bounds for src, _ in sources])
+    cut_bounds = np.array([cut.bounds for _, cut in sources])
+
+    def intersecting(bounds, left, bottom, right, top):
+        # left, bottom, right, top
+        return np.nonzero((bounds[:,0] < right) & (bounds[:,2] > left) & 
+                          (bounds[:,1] < top) & (bounds[:,3] > bottom))[0]
+
+    def read_window(raster, left, bottom, right, top, dst_shape):
+        src_window = tuple(zip(rowcol(
+                raster.transform, left, top, op=round, precision=precision
+            ), rowcol(
+                raster.transform, right, bottom, op=round, precision=precision
+            )))
+
+        temp = np.zeros(dst_shape, dtype=dtype)
+        return raster.read(
+            out=temp, window=src_window, boundless=True, masked=False
+        )
+
     # create destination file
-    with rasterio.open(output_orthophoto, "w", **profile) as dstrast:
+    with rasterio.open(output_orthophoto, "w", **profile) as dstrast, \
+         ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
         dstrast.colorinterp = colorinterp
         for idx, dst_window in dstrast.block_windows():
             left, bottom, right, top = dstrast.window_bounds(dst_window)
@@ -260,19 +287,14 @@ def merge(input_ortho_and_ortho_cuts, output_orthophoto, orthophoto_vars={}):
 
             dstarr = np.zeros(dst_shape, dtype=dtype)
 
-            # First pass, write all rasters naively without blending
-            for src, _ in sources:
-                src_window = tuple(zip(rowcol(
-                        src.transform, left, top, op=round, precision=precision
-                    ), rowcol(
-                        src.transform, right, bottom, op=round, precision=precision
-                    )))
-
-                temp = np.zeros(dst_shape, dtype=dtype)
-                temp = src.read(
-                    out=temp, window=src_window, boundless=True, masked=False
-                )
+            # Read the intersecting sources in parallel (in their original order)
+            src_idxs = intersecting(src_bounds, left, bottom, right, top)
+            cut_idxs = intersecting(cut_bounds, left, bottom, right, top)
+            src_arrs = list(executor.map(lambda i: read_window(sources[i][0], left, bottom, right, top, dst_shape), src_idxs))
+            cut_arrs = list(executor.map(lambda i: read_window(sources[i][1], left, bottom, right, top, dst_shape), cut_idxs))
 
+            # First pass, write all rasters naively without blending
+            for temp in src_arrs:
                 # pixels without data yet are available to write
                 write_region = np.logical_and(
                     (dstarr[-1] == 0), (temp[-1] != 0)  # 0 is nodata
@@ -285,22 +307,10 @@ def merge(input_ortho_and_ortho_cuts, output_orthophoto, orthophoto_vars={}):
 
             # Second pass, write all feathered rasters
             # blending the edges
-            for src, _ in sources:
-                src_window = tuple(zip(rowcol(
-                        src.transform, left, top, op=round, precision=precision
-                    ), rowcol(
-                        src.transform, right, bottom, op=round, precision=precision
-                    )))
-
-                temp = np.zeros(dst_shape, dtype=dtype)
-                temp = src.read(
-                    out=temp, window=src_window, boundless=True, masked=False
-                )
-
+            for temp in src_arrs:
                 where = temp[-1] != 0
-                for b in range(0, num_bands):
-                    blended = temp[-1] / 255.0 * temp[b] + (1 - temp[-1] / 255.0) * dstarr[b]
-                    np.copyto(dstarr[b], blended, casting='unsafe', where=where)
+                blended = temp[-1] / 255.0 * temp[:num_bands] + (1 - temp[-1] / 255.0) * dstarr[:num_bands]
+                np.copyto(dstarr[:num_bands], blended, casting='unsafe', where=where)
                 dstarr[-1][where] = 255.0
                 
                 # check if dest has any nodata pixels available
@@ -309,23 +319,11 @@ def merge(input_ortho_and_ortho_cuts, output_orthophoto, orthophoto_vars={}):
 
             # Third pass, write cut rasters
             # blending the cutlines
-            for _, cut in sources:
-                src_window = tuple(zip(rowcol(
-                        cut.transform, left, top, op=round, precision=precision
-                    ), rowcol(
-                        cut.transform, right, bottom, op=round, precision=precision
-                    )))
-
-                temp = np.zeros(dst_shape, dtype=dtype)
-                temp = cut.read(
-                    out=temp, window=src_window, boundless=True, masked=False
-                )
-
-                # For each band, average alpha values between
+            for temp in cut_arrs:
+                # Average alpha values between
                 # destination raster and cut raster
-                for b in range(0, num_bands):
-                    blended = temp[-1] / 255.0 * temp[b] + (1 - temp[-1] / 255.0) * dstarr[b]
-                    np.copyto(dstarr[b], blended, casting='unsafe', where=temp[-1]!=0)
+                blended = temp[-1] / 255.0 * temp[:num_bands] + (1 - temp[-1] / 255.0) * dstarr[:num_bands]
+                np.copyto(dstarr[:num_bands], blended, casting='unsafe', where=temp[-1]!=0)
 
             dstrast.write(dstarr, window=dst_window)
 
@@ -607,7 +607,7 @@ class OSFMContext:
     def name(self):
         return os.path.basename(os.path.abspath(self.path("..")))
 
-def get_submodel_argv(args, submodels_path = None, submodel_name = None):
+def get_submodel_argv(args, submodels_path = None, submodel_name = None, max_concurrency = None):
     """
     Gets argv for a submodel starting from the args passed to the application startup.
     Additionally, if project_name, submodels_path and submodel_name are passed, the function
@@ -625,6 +625,7 @@ def get_submodel_argv(args, submodels_path = None, submodel_name = None):
         removing --gcp (the GCP path if specified is always "gcp_list.txt")
         reading the contents of --cameras
         reading the contents of --boundary
+        setting --max-concurrency if max_concurrency is passed
     """
     assure_always = ['orthophoto_cutline', 'dem_euclidean_map', 'skip_3dmodel', 'skip_report']
     remove_always = ['split', 'split_overlap', 'rerun_from', 'rerun', 'gcp', 'end_with', 'sm_cluster', 'rerun_all', 'pc_csv', 'pc_las', 'pc_ept', 'tiles', 'copy-to', 'cog']
@@ -681,6 +682,12 @@ def get_submodel_argv(args, submodels_path = None, submodel_name = None):
             crop_value = 0.015625
         args_dict["crop"] = crop_value
 
+    # Handle max concurrency override
+    if max_concurrency is not None:
+        if not "max_concurrency" in set_keys:
+            set_keys.append("max_concurrency")
+        args_dict["max_concurrency"] = max_concurrency
+
     # Populate result
     for k in set_keys:
         result.append("--%s" % k.replace("_", "-"))
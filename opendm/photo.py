@@ -99,6 +99,7 @@ class ODM_Photo:
         self.height = None
         self.camera_make = ''
         self.camera_model = ''
+        self.camera_serial = None
         self.orientation = 1
 
         # Geo tags
@@ -217,6 +218,11 @@ class ODM_Photo:
                     except UnicodeDecodeError:
                         log.ODM_WARNING("EXIF Image Model might be corrupted")
                         self.camera_model = "unknown"
+                if 'EXIF BodySerialNumber' in tags:
+                    try:
+                        self.camera_serial = str(tags['EXIF BodySerialNumber'].values).strip()
+                    except UnicodeDecodeError:
+                        log.ODM_WARNING("EXIF BodySerialNumber might be corrupted")
                 if 'GPS GPSAltitude' in tags:
                     self.altitude = self.float_value(tags['GPS GPSAltitude'])
                     if 'GPS GPSAltitudeRef' in tags and self.int_value(tags['GPS GPSAltitudeRef']) is not None and self.int_value(tags['GPS GPSAltitudeRef']) > 0:
@@ -0,0 +1,156 @@
+import os
+import json
+import hashlib
+import multiprocessing
+
+from opendm import log
+from opendm import cache
+from opendm.photo import ODM_Photo, PhotoCorruptedException
+
+# Bump this whenever ODM_Photo.parse_exif_values changes
+# the fields it extracts, so that stale entries are ignored
+CACHE_VERSION = 2
+
+# Number of bytes at the beginning of a file used to compute
+# the content key (EXIF/XMP headers live here)
+HEADER_SIZE = 65536
+
+# Least recently used entries are removed above this size
+CACHE_MAX_SIZE_MB = 256
+
+def default_cache_dir(project_path):
+    return cache.get_cache_dir(project_path, "photos")
+
+class PhotoCache:
+    """
+    Persistent cache of parsed ODM_Photo fields, keyed by
+    file size, modification time and a hash of the file header.
+    Entries are stored as small JSON files and can be shared
+    between runs (and between projects, see cache.get_cache_dir).
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.write_failed = False
+
+    def key(self, path_file):
+        try:
+            st = os.stat(path_file)
+            h = hashlib.sha1()
+            with open(path_file, 'rb') as f:
+                h.update(f.read(HEADER_SIZE))
+            return "%s-%s-%s-%s" % (CACHE_VERSION, st.st_size, st.st_mtime_ns, h.hexdigest())
+        except OSError:
+            return None
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key[-2:], key + ".json")
+
+    def get(self, key, path_file):
+        if key is None:
+            return None
+
+        entry = self.entry_path(key)
+        if not os.path.isfile(entry):
+            return None
+
+        try:
+            with open(entry, 'r') as f:
+                fields = json.loads(f.read())
+        except Exception as e:
+            log.ODM_WARNING("Cannot read photo cache entry %s: %s" % (entry, str(e)))
+            return None
+
+        cache.touch(entry)
+
+        # Create an ODM_Photo instance without parsing the file again
+        p = ODM_Photo.__new__(ODM_Photo)
+        p.__dict__.update(fields)
+        p.filename = os.path.basename(path_file)
+        p.mask = None
+        return p
+
+    def put(self, key, photo):
+        if key is None or self.write_failed:
+            return
+
+        fields = dict(photo.__dict__)
+        fields.pop('filename', None)
+        fields.pop('mask', None)
+
+        entry = self.entry_path(key)
+        tmp_entry = "%s.%s.tmp" % (entry, os.getpid())
+        try:
+            data = json.dumps(fields)
+        except Exception as e:
+            log.ODM_WARNING("Cannot cache metadata of %s: %s" % (photo.filename, str(e)))
+            return
+
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            with open(tmp_entry, 'w') as f:
+                f.write(data)
+            os.replace(tmp_entry, entry)
+        except OSError as e:
+            # Read-only storage, full disk, etc. Caching is best effort.
+            log.ODM_WARNING("Cannot write to photo cache %s: %s" % (self.cache_dir, str(e)))
+            self.write_failed = True
+            if os.path.isfile(tmp_entry):
+                os.remove(tmp_entry)
+
+
+def parse_photo(path_file):
+    """
+    :return ODM_Photo instance or None if the photo is corrupted
+    """
+    try:
+        return ODM_Photo(path_file)
+    except PhotoCorruptedException:
+        return None
+
+def load_photos(path_files, cache_dir=None, max_workers=1):
+    """
+    Parse the metadata of many photos, using a persistent cache
+    and a pool of worker processes for the photos that are not cached.
+    :param path_files list of image paths
+    :param cache_dir directory where to store parsed metadata, None to disable caching
+    :param max_workers number of worker processes used for parsing
+    :return list of ODM_Photo instances (or None for corrupted photos)
+        in the same order as path_files
+    """
+    photo_cache = PhotoCache(cache_dir) if cache_dir is not None else None
+    photos = [None] * len(path_files)
+    keys = [None] * len(path_files)
+    todo = []
+
+    for i, f in enumerate(path_files):
+        if photo_cache is not None:
+            keys[i] = photo_cache.key(f)
+            photos[i] = photo_cache.get(keys[i], f)
+        if photos[i] is None:
+            todo.append(i)
+
+    if photo_cache is not None:
+        log.ODM_INFO("Photo metadata cache: %s hits, %s misses" % (len(path_files) - len(todo), len(todo)))
+
+    if len(todo) == 0:
+        return photos
+
+    todo_files = [path_files[i] for i in todo]
+    max_workers = min(max_workers, len(todo))
+
+    if max_workers > 1:
+        chunksize = max(1, min(64, len(todo) // (max_workers * 4)))
+        with multiprocessing.Pool(max_workers) as pool:
+            results = pool.map(parse_photo, todo_files, chunksize=chunksize)
+    else:
+        results = [parse_photo(f) for f in todo_files]
+
+    for i, p in zip(todo, results):
+        photos[i] = p
+        if p is not None and photo_cache is not None:
+            photo_cache.put(keys[i], p)
+
+    if photo_cache is not None and not photo_cache.write_failed:
+        cache.prune(cache_dir, CACHE_MAX_SIZE_MB)
+
+    return photos
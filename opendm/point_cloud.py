@@ -1,4 +1,6 @@
 import os, sys, shutil, tempfile, math, json
+import numpy as np
+import laspy
 from opendm import system
 from opendm import log
 from opendm import context
@@ -18,12 +20,23 @@ def ply_info(input_ply):
     has_normals = False
     has_views = False
     vertex_count = 0
-
-    with open(input_ply, 'r', errors='ignore') as f:
-        line = f.readline().strip().lower()
+    face_count = 0
+    ply_format = None
+    elements = []
+    vertex_properties = []
+    header_bytes = 0
+
+    with open(input_ply, 'rb') as f:
+        line = f.readline()
+        header_bytes += len(line)
+        line = line.decode('utf8', errors='ignore').strip().lower()
         i = 0
         while line != "end_header":
-            line = f.readline().strip().lower()
+            line = f.readline()
+            if not line:
+                raise IOError("Cannot find end_header field. Invalid PLY?")
+            header_bytes += len(line)
+            line = line.decode('utf8', errors='ignore').strip().lower()
             props = line.split(" ")
             if len(props) == 3:
                 if props[0] == "property" and props[2] in ["nx", "normalx", "normal_x"]:
@@ -32,6 +45,14 @@ def ply_info(input_ply):
                     has_views = True
                 elif props[0] == "element" and props[1] == "vertex":
                     vertex_count = int(props[2])
+                elif props[0] == "element" and props[1] == "face":
+                    face_count = int(props[2])
+                elif props[0] == "format":
+                    ply_format = props[1]
+            if len(props) >= 3 and props[0] == "element":
+                elements.append(props[1])
+            elif props[0] == "property" and len(elements) > 0 and elements[-1] == "vertex":
+                vertex_properties.append(" ".join(props[1:]))
             i += 1
             if i > 100:
                 raise IOError("Cannot find end_header field. Invalid PLY?")
@@ -40,8 +61,13 @@ def ply_info(input_ply):
     return {
         'has_normals': has_normals,
         'vertex_count': vertex_count,
+        'face_count': face_count,
         'has_views': has_views,
-        'header_lines': i + 1
+        'header_lines': i + 1,
+        'header_bytes': header_bytes,
+        'format': ply_format,
+        'elements': elements,
+        'vertex_properties': vertex_properties
     }
 
 
@@ -108,13 +134,256 @@ def filter(input_point_cloud, output_point_cloud, standard_deviation=2.5, meank=
         log.ODM_WARNING("{} not found, filtering has failed.".format(output_point_cloud))
 
 def export_info_json(pointcloud_path, info_file_path):
-    system.run('pdal info --dimensions "X,Y,Z" "{0}" > "{1}"'.format(pointcloud_path, info_file_path))
+    try:
+        meta = get_metadata(pointcloud_path, stats=True)
+        with open(info_file_path, 'w') as f:
+            f.write(json.dumps({
+                'filename': pointcloud_path,
+                'stats': {
+                    'bbox': {
+                        'native': {
+                            'bbox': meta['bounds']
+                        }
+                    },
+                    'statistic': meta['statistic']
+                }
+            }))
+    except Exception as e:
+        log.ODM_WARNING("Cannot read statistics of %s (%s), falling back to PDAL" % (pointcloud_path, str(e)))
+        system.run('pdal info --dimensions "X,Y,Z" "{0}" > "{1}"'.format(pointcloud_path, info_file_path))
 
 
 def export_summary_json(pointcloud_path, summary_file_path):
     system.run('pdal info --summary "{0}" > "{1}"'.format(pointcloud_path, summary_file_path))
 
+PLY_TYPES = {
+    'char': 'i1', 'int8': 'i1',
+    'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2',
+    'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4',
+    'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4',
+    'double': 'f8', 'float64': 'f8'
+}
+
+def read_ply_xyz(input_ply, chunk_size=1000000):
+    """
+    Generator of (x, y, z) arrays, read from the vertices of a PLY file in chunks
+    """
+    info = ply_info(input_ply)
+    if info['elements'][:1] != ['vertex']:
+        raise IOError("%s has no vertex element" % input_ply)
+
+    names = []
+    types = []
+    for prop in info['vertex_properties']:
+        parts = prop.split(" ")
+        if len(parts) != 2 or not parts[0] in PLY_TYPES:
+            raise IOError("Unsupported vertex property: %s" % prop)
+        types.append(PLY_TYPES[parts[0]])
+        names.append(parts[1])
+    
+    for dim in ['x', 'y', 'z']:
+        if not dim in names:
+            raise IOError("%s has no %s property" % (input_ply, dim))
+
+    count = info['vertex_count']
+    if info['format'] in ['binary_little_endian', 'binary_big_endian']:
+        endian = '<' if info['format'] == 'binary_little_endian' else '>'
+        dtype = np.dtype([(n, endian + t) for n, t in zip(names, types)])
+        vertices = np.memmap(input_ply, dtype=dtype, mode='r', offset=info['header_bytes'], shape=(count,))
+        for i in range(0, count, chunk_size):
+            chunk = vertices[i:i+chunk_size]
+            yield chunk['x'].astype(np.float64), chunk['y'].astype(np.float64), chunk['z'].astype(np.float64)
+        del vertices
+    elif info['format'] == 'ascii':
+        cols = [names.index(dim) for dim in ['x', 'y', 'z']]
+        with open(input_ply, 'rb') as f:
+            f.seek(info['header_bytes'])
+            remaining = count
+            while remaining > 0:
+                lines = [f.readline() for _ in range(min(chunk_size, remaining))]
+                remaining -= len(lines)
+                chunk = np.loadtxt(lines, usecols=cols, ndmin=2, dtype=np.float64)
+                yield chunk[:,0], chunk[:,1], chunk[:,2]
+    else:
+        raise IOError("Unsupported PLY format: %s" % info['format'])
+
+def read_xyz(input_point_cloud, chunk_size=1000000):
+    """
+    Generator of (x, y, z) arrays, read from a LAS/LAZ/PLY file in chunks
+    """
+    if input_point_cloud.lower().endswith(".ply"):
+        for xyz in read_ply_xyz(input_point_cloud, chunk_size):
+            yield xyz
+    else:
+        with laspy.open(input_point_cloud) as f:
+            for points in f.chunk_iterator(chunk_size):
+                yield np.asarray(points.x), np.asarray(points.y), np.asarray(points.z)
+
+def get_metadata(input_point_cloud, stats=False):
+    """
+    Read the number of points, bounds and SRS of a point cloud.
+    LAS/LAZ files only need their header to be read, PLY files are scanned once.
+    Results are cached in a file next to the point cloud and reused until the point cloud changes.
+    :param stats also compute the statistics (count, min, max, average, variance) of the X, Y and Z dimensions,
+        which require a full scan for all formats
+    :return dict with count, bounds (minx, maxx, miny, maxy, minz, maxz), srs (proj4 string or None) and, if requested, statistic keys
+    """
+    if not os.path.exists(input_point_cloud):
+        raise IOError("%s does not exist" % input_point_cloud)
+
+    d, f = os.path.split(input_point_cloud)
+    cache_file = os.path.join(d, ".%s.meta.json" % f)
+    st = os.stat(input_point_cloud)
+    key = "%s-%s" % (st.st_size, st.st_mtime_ns)
+
+    meta = None
+    if os.path.isfile(cache_file):
+        try:
+            with open(cache_file, 'r') as fin:
+                meta = json.loads(fin.read())
+            if meta.get('key') != key:
+                meta = None
+        except Exception as e:
+            log.ODM_WARNING("Cannot read %s: %s" % (cache_file, str(e)))
+            meta = None
+    
+    if meta is not None and (not stats or 'statistic' in meta):
+        return meta
+
+    is_ply = input_point_cloud.lower().endswith(".ply")
+
+    if meta is None:
+        meta = {'key': key, 'srs': None}
+
+        if not is_ply and not stats:
+            # Header only
+            with laspy.open(input_point_cloud) as fin:
+                header = fin.header
+                meta['count'] = int(header.point_count)
+                meta['bounds'] = {
+                    'minx': float(header.mins[0]), 'maxx': float(header.maxs[0]),
+                    'miny': float(header.mins[1]), 'maxy': float(header.maxs[1]),
+                    'minz': float(header.mins[2]), 'maxz': float(header.maxs[2])
+                }
+        if not is_ply:
+            try:
+                with laspy.open(input_point_cloud) as fin:
+                    crs = fin.header.parse_crs()
+                    if crs is not None:
+                        meta['srs'] = crs.to_proj4()
+            except Exception as e:
+                log.ODM_WARNING("Cannot read SRS of %s: %s" % (input_point_cloud, str(e)))
+
+    if is_ply or stats:
+        log.ODM_INFO("Computing statistics for %s" % input_point_cloud)
+        count = 0
+        mins = np.full(3, np.inf)
+        maxs = np.full(3, -np.inf)
+        means = np.zeros(3)
+        m2 = np.zeros(3)
+
+        for x, y, z in read_xyz(input_point_cloud):
+            n = len(x)
+            if n == 0:
+                continue
+            xyz = np.vstack((x, y, z))
+            mins = np.minimum(mins, xyz.min(axis=1))
+            maxs = np.maximum(maxs, xyz.max(axis=1))
+
+            # Combine chunk mean/variance (Chan et al.)
+            chunk_means = xyz.mean(axis=1)
+            chunk_m2 = ((xyz - chunk_means[:,None]) ** 2).sum(axis=1)
+            delta = chunk_means - means
+            total = count + n
+            means = means + delta * n / total
+            m2 = m2 + chunk_m2 + delta ** 2 * count * n / total
+            count = total
+
+        if count == 0:
+            raise IOError("%s has no points" % input_point_cloud)
+        
+        meta['count'] = count
+        meta['bounds'] = {
+            'minx': float(mins[0]), 'maxx': float(maxs[0]),
+            'miny': float(mins[1]), 'maxy': float(maxs[1]),
+            'minz': float(mins[2]), 'maxz': float(maxs[2])
+        }
+
+        variance = m2 / max(1, count - 1)
+        meta['statistic'] = [{
+                'name': dim,
+                'position': i,
+                'count': count,
+                'minimum': float(mins[i]),
+                'maximum': float(maxs[i]),
+                'average': float(means[i]),
+                'variance': float(variance[i]),
+                'stddev': float(math.sqrt(variance[i]))
+            } for i, dim in enumerate(['X', 'Y', 'Z'])]
+
+    try:
+        with open(cache_file, 'w') as fout:
+            fout.write(json.dumps(meta))
+    except Exception as e:
+        log.ODM_WARNING("Cannot write %s: %s" % (cache_file, str(e)))
+
+    return meta
+
+def get_convex_hull(input_point_cloud, decimation=1, hexbin_edge_size=0, chunk_size=1000000):
+    """
+    Compute the 2D convex hull of a point cloud with a single chunked read.
+    Only the vertices of the hull are kept between chunks, so memory is bounded by chunk_size.
+    :param decimation only use one point every N points (same as PDAL's filters.decimation)
+    :param hexbin_edge_size if > 0, grow the hull by a hexagon of this edge size, which matches
+        the convex hull of the boundary computed by PDAL's filters.hexbin (within edge_size)
+    :return (N, 2) array with the vertices of the hull, in counter-clockwise order
+    """
+    from scipy.spatial import ConvexHull
+
+    hull = np.empty((0, 2))
+    index = 0
+    decimation = max(1, int(decimation))
+
+    for x, y, z in read_xyz(input_point_cloud, chunk_size):
+        n = len(x)
+        offset = (-index) % decimation
+        index += n
+        if offset >= n:
+            continue
+
+        points = np.column_stack((x[offset::decimation], y[offset::decimation]))
+        points = np.vstack((hull, points))
+        if len(points) >= 3:
+            try:
+                hull = points[ConvexHull(points).vertices]
+            except Exception:
+                # Degenerate (collinear/duplicate) points, keep accumulating
+                hull = np.unique(points, axis=0)
+        else:
+            hull = points
+
+    if len(hull) < 3:
+        raise IOError("Cannot compute convex hull of %s, not enough points" % input_point_cloud)
+
+    if hexbin_edge_size > 0:
+        angles = np.arange(6) * np.pi / 3.0
+        corners = np.column_stack((np.cos(angles), np.sin(angles))) * hexbin_edge_size
+        points = (hull[:,None,:] + corners[None,:,:]).reshape((-1, 2))
+        hull = points[ConvexHull(points).vertices]
+    
+    return hull
+
 def get_extent(input_point_cloud):
+    try:
+        return get_metadata(input_point_cloud)['bounds']
+    except Exception as e:
+        log.ODM_WARNING("Cannot read bounds of %s (%s), falling back to PDAL" % (input_point_cloud, str(e)))
+        return get_extent_pdal(input_point_cloud)
+
+def get_extent_pdal(input_point_cloud):
     fd, json_file = tempfile.mkstemp(suffix='.json')
     os.close(fd)
     
@@ -182,9 +451,46 @@ def merge(input_point_cloud_files, output_file, rerun=False):
     system.run('lasmerge -i {all_inputs} -o "{output}"'.format(**kwargs))
    
 
+def copy_file_range(src, dst, offset, count, chunk_size=64 * 1024 * 1024):
+    """
+    Append count bytes from src (starting at offset) to dst, using kernel copies
+    when available so that data does not go through user space
+    :param src source file descriptor
+    :param dst destination file descriptor (data is written at its current position)
+    """
+    for copy in ['copy_file_range', 'sendfile']:
+        if count == 0 or not hasattr(os, copy):
+            continue
+        try:
+            while count > 0:
+                if copy == 'copy_file_range':
+                    n = os.copy_file_range(src, dst, min(count, chunk_size), offset)
+                else:
+                    n = os.sendfile(dst, src, offset, min(count, chunk_size))
+                if n == 0:
+                    break
+                offset += n
+                count -= n
+        except OSError:
+            # Not supported (e.g. across filesystems on older kernels)
+            pass
+
+    # Fallback, fixed size chunks
+    while count > 0:
+        if hasattr(os, 'pread'):
+            buf = os.pread(src, min(count, chunk_size), offset)
+        else:
+            os.lseek(src, offset, os.SEEK_SET)
+            buf = os.read(src, min(count, chunk_size))
+        if not buf:
+            raise IOError("Unexpected end of file")
+        os.write(dst, buf)
+        offset += len(buf)
+        count -= len(buf)
+
 def fast_merge_ply(input_point_cloud_files, output_file):
-    # Assumes that all input files share the same header/content format
-    # As the merge is a naive byte stream copy
+    # Assumes that all input files have only vertices
+    # with the same properties, as the merge is a naive byte stream copy
 
     num_files = len(input_point_cloud_files)
     if num_files == 0:
@@ -195,42 +501,36 @@ def fast_merge_ply(input_point_cloud_files, output_file):
         log.ODM_WARNING("Removing previous point cloud: %s" % output_file)
         os.remove(output_file)
     
-    vertex_count = sum([ply_info(pcf)['vertex_count'] for pcf in input_point_cloud_files])
+    infos = [ply_info(pcf) for pcf in input_point_cloud_files]
+    master_info = infos[0]
+    for pcf, info in zip(input_point_cloud_files, infos):
+        if info['elements'] != ['vertex']:
+            raise IOError("Cannot merge %s, only point clouds with vertices can be merged (found %s)" % (pcf, ", ".join(info['elements'])))
+        if info['format'] != master_info['format'] or info['vertex_properties'] != master_info['vertex_properties']:
+            raise IOError("Cannot merge %s, its vertex layout (%s %s) does not match %s (%s %s)" % 
+                (pcf, info['format'], ", ".join(info['vertex_properties']),
+                 input_point_cloud_files[0], master_info['format'], ", ".join(master_info['vertex_properties'])))
+
+    vertex_count = sum([info['vertex_count'] for info in infos])
     master_file = input_point_cloud_files[0]
     with open(output_file, "wb") as out:
-        with open(master_file, "r", errors="ignore") as fhead:
+        with open(master_file, "rb") as fhead:
             # Copy header
-            line = fhead.readline()
-            out.write(line.encode('utf8'))
-
-            i = 0
-            while line.strip().lower() != "end_header":
-                line = fhead.readline()
-                
+            header = fhead.read(master_info['header_bytes'])
+            
+            for line in header.splitlines(True):
                 # Intercept element vertex field
-                if line.lower().startswith("element vertex "):
+                if line.lower().startswith(b"element vertex "):
                     out.write(("element vertex %s\n" % vertex_count).encode('utf8'))
                 else:
-                    out.write(line.encode('utf8'))
+                    out.write(line)
+        out.flush()
 
-                i += 1
-                if i > 100:
-                    raise IOError("Cannot find end_header field. Invalid PLY?")
-            
-        for ipc in input_point_cloud_files:
-            i = 0
+        # Copy bodies
+        for ipc, info in zip(input_point_cloud_files, infos):
             with open(ipc, "rb") as fin:
-                # Skip header
-                line = fin.readline()
-                while line.strip().lower() != b"end_header":
-                    line = fin.readline()
-
-                    i += 1
-                    if i > 100:
-                        raise IOError("Cannot find end_header field. Invalid PLY?")
-                
-                # Write fields
-                out.write(fin.read())
+                body_bytes = os.fstat(fin.fileno()).st_size - info['header_bytes']
+                copy_file_range(fin.fileno(), out.fileno(), info['header_bytes'], body_bytes)
     
     return output_file
 
@@ -10,32 +10,46 @@ from opendm import log
 from opendm import system
 from opendm import config
 from pyodm import Node, exceptions
-from pyodm.utils import AtomicCounter
 from pyodm.types import TaskStatus
 from opendm.osfm import OSFMContext, get_submodel_args_dict, get_submodel_argv
 from opendm.utils import double_quote
 
-try:
-    import queue
-except ImportError:
-    import Queue as queue
+from collections import deque
+
+# Files that are not worth compressing in seed payloads
+COMPRESSED_EXTENSIONS = ['.npz', '.gz', '.zip', '.jpg', '.jpeg', '.png', '.tif', '.tiff', '.laz']
+
+DEFAULT_PARALLEL_UPLOADS = 10
+
+# A remote task that has been running for longer than this factor
+# times the median task time is considered a straggler and can be
+# taken over by an idle local slot
+STRAGGLER_FACTOR = 1.5
 
 class LocalRemoteExecutor:
     """
     A class for performing OpenSfM reconstructions and full ODM pipeline executions
-    using a mix of local and remote processing. Tasks are executed locally one at a time
-    and remotely until a node runs out of available slots for processing. This allows us
+    using a mix of local and remote processing. Tasks are executed locally using up to
+    local_slots tasks at a time and remotely (using up to remote_slots concurrent uploads)
+    until a node runs out of available slots for processing. This allows us
     to use the processing power of the current machine as well as offloading tasks to a 
-    network node.
+    network node. When there's nothing left in the queue, idle local slots take over
+    remote tasks that are taking much longer than the others (stragglers).
     """
-    def __init__(self, nodeUrl, rolling_shutter = False, rerun = False):
+    def __init__(self, nodeUrl, rolling_shutter = False, rerun = False, parallel_uploads = DEFAULT_PARALLEL_UPLOADS, 
+                 local_slots = 1, remote_slots = 1, local_max_concurrency = None):
         self.node = Node.from_url(nodeUrl)
         self.params = {
             'tasks': [],
             'threads': [],
             'rolling_shutter': rolling_shutter,
-            'rerun': rerun
+            'rerun': rerun,
+            'parallel_uploads': max(1, parallel_uploads),
+            'local_max_concurrency': local_max_concurrency
         }
+        self.local_slots = max(1, local_slots)
+        self.remote_slots = max(1, remote_slots)
+        self.metrics = []
         self.node_online = True
 
         log.ODM_INFO("LRE: Initializing using cluster node %s:%s" % (self.node.host, self.node.port))
@@ -61,21 +75,27 @@ class LocalRemoteExecutor:
         if not self.project_paths:
             return
 
-        # Shared variables across threads
+        # Shared state, guarded by cv
         class nonloc:
             error = None
-            local_processing = False
+            stop = False
+            local_busy = 0
             max_remote_tasks = None
+            remote_running_tasks = 0
+            finished_tasks = 0
         
-        calculate_task_limit_lock = threading.Lock()
-        finished_tasks = AtomicCounter(0)
-        remote_running_tasks = AtomicCounter(0)
+        cv = threading.Condition()
+        pending = deque()
+        remote_tasks = [] # Uploaded tasks that are being processed by the node
+        run_times = []
+
+        def enqueue(task):
+            task.queued_at = time.time()
+            pending.append(task)
 
-        # Create queue
-        q = queue.Queue()
         for pp in self.project_paths:
             log.ODM_INFO("LRE: Adding to queue %s" % pp)
-            q.put(taskClass(pp, self.node, self.params))
+            enqueue(taskClass(pp, self.node, self.params))
 
         def remove_task_safe(task):
             try:
@@ -93,11 +113,25 @@ class LocalRemoteExecutor:
             for task in self.params['tasks']:
                 log.ODM_INFO("LRE: Removing remote task %s... %s" % (task.uuid, 'OK' if remove_task_safe(task) else 'NO'))
 
+        def add_metric(task, slot, local, error):
+            m = {
+                'task': str(task),
+                'slot': slot,
+                'local': local,
+                'wait': task.started_at - task.queued_at,
+                'run': time.time() - task.started_at,
+                'error': error is not None
+            }
+            self.metrics.append(m)
+            if error is None:
+                run_times.append(m['run'])
+
         def handle_result(task, local, error = None, partial=False):
             def cleanup_remote():
                 if not partial and task.remote_task:
                     log.ODM_INFO("LRE: Cleaning up remote task (%s)... %s" % (task.remote_task.uuid, 'OK' if remove_task_safe(task.remote_task) else 'NO'))
-                    self.params['tasks'].remove(task.remote_task)
+                    if task.remote_task in self.params['tasks']:
+                        self.params['tasks'].remove(task.remote_task)
                     task.remote_task = None
 
             if error:
@@ -113,129 +147,215 @@ class LocalRemoteExecutor:
                 if task_limit_reached:
                     # Estimate the maximum number of tasks based on how many tasks
                     # are currently running
-                    with calculate_task_limit_lock:
-                        if nonloc.max_remote_tasks is None:
-                            node_task_limit = 0
-                            for t in self.params['tasks']:
-                                try:
-                                    info = t.info(with_output=-3)
-                                    if info.status == TaskStatus.RUNNING and info.processing_time >= 0 and len(info.output) >= 3:
-                                        node_task_limit += 1
-                                except exceptions.OdmError:
-                                    pass
-
-                            nonloc.max_remote_tasks = max(1, node_task_limit)
-                            log.ODM_INFO("LRE: Node task limit reached. Setting max remote tasks to %s" % node_task_limit)
-                                
-
-                # Retry, but only if the error is not related to a task failure
-                if task.retries < task.max_retries and not isinstance(error, exceptions.TaskFailedError):
-                    # Put task back in queue
-                    # Don't increment the retry counter if this task simply reached the task
-                    # limit count.
-                    if not task_limit_reached:
-                        task.retries += 1
-                    task.wait_until = datetime.datetime.now() + datetime.timedelta(seconds=task.retries * task.retry_timeout)
-                    cleanup_remote()
-                    q.task_done()
-
-                    log.ODM_INFO("LRE: Re-queueing %s (retries: %s)" % (task, task.retries))
-                    q.put(task)
-                    if not local: remote_running_tasks.increment(-1)
-                    return
-                else:
-                    nonloc.error = error
-                    finished_tasks.increment()
-                    if not local: remote_running_tasks.increment(-1)
+                    with cv:
+                        estimate_limit = nonloc.max_remote_tasks is None
+                    if estimate_limit:
+                        node_task_limit = 0
+                        for t in list(self.params['tasks']):
+                            try:
+                                info = t.info(with_output=-3)
+                                if info.status == TaskStatus.RUNNING and info.processing_time >= 0 and len(info.output) >= 3:
+                                    node_task_limit += 1
+                            except exceptions.OdmError:
+                                pass
+
+                        with cv:
+                            if nonloc.max_remote_tasks is None:
+                                nonloc.max_remote_tasks = max(1, node_task_limit)
+                                log.ODM_INFO("LRE: Node task limit reached. Setting max remote tasks to %s" % node_task_limit)
+
+                cleanup_remote()
+
+                with cv:
+                    if not local: 
+                        nonloc.remote_running_tasks -= 1
+                        if task in remote_tasks: remote_tasks.remove(task)
+
+                    # Retry, but only if the error is not related to a task failure
+                    if task.retries < task.max_retries and not isinstance(error, exceptions.TaskFailedError):
+                        # Put task back in queue
+                        # Don't increment the retry counter if this task simply reached the task
+                        # limit count.
+                        if not task_limit_reached:
+                            task.retries += 1
+                        task.wait_until = datetime.datetime.now() + datetime.timedelta(seconds=task.retries * task.retry_timeout)
+
+                        log.ODM_INFO("LRE: Re-queueing %s (retries: %s)" % (task, task.retries))
+                        enqueue(task)
+                    else:
+                        nonloc.error = error
+                        nonloc.finished_tasks += 1
+                    cv.notify_all()
             else:
-                if not partial:
+                if partial:
+                    # Upload is done, the node is processing the task
+                    with cv:
+                        remote_tasks.append(task)
+                        cv.notify_all()
+                else:
                     log.ODM_INFO("LRE: %s finished successfully" % task)
-                    finished_tasks.increment()
-                    if not local: remote_running_tasks.increment(-1)
-
-            cleanup_remote()
-            if not partial: q.task_done()
+                    cleanup_remote()
+                    with cv:
+                        if not local: 
+                            nonloc.remote_running_tasks -= 1
+                            if task in remote_tasks: remote_tasks.remove(task)
+                        nonloc.finished_tasks += 1
+                        cv.notify_all()
+        
+        def find_straggler():
+            """
+            :return (task, seconds until a remote task becomes a straggler)
+            """
+            if not remote_tasks or not run_times:
+                return None, None
             
-        def local_worker():
+            candidates = [t for t in remote_tasks if not t.downloading]
+            if not candidates:
+                return None, None
+
+            median = sorted(run_times)[len(run_times) // 2]
+            task = min(candidates, key=lambda t: t.started_at)
+            remaining = task.started_at + median * STRAGGLER_FACTOR - time.time()
+            if remaining <= 0:
+                return task, 0
+            else:
+                return None, remaining
+
+        def local_done(slot):
+            """
+            :return a completion callback for a new local attempt
+            """
+            state = {'done': False}
+            def done(t, local, error = None, partial = False):
+                with cv:
+                    if state['done']:
+                        return
+                    state['done'] = True
+                    add_metric(t, slot, local, error)
+                    nonloc.local_busy -= 1
+                handle_result(t, local, error, partial)
+            return done
+
+        def remote_done(slot, attempt):
+            """
+            :return a completion callback for a new remote attempt
+            """
+            state = {'done': False}
+            def done(t, local, error = None, partial = False):
+                with cv:
+                    # Results of a remote attempt that has been taken over locally are ignored,
+                    # as well as the end of the upload if processing has already finished
+                    if t.attempt != attempt or state['done']:
+                        return
+                    if error is not None or not partial:
+                        state['done'] = True
+                        add_metric(t, slot, local, error)
+                handle_result(t, local, error, partial)
+            return done
+
+        def local_worker(slot):
             while True:
-                # Block until a new queue item is available
-                task = q.get()
-
-                if task is None or nonloc.error is not None:
-                    q.task_done()
-                    break
+                stolen = False
+                with cv:
+                    while True:
+                        if nonloc.stop or nonloc.error is not None:
+                            return
+                        if pending:
+                            task = pending.popleft()
+                            break
+                        
+                        # Nothing left in the queue, take over a straggler
+                        task, timeout = find_straggler()
+                        if task is not None and not task.steal():
+                            # Wait for the next event
+                            task = timeout = None
+
+                        if task is not None:
+                            log.ODM_INFO("LRE: %s is taking too long on the node, processing it locally" % task)
+                            remote_tasks.remove(task)
+                            nonloc.remote_running_tasks -= 1
+                            task.queued_at = time.time()
+
+                            # Ignore any further result from the remote attempt
+                            task.attempt += 1
+                            stolen = True
+                            break
+
+                        cv.wait(timeout)
+
+                    nonloc.local_busy += 1
+                    cv.notify_all()
+                
+                if stolen:
+                    task.cancel_remote()
 
                 # Process local
+                task.started_at = time.time()
+                done = local_done(slot)
+
                 try:
-                    nonloc.local_processing = True
-                    task.process(True, handle_result)
+                    task.process(True, done)
                 except Exception as e:
-                    handle_result(task, True, e)
-                finally:
-                    nonloc.local_processing = False
+                    done(task, True, e)
 
-
-        def remote_worker():
+        def remote_worker(slot):
             while True:
-                # Block until a new queue item is available
-                task = q.get()
-
-                if task is None or nonloc.error is not None:
-                    q.task_done()
-                    break
-                
-                # Yield to local processing
-                if not nonloc.local_processing:
-                    log.ODM_INFO("LRE: Yielding to local processing, sending %s back to the queue" % task)
-                    q.put(task)
-                    q.task_done()
-                    time.sleep(0.05)
-                    continue
-
-                # If we've found an estimate of the limit on the maximum number of tasks
-                # a node can process, we block until some tasks have completed
-                if nonloc.max_remote_tasks is not None and remote_running_tasks.value >= nonloc.max_remote_tasks:
-                    q.put(task)
-                    q.task_done()
-                    time.sleep(2)
-                    continue
+                with cv:
+                    # Yield to local processing: remote slots only pick up tasks when
+                    # all local slots are busy. If we've found an estimate of the limit on
+                    # the maximum number of tasks a node can process, we also wait until
+                    # some tasks have completed
+                    while not (nonloc.stop or nonloc.error is not None) and \
+                          not (pending and nonloc.local_busy >= self.local_slots and \
+                               (nonloc.max_remote_tasks is None or nonloc.remote_running_tasks < nonloc.max_remote_tasks)):
+                        cv.wait()
+
+                    if nonloc.stop or nonloc.error is not None:
+                        return
+
+                    task = pending.popleft()
+                    nonloc.remote_running_tasks += 1
+                    task.attempt += 1
+                    attempt = task.attempt
 
                 # Process remote
+                task.started_at = time.time()
+                task.stolen = task.downloading = False
+                done = remote_done(slot, attempt)
+
                 try:
-                    remote_running_tasks.increment()
-                    task.process(False, handle_result)
+                    task.process(False, done)
                 except Exception as e:
-                    handle_result(task, False, e)
+                    done(task, False, e)
         
-        # Create queue thread
-        local_thread = threading.Thread(target=local_worker)
+        # Create worker threads
+        workers = [threading.Thread(target=local_worker, args=("local-%s" % i, )) for i in range(self.local_slots)]
         if self.node_online:
-            remote_thread = threading.Thread(target=remote_worker)
+            workers += [threading.Thread(target=remote_worker, args=("remote-%s" % i, )) for i in range(self.remote_slots)]
 
         system.add_cleanup_callback(cleanup_remote_tasks)
 
         # Start workers
-        local_thread.start()
-        if self.node_online:
-            remote_thread.start()
+        for w in workers:
+            w.start()
 
         # block until all tasks are done (or CTRL+C)
         try:
-            while finished_tasks.value < len(self.project_paths) and nonloc.error is None:
-                time.sleep(0.5)
+            with cv:
+                while nonloc.finished_tasks < len(self.project_paths) and nonloc.error is None:
+                    cv.wait()
         except KeyboardInterrupt:
             log.ODM_WARNING("LRE: CTRL+C")
             system.exit_gracefully()
         
         # stop workers
-        q.put(None)
-        if self.node_online:
-            q.put(None)
+        with cv:
+            nonloc.stop = True
+            cv.notify_all()
 
-        # Wait for queue thread
-        local_thread.join()
-        if self.node_online:
-            remote_thread.join()
+        # Wait for worker threads
+        for w in workers:
+            w.join()
 
         # Wait for all remains threads
         for thrds in self.params['threads']:
@@ -244,12 +364,24 @@ class LocalRemoteExecutor:
         system.remove_cleanup_callback(cleanup_remote_tasks)
         cleanup_remote_tasks()
 
+        self.log_metrics()
+
         if nonloc.error is not None:
             # Try not to leak access token
             if isinstance(nonloc.error, exceptions.NodeConnectionError):
                 raise exceptions.NodeConnectionError("A connection error happened. Check the connection to the processing node and try again.")
             else:
                 raise nonloc.error
+
+    def log_metrics(self):
+        slots = {}
+        for m in self.metrics:
+            slots.setdefault(m['slot'], []).append(m)
+
+        for slot in sorted(slots):
+            ms = slots[slot]
+            log.ODM_INFO("LRE: %s processed %s tasks (avg queue wait: %.1fs, avg execution: %.1fs, max execution: %.1fs)" % 
+                        (slot, len(ms), sum(m['wait'] for m in ms) / len(ms), sum(m['run'] for m in ms) / len(ms), max(m['run'] for m in ms)))
         
 
 class NodeTaskLimitReachedException(Exception):
@@ -266,6 +398,14 @@ class Task:
         self.retry_timeout = retry_timeout
         self.remote_task = None
 
+        # Scheduling state
+        self.queued_at = None
+        self.started_at = None
+        self.attempt = 0
+        self.stolen = False
+        self.downloading = False
+        self.lock = threading.Lock()
+
     def process(self, local, done):
         def handle_result(error = None, partial=False):
             done(self, local, error, partial)
@@ -286,6 +426,29 @@ class Task:
             # perhaps this wouldn't be a big speedup.
             self._process_remote(handle_result) # Block until upload is complete
 
+    def steal(self):
+        """
+        Mark a task that is being processed remotely as taken over by local processing
+        :return True if the task can be taken over (its results are not being downloaded)
+        """
+        with self.lock:
+            if self.downloading or self.remote_task is None:
+                return False
+            self.stolen = True
+            return True
+    
+    def cancel_remote(self):
+        remote_task = self.remote_task
+        self.remote_task = None
+        if remote_task is not None:
+            try:
+                removed = remote_task.remove()
+            except exceptions.OdmError:
+                removed = False
+            log.ODM_INFO("LRE: Removing remote task %s... %s" % (remote_task.uuid, 'OK' if removed else 'NO'))
+            if remote_task in self.params['tasks']:
+                self.params['tasks'].remove(remote_task)
+
     def path(self, *paths):
         return os.path.join(self.project_path, *paths)
 
@@ -297,16 +460,24 @@ class Task:
         paths = filter(os.path.exists, map(lambda p: self.path(p), paths))
         outfile = self.path("seed.zip")
 
-        with zipfile.ZipFile(outfile, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+        def add_file(zf, filename):
+            # Don't spend time recompressing data that is already compressed
+            # and use fast compression for everything else (mostly JSON/CSV)
+            if os.path.splitext(filename)[1].lower() in COMPRESSED_EXTENSIONS:
+                zf.write(filename, os.path.relpath(filename, self.project_path), compress_type=zipfile.ZIP_STORED)
+            else:
+                zf.write(filename, os.path.relpath(filename, self.project_path))
+
+        with zipfile.ZipFile(outfile, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1, allowZip64=True) as zf:
             for p in paths:
                 if os.path.isdir(p):
                     for root, _, filenames in os.walk(p):
                         for filename in filenames:
                             filename = os.path.join(root, filename)
                             filename = os.path.normpath(filename)
-                            zf.write(filename, os.path.relpath(filename, self.project_path))
+                            add_file(zf, filename)
                 else:
-                    zf.write(p, os.path.relpath(p, self.project_path))
+                    add_file(zf, p)
 
             for tf in touch_files:
                 zf.writestr(tf, "")
@@ -349,6 +520,10 @@ class Task:
         # Add seed file
         images.append(seed_file)
 
+        # Upload the largest files first, so that a large file (e.g. the seed)
+        # doesn't end up being uploaded alone after all the others are done
+        images.sort(key=lambda f: os.path.getsize(f), reverse=True)
+
         class nonloc:
             last_update = 0
 
@@ -362,7 +537,8 @@ class Task:
                 get_submodel_args_dict(config.config()),
                 progress_callback=print_progress,
                 skip_post_processing=True,
-                outputs=outputs)
+                outputs=outputs,
+                parallel_uploads=self.params.get('parallel_uploads', DEFAULT_PARALLEL_UPLOADS))
         self.remote_task = task
 
         # Cleanup seed file
@@ -398,6 +574,13 @@ class Task:
                             nonloc.last_update = time.time()
 
                     task.wait_for_completion(status_callback=status_callback)
+
+                    with self.lock:
+                        if self.stolen:
+                            # Being processed locally
+                            return
+                        self.downloading = True
+
                     log.ODM_INFO("LRE: Downloading assets for %s" % self)
                     task.download_assets(self.project_path, progress_callback=print_progress)
                     log.ODM_INFO("LRE: Downloaded and extracted assets for %s" % self)
@@ -446,6 +629,11 @@ class ReconstructionTask(Task):
         log.ODM_INFO("==================================")
         log.ODM_INFO("Local Reconstruction %s" % octx.name())
         log.ODM_INFO("==================================")
+
+        # Share the CPUs with the other local slots
+        if self.params.get('local_max_concurrency') is not None:
+            octx.update_config({'processes': self.params['local_max_concurrency']})
+
         octx.feature_matching(self.params['rerun'])
         octx.create_tracks(self.params['rerun'])
         octx.reconstruct(self.params['rolling_shutter'], self.params['rerun'])
@@ -476,7 +664,7 @@ class ToolchainTask(Task):
             log.ODM_INFO("=============================")
 
             submodels_path = os.path.abspath(self.path(".."))
-            argv = get_submodel_argv(config.config(), submodels_path, submodel_name)
+            argv = get_submodel_argv(config.config(), submodels_path, submodel_name, max_concurrency=self.params.get('local_max_concurrency'))
 
             # Re-run the ODM toolchain on the submodel
             system.run(" ".join(map(double_quote, map(str, argv))), env_vars=os.environ.copy())
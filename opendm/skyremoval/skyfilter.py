@@ -6,19 +6,18 @@ import os
 import onnxruntime as ort
 from .guidedfilter import guided_filter
 from opendm import log
-from threading import Lock
-
-mutex = Lock()
+from opendm.ai import session_options, get_batch_size, batch_inference
 
 # Use GPU if it is available, otherwise CPU
 provider = "CUDAExecutionProvider" if "CUDAExecutionProvider" in ort.get_available_providers() else "CPUExecutionProvider"
 
 class SkyFilter():
 
-    def __init__(self, model, width = 384, height = 384):
+    def __init__(self, model, width = 384, height = 384, threads = None):
 
         self.model = model
         self.width, self.height = width, height
+        self.threads = threads
 
         log.ODM_INFO(' ?> Using provider %s' % provider)
         self.load_model()
@@ -26,28 +25,30 @@ class SkyFilter():
     
     def load_model(self):
         log.ODM_INFO(' -> Loading the model')
-        self.session = ort.InferenceSession(self.model, providers=[provider])     
-
 
-    def get_mask(self, img):
+        # Sessions are thread-safe and shared by all threads
+        self.session = ort.InferenceSession(self.model, sess_options=session_options(self.threads), providers=[provider])
 
-        height, width, c = img.shape
 
+    def preprocess(self, img):
         # Resize image to fit the model input
         new_img = cv2.resize(img, (self.width, self.height), interpolation=cv2.INTER_AREA)
         new_img = np.array(new_img, dtype=np.float32)
 
         # Input vector for onnx model
-        input_v = np.expand_dims(new_img.transpose((2, 0, 1)), axis=0)
-        ort_inputs = {self.session.get_inputs()[0].name: input_v}
+        return new_img.transpose((2, 0, 1))
+
+
+    def infer(self, inputs):
+        ort_inputs = {self.session.get_inputs()[0].name: np.stack(inputs)}
+        return list(self.session.run(None, ort_inputs)[0])
+
 
-        # Run the model
-        with mutex:
-            ort_outs = self.session.run(None, ort_inputs)
+    def postprocess(self, output, img):
+        height, width, c = img.shape
 
         # Get the output
-        output = np.array(ort_outs)
-        output = output[0][0].transpose((1, 2, 0))
+        output = output.transpose((1, 2, 0))
         output = cv2.resize(output, (width, height), interpolation=cv2.INTER_LANCZOS4)
         output = np.array([output, output, output]).transpose((1, 2, 0))
         output = np.clip(output, a_max=1.0, a_min=0.0)
@@ -55,6 +56,10 @@ class SkyFilter():
         return self.refine(output, img)
 
 
+    def get_mask(self, img):
+        return self.postprocess(self.infer([self.preprocess(img)])[0], img)
+
+
     def refine(self, pred, img):
         guided_filter_radius, guided_filter_eps = 20, 0.01
         refined = guided_filter(img[:,:,2], pred[:,:,0], guided_filter_radius, guided_filter_eps)
@@ -70,17 +75,16 @@ class SkyFilter():
         return res
         
 
-    def run_img(self, img_path, dest):
-
+    def load_img(self, img_path):
         img = cv2.imread(img_path, cv2.IMREAD_COLOR)
         if img is None:
             return None
 
         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        img = np.array(img / 255., dtype=np.float32)
+        return np.array(img / 255., dtype=np.float32)
 
-        mask  = self.get_mask(img)
-        
+
+    def write_mask(self, mask, img_path, dest):
         img_name = os.path.basename(img_path)
         fpath = os.path.join(dest, img_name)
 
@@ -89,3 +93,35 @@ class SkyFilter():
         cv2.imwrite(mask_name, mask)
         
         return mask_name
+
+
+    def run_img(self, img_path, dest):
+
+        img = self.load_img(img_path)
+        if img is None:
+            return None
+
+        mask  = self.get_mask(img)
+        
+        return self.write_mask(mask, img_path, dest)
+
+
+    def run_imgs(self, img_paths, dest, max_workers=1, batch_size=4):
+        """
+        Generate masks for multiple images, running the model on batches of images
+        and loading/post-processing the images concurrently
+        :return list of mask paths (None for the images that could not be processed)
+        """
+        def preprocess(img_path):
+            img = self.load_img(img_path)
+            if img is None:
+                return None
+            return self.preprocess(img), (img, img_path)
+        
+        def postprocess(output, ctx):
+            img, img_path = ctx
+            return self.write_mask(self.postprocess(output, img), img_path, dest)
+
+        return batch_inference(img_paths, preprocess, self.infer, postprocess, 
+                               batch_size=get_batch_size(self.session, batch_size), 
+                               max_workers=max_workers)
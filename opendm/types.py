@@ -1,6 +1,8 @@
 import os
 import shutil
 import warnings
+import functools
+import threading
 import numpy as np
 from opendm import get_image_size
 from opendm import location
@@ -13,8 +15,10 @@ from opendm import log
 from opendm import io
 from opendm import system
 from opendm import context
+from opendm.dag import TaskGraph
 
 from opendm.progress import progressbc
+from opendm.concurrency import get_max_memory, get_max_memory_mb
 from opendm.photo import ODM_Photo
 
 # Ignore warnings about proj information being lost
@@ -28,6 +32,17 @@ class ODM_Reconstruction(object):
         self.multi_camera = self.detect_multi_camera()
         self.filter_photos()
 
+    @property
+    def photos(self):
+        return self._photos
+
+    @photos.setter
+    def photos(self, photos):
+        self._photos = photos
+
+        # filename --> photo index, used by get_photo
+        self._photos_index = {p.filename: p for p in photos}
+
     def detect_multi_camera(self):
         """
         Looks at the reconstruction photos and determines if this
@@ -208,9 +223,7 @@ class ODM_Reconstruction(object):
             return (None, None)
 
     def get_photo(self, filename):
-        for p in self.photos:
-            if p.filename == filename:
-                return p
+        return self._photos_index.get(filename)
     
 
 class ODM_GeoRef(object):
@@ -343,6 +356,10 @@ class ODM_Tree(object):
         return os.path.join(self.root_path, *args)
 
 
+# Stages currently running --> their progress
+running_stages = {}
+progress_lock = threading.Lock()
+
 class ODM_Stage:
     def __init__(self, name, args, progress=0.0, **params):
         self.name = name
@@ -353,12 +370,50 @@ class ODM_Stage:
             self.params = {}
         self.next_stage = None
         self.prev_stage = None
+        self.dependencies = None
 
     def connect(self, stage):
         self.next_stage = stage
         stage.prev_stage = self
         return stage
 
+    def depends_on(self, *stages):
+        """
+        Declare the stages whose outputs are needed by this stage.
+        By default a stage depends on the previous stage in the chain.
+        Stages that do not depend on each other can run concurrently.
+        """
+        self.dependencies = list(stages)
+        return self
+
+    def get_dependencies(self):
+        if self.dependencies is not None:
+            return self.dependencies
+        elif self.prev_stage is not None:
+            return [self.prev_stage]
+        else:
+            return []
+
+    def max_concurrency(self):
+        """
+        Number of CPUs this stage can use (by default all of them,
+        which means that the stage never runs concurrently with others).
+        Stages should pass this value to their tools instead of args.max_concurrency
+        """
+        return max(1, min(self.args.max_concurrency, self.params.get('max_concurrency', self.args.max_concurrency)))
+
+    def max_memory_share(self):
+        """
+        Fraction of the memory budget this stage can use (by default all of it)
+        """
+        return self.params.get('memory_share', 1.0)
+
+    def max_memory(self):
+        """
+        :return percentage of memory this stage can use (for GDAL_CACHEMAX and the like)
+        """
+        return get_max_memory() * self.max_memory_share()
+
     def rerun(self):
         """
         Does this stage need to be rerun?
@@ -367,12 +422,56 @@ class ODM_Stage:
                      (self.args.rerun_all) or \
                      (self.args.rerun_from is not None and self.name in self.args.rerun_from)
     
+    def is_final(self):
+        """
+        Is this the last stage that should run?
+        """
+        return self.args.end_with == self.name or self.args.rerun == self.name
+
     def run(self, outputs = {}):
+        """
+        Run this stage and all following stages, as a graph.
+        A stage starts as soon as all of its dependencies have completed.
+        """
+        stages = self.following_stages()
+        names = [s.name for s in stages]
+
+        def run_stage_if_reachable(stage):
+            # A stage can shorten the chain while running (by changing next_stage),
+            # in which case the stages that were cut off are skipped
+            if stage in self.following_stages():
+                stage.run_stage(outputs)
+
+        max_memory = get_max_memory_mb()
+        graph = TaskGraph(self.args.max_concurrency, max_memory)
+        for s in stages:
+            graph.add(s.name, functools.partial(run_stage_if_reachable, s), 
+                      depends_on=[d.name for d in s.get_dependencies() if d.name in names],
+                      cpus=s.max_concurrency(),
+                      memory=max_memory * s.max_memory_share())
+        graph.run()
+
+        if stages[-1].is_final():
+            log.ODM_INFO("No more stages to run")
+    
+    def following_stages(self):
+        """
+        :return list of stages that should run, starting from this one
+        """
+        stages = [self]
+        while not stages[-1].is_final() and stages[-1].next_stage is not None:
+            stages.append(stages[-1].next_stage)
+        return stages
+
+    def run_stage(self, outputs):
         start_time = system.now_raw()
         log.logger.log_json_stage_run(self.name, start_time)
 
         log.ODM_INFO('Running %s stage' % self.name)
         
+        with progress_lock:
+            running_stages[self] = 0.0
+
         self.process(self.args, outputs)
 
         # The tree variable should always be populated at this point
@@ -386,15 +485,10 @@ class ODM_Stage:
 
         log.ODM_INFO('Finished %s stage' % self.name)
         self.update_progress_end()
+        log.logger.log_json_stage_end(self.name)
 
-        # Last stage?
-        if self.args.end_with == self.name or self.args.rerun == self.name:
-            log.ODM_INFO("No more stages to run")
-            return
-
-        # Run next stage?
-        elif self.next_stage is not None:
-            self.next_stage.run(outputs)
+        with progress_lock:
+            running_stages.pop(self, None)
 
     def delta_progress(self):
         if self.prev_stage:
@@ -413,8 +507,13 @@ class ODM_Stage:
 
     def update_progress(self, progress):
         progress = max(0.0, min(100.0, progress))
-        progressbc.send_update(self.previous_stages_progress() + 
-                              (self.delta_progress() / 100.0) * float(progress))
+
+        # Stages that run concurrently report their combined progress,
+        # starting from the progress before the earliest of them
+        with progress_lock:
+            running_stages[self] = float(progress)
+            progressbc.send_update(min([s.previous_stages_progress() for s in running_stages]) + 
+                                   sum([(s.delta_progress() / 100.0) * p for s, p in running_stages.items()]))
 
     def last_stage(self):
         if self.next_stage:
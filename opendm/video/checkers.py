@@ -61,20 +61,61 @@ class NaiveBlackFrameChecker:
     def NeedPreProcess(self):
         return False
 
+    def Reset(self):
+        return
+
+    def Update(self, luminance_min, luminance_max):
+        return
+
+    def IsReady(self):
+        return True
+
     def IsBlack(self, image_bw, id):
         return np.average(image_bw) < self.threshold
 
 
 class BlackFrameChecker:
-    def __init__(self, picture_black_ratio_th=0.98, pixel_black_th=0.30):
+    def __init__(self, picture_black_ratio_th=0.98, pixel_black_th=0.30, warmup_frames=10):
         self.picture_black_ratio_th = picture_black_ratio_th if picture_black_ratio_th is not None else 0.98
         self.pixel_black_th = pixel_black_th if pixel_black_th is not None else 0.30
+        self.warmup_frames = warmup_frames
+        self.frames_seen = 0
+        self.preprocessed = False
         self.luminance_minimum_value = None
         self.luminance_range_size = None
         self.absolute_threshold = None
 
     def NeedPreProcess(self):
-        return True
+        # Luminance statistics are collected while frames are
+        # decoded (see Update), no need for a separate pass
+        return False
+
+    def Reset(self):
+        self.frames_seen = 0
+        self.preprocessed = False
+
+    def Update(self, luminance_min, luminance_max):
+        """
+        Update the luminance statistics with the minimum and maximum
+        luminance of a frame, unless they were computed by PreProcess
+        """
+        if self.preprocessed:
+            return
+
+        if self.frames_seen == 0:
+            self.luminance_range_size = 0
+            self.luminance_minimum_value = 255
+
+        self.luminance_range_size = max(self.luminance_range_size, int(luminance_max - luminance_min))
+        self.luminance_minimum_value = min(self.luminance_minimum_value, int(luminance_min))
+        self.absolute_threshold = self.luminance_minimum_value + self.pixel_black_th * self.luminance_range_size
+        self.frames_seen += 1
+
+    def IsReady(self):
+        """
+        :return True if enough frames have been seen to reliably estimate the threshold
+        """
+        return self.preprocessed or self.frames_seen >= self.warmup_frames
 
     def PreProcess(self, video_path, start_frame, end_frame):
         # Open video file
@@ -113,6 +154,8 @@ class BlackFrameChecker:
         # Calculate absolute threshold for considering a pixel "black"
         self.absolute_threshold = self.luminance_minimum_value + self.pixel_black_th * self.luminance_range_size
 
+        self.preprocessed = True
+
         # Close video file
         cap.release()
 
@@ -20,6 +20,7 @@ class Parameters:
         # "limit" -> Maximum number of output frames
         # "frame-format" -> frame format (jpg, png, tiff, etc.)")
         # "stats-file" -> Save statistics to csv file")
+        # "max-concurrency" -> Number of threads used to analyze and encode frames
 
         if not os.path.exists(args["output"]):
             os.makedirs(args["output"])
@@ -39,6 +40,7 @@ class Parameters:
         self.use_srt = "use_srt" in args
         self.frame_format = args.get("frame_format", "jpg")
         self.max_dimension = args.get("max_dimension", None)
+        self.max_concurrency = args.get("max_concurrency", 1)
 
         self.stats_file = args.get("stats_file", None)
 
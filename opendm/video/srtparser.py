@@ -1,4 +1,6 @@
 from datetime import datetime
+from bisect import bisect_left, bisect_right
+from threading import Lock
 from opendm import location, log
 import re
 
@@ -26,32 +28,39 @@ class SrtFileParser:
     def __init__(self, filename):
         self.filename = filename
         self.data = []
+        self.starts = []
         self.gps_data = []
+        self.gps_times = []
         self.ll_to_utm = None
         self.utm_to_ll = None
+        self.lock = Lock()
 
     def get_entry(self, timestamp: datetime):
         if not self.data:
             self.parse()
+        if not self.data:
+            return None
 
         # check min and max
         if timestamp < self.data[0]["start"] or timestamp > self.data[len(self.data) - 1]["end"]:
             return None
 
-        for entry in self.data:
-            if entry["start"] <= timestamp and entry["end"] >= timestamp:
-                return entry
+        # Last entry starting at or before timestamp, then walk back
+        # to the first entry that contains it (entries can share a boundary)
+        i = bisect_right(self.starts, timestamp) - 1
+        match = None
+        while i >= 0 and self.data[i]["end"] >= timestamp:
+            match = self.data[i]
+            i -= 1
 
-        return None
+        return match
 
-    def get_gps(self, timestamp):
-        if not self.data:
-            self.parse()
-        
-        # Initialize on first call
-        prev_coords = None
+    def build_gps_data(self):
+        with self.lock:
+            if self.gps_data:
+                return
 
-        if not self.gps_data:
+            gps_data = []
             for d in self.data:
                 lat, lon, alt = d.get('latitude'), d.get('longitude'), d.get('altitude')
                 tm = d.get('start')
@@ -63,48 +72,59 @@ class SrtFileParser:
                     coords = self.ll_to_utm.TransformPoint(lon, lat, alt)
 
                     # First or new (in X/Y only)
-                    add = (not len(self.gps_data)) or (coords[0], coords[1]) != (self.gps_data[-1][1][0], self.gps_data[-1][1][1])
+                    add = (not len(gps_data)) or (coords[0], coords[1]) != (gps_data[-1][1][0], gps_data[-1][1][1])
                     if add:
-                        self.gps_data.append((tm, coords))
+                        gps_data.append((tm, coords))
+
+            self.gps_times = [tm for tm, _ in gps_data]
+            self.gps_data = gps_data
+
+    def get_gps(self, timestamp):
+        if not self.data:
+            self.parse()
+        
+        # Initialize on first call
+        if not self.gps_data:
+            self.build_gps_data()
         
         # No data available
         if not len(self.gps_data) or self.gps_data[0][0] > timestamp:
             return None
 
         # Interpolate
-        start = None
-        for i in range(len(self.gps_data)):
-            tm, coords = self.gps_data[i]
-
-            # Perfect match
-            if timestamp == tm:
-                return self.utm_to_ll.TransformPoint(*coords)
-
-            elif tm > timestamp:
-                end = i
-                start = i - 1
-                if start < 0:
-                    return None
-
-                gd_s = self.gps_data[start]
-                gd_e = self.gps_data[end]
-                sx, sy, sz = gd_s[1]
-                ex, ey, ez = gd_e[1]
-                
-                dt = (gd_e[0] - gd_s[0]).total_seconds()
-                if dt >= 10:
-                    return None
-
-                dx = (ex - sx) / dt
-                dy = (ey - sy) / dt
-                dz = (ez - sz) / dt
-                t = (timestamp - gd_s[0]).total_seconds()
-
-                return self.utm_to_ll.TransformPoint(
-                    sx + dx * t,
-                    sy + dy * t,
-                    sz + dz * t
-                )
+        end = bisect_left(self.gps_times, timestamp)
+        if end >= len(self.gps_data):
+            return None
+
+        tm, coords = self.gps_data[end]
+
+        # Perfect match
+        if timestamp == tm:
+            return self.utm_to_ll.TransformPoint(*coords)
+
+        start = end - 1
+        if start < 0:
+            return None
+
+        gd_s = self.gps_data[start]
+        gd_e = self.gps_data[end]
+        sx, sy, sz = gd_s[1]
+        ex, ey, ez = gd_e[1]
+        
+        dt = (gd_e[0] - gd_s[0]).total_seconds()
+        if dt >= 10:
+            return None
+
+        dx = (ex - sx) / dt
+        dy = (ey - sy) / dt
+        dz = (ez - sz) / dt
+        t = (timestamp - gd_s[0]).total_seconds()
+
+        return self.utm_to_ll.TransformPoint(
+            sx + dx * t,
+            sy + dy * t,
+            sz + dz * t
+        )
 
     def parse(self):
 
@@ -203,4 +223,9 @@ class SrtFileParser:
                 altitude = match_single([
                     ("altitude: ([\d\.\-]+)", lambda v: float(v) if v != 0 else None),
                     ("GPS \([\d\.\-]+,? [\d\.\-]+,? ([\d\.\-]+)\)", lambda v: float(v) if v != 0 else None),
-                ], line)
\ No newline at end of file
+                ], line)
+
+        # Sort entries by start time for lookups
+        if any(self.data[i]["start"] > self.data[i + 1]["start"] for i in range(len(self.data) - 1)):
+            self.data.sort(key=lambda e: e["start"])
+        self.starts = [e["start"] for e in self.data]
@@ -6,6 +6,9 @@ import time
 import cv2
 import os
 import collections
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 import numpy as np
 import piexif
@@ -80,9 +83,12 @@ class Video2Dataset:
             else:
                 srt_parser = None
 
+            if self.black_checker is not None:
+                self.black_checker.Reset()
+
             if (self.black_checker is not None and self.black_checker.NeedPreProcess()):
                 start2 = time.time()
-                log.ODM_INFO("Preprocessing for black frame checker... this might take a bit")
+                log.ODM_INFO("Preprocessing for black frame checker")
                 self.black_checker.PreProcess(input_file, self.parameters.start, self.parameters.end)
                 end = time.time()
                 log.ODM_INFO("Preprocessing time: {:.2f}s".format(end - start2))
@@ -105,32 +111,11 @@ class Video2Dataset:
 
             frames_to_process = self.parameters.end - start_frame + 1 if (self.parameters.end is not None) else video_info.total_frames - start_frame
 
-            progress = 0
-            while (cap.isOpened()):
-                ret, frame = cap.read()
-
-                if not ret:
-                    break
-
-                if (self.parameters.end is not None and self.frame_index > self.parameters.end):
-                    break
-
-                # Calculate progress percentage
-                prev_progress = progress
-                progress = floor((self.frame_index - start_frame + 1) / frames_to_process * 100)
-                if progress != prev_progress:
-                    print("[{}][{:3d}%] Processing frame {}/{}: ".format(file_name, progress, self.frame_index - start_frame + 1, frames_to_process), end="\r")
-
-                stats = self.ProcessFrame(frame, video_info, srt_parser)
-
-                if stats is not None and self.parameters.stats_file is not None:
-                    self.WriteStats(input_file, stats)
-
-                # Add element to array
-                if stats is not None and "written" in stats.keys():
-                    output_file_paths.append(stats["path"])
-
+            video_start = time.time()
+            frames_processed = self.ProcessFrames(cap, file_name, start_frame, frames_to_process, video_info, srt_parser, input_file, output_file_paths)
             cap.release()
+            elapsed = time.time() - video_start
+            log.ODM_INFO("Processed {} frames in {:.2f}s ({:.1f} fps)".format(frames_processed, elapsed, frames_processed / elapsed if elapsed > 0 else 0))
 
         if self.f is not None:
             self.f.close()
@@ -144,11 +129,120 @@ class Video2Dataset:
         return output_file_paths
 
 
-    def ProcessFrame(self, frame, video_info, srt_parser):
+    def ProcessFrames(self, cap, file_name, start_frame, frames_to_process, video_info, srt_parser, input_file, output_file_paths):
+        """
+        Decode, analyze and save the frames of a video in a pipeline:
+        a decoder thread feeds a bounded queue, frames are scored by a pool of
+        analyzer threads (results are consumed in order, since the black frame and
+        similarity checks depend on the previous frames) and written by a pool of encoder threads.
+        :return number of frames processed
+        """
+        workers = max(1, self.parameters.max_concurrency)
+        queue_size = workers + 2
+        frames = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+
+        decoder = threading.Thread(target=decode_frames, args=(cap, self.frame_index, self.parameters.end, frames, stop))
+        decoder.daemon = True
+        decoder.start()
+
+        analyzers = ThreadPoolExecutor(max_workers=workers)
+        encoders = ThreadPoolExecutor(max_workers=workers)
+        analyzing = collections.deque()
+        writing = collections.deque()
+        frames_processed = 0
+        progress = 0
+        decoded = False
+        pending = collections.deque()
+
+        def finish_frame(frame_index, frame, frame_bw, res):
+            res["global_idx"] = self.global_idx
+
+            if frame_bw is not None and self.black_checker is not None:
+                is_black = self.black_checker.IsBlack(frame_bw, frame_index)
+                res["is_black"] = is_black
+                if is_black:
+                    frame_bw = None
+
+            if frame_bw is not None and self.similarity_checker is not None:
+                similarity_score, is_similar, last_frame_index = self.similarity_checker.IsSimilar(frame_bw, frame_index)
+                res["similarity_score"] = similarity_score
+                res["is_similar"] = is_similar
+                res["last_frame_index"] = last_frame_index
+                if is_similar:
+                    frame_bw = None
+
+            if frame_bw is not None:
+                res["written"] = True
+                writing.append(encoders.submit(self.SaveFrame, frame, frame_index, self.global_idx, video_info, srt_parser))
+                self.global_idx += 1
+
+                while len(writing) > queue_size:
+                    output_file_paths.append(writing.popleft().result())
+
+            if self.parameters.stats_file is not None:
+                self.WriteStats(input_file, res)
+
+            self.frame_index = frame_index + 1
+
+        try:
+            while not decoded or len(analyzing) > 0:
+                # Keep the analyzers busy
+                while not decoded and len(analyzing) < queue_size:
+                    item = frames.get()
+                    if item is None:
+                        decoded = True
+                    elif isinstance(item, Exception):
+                        raise item
+                    else:
+                        analyzing.append(analyzers.submit(self.AnalyzeFrame, *item))
+
+                if len(analyzing) == 0:
+                    break
 
-        res = {"frame_index": self.frame_index, "global_idx": self.global_idx}
+                frame_index, frame, frame_bw, res, luminance = analyzing.popleft().result()
+                frames_processed += 1
+
+                # Calculate progress percentage
+                prev_progress = progress
+                progress = floor((frame_index - start_frame + 1) / frames_to_process * 100)
+                if progress != prev_progress:
+                    print("[{}][{:3d}%] Processing frame {}/{}: ".format(file_name, progress, frame_index - start_frame + 1, frames_to_process), end="\r")
+
+                # The black frame threshold is estimated from the frames seen so far,
+                # hold the first frames until the estimate is reliable
+                pending.append((frame_index, frame, frame_bw, res))
+                if self.black_checker is not None:
+                    self.black_checker.Update(*luminance)
+                    if not self.black_checker.IsReady() and not (decoded and len(analyzing) == 0):
+                        continue
+
+                while len(pending) > 0:
+                    finish_frame(*pending.popleft())
+
+            while len(pending) > 0:
+                finish_frame(*pending.popleft())
+
+            while len(writing) > 0:
+                output_file_paths.append(writing.popleft().result())
+        finally:
+            stop.set()
+            decoder.join()
+            analyzers.shutdown()
+            encoders.shutdown()
+
+        return frames_processed
+
+    def AnalyzeFrame(self, frame_index, frame):
+        """
+        Run the checkers that do not depend on other frames
+        :return (frame_index, frame, frame_bw, stats, (luminance min, luminance max)),
+            frame and frame_bw are None if the frame should be skipped
+        """
+        res = {"frame_index": frame_index}
 
         frame_bw = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        luminance = cv2.minMaxLoc(frame_bw)[:2] if self.black_checker is not None else None
 
         h, w = frame_bw.shape
         resolution = self.parameters.internal_resolution
@@ -158,44 +252,16 @@ class Video2Dataset:
             frame_bw = cv2.resize(frame_bw, (int(ceil(w * factor)), int(ceil(h * factor))), interpolation=cv2.INTER_NEAREST)
 
         if (self.blur_checker is not None):
-            blur_score, is_blurry = self.blur_checker.IsBlur(frame_bw, self.frame_index)
+            blur_score, is_blurry = self.blur_checker.IsBlur(frame_bw, frame_index)
             res["blur_score"] = blur_score
             res["is_blurry"] = is_blurry
 
             if is_blurry:
-                # print ("blurry, skipping")
-                self.frame_index += 1
-                return res
-
-        if (self.black_checker is not None):
-            is_black = self.black_checker.IsBlack(frame_bw, self.frame_index)
-            res["is_black"] = is_black
-
-            if is_black:
-                # print ("black, skipping")
-                self.frame_index += 1
-                return res
-
-        if (self.similarity_checker is not None):
-            similarity_score, is_similar, last_frame_index = self.similarity_checker.IsSimilar(frame_bw, self.frame_index)
-            res["similarity_score"] = similarity_score
-            res["is_similar"] = is_similar
-            res["last_frame_index"] = last_frame_index
-
-            if is_similar:
-                # print ("similar to {}, skipping".format(self.similarity_checker.last_image_id))
-                self.frame_index += 1
-                return res
-
-        path = self.SaveFrame(frame, video_info, srt_parser)
-        res["written"] = True
-        res["path"] = path
-        self.frame_index += 1
-        self.global_idx += 1
-
-        return res
-
-    def SaveFrame(self, frame, video_info, srt_parser: SrtFileParser):
+                return frame_index, None, None, res, luminance
+
+        return frame_index, frame, frame_bw, res, luminance
+
+    def SaveFrame(self, frame, frame_index, global_idx, video_info, srt_parser: SrtFileParser):
         max_dim = self.parameters.max_dimension
         if max_dim is not None:
             h, w, _ = frame.shape
@@ -205,15 +271,17 @@ class Video2Dataset:
                 frame = cv2.resize(frame, (int(ceil(w * factor)), int(ceil(h * factor))), interpolation=cv2.INTER_AREA)
 
         path = os.path.join(self.parameters.output,
-            "{}_{}_{}.{}".format(video_info.basename, self.global_idx, self.frame_index, self.parameters.frame_format))
+            "{}_{}_{}.{}".format(video_info.basename, global_idx, frame_index, self.parameters.frame_format))
 
-        _, buf = cv2.imencode('.' + self.parameters.frame_format, frame)
+        is_jpeg = self.parameters.frame_format.lower() in ["jpg", "jpeg"]
+        if is_jpeg:
+            _, buf = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 95])
+        else:
+            _, buf = cv2.imencode('.' + self.parameters.frame_format, frame)
 
-        delta = datetime.timedelta(seconds=(self.frame_index / video_info.frame_rate))
+        delta = datetime.timedelta(seconds=(frame_index / video_info.frame_rate))
         elapsed_time = datetime.datetime(1900, 1, 1) + delta
 
-        img = Image.open(io.BytesIO(buf))
-        
         entry = gps_coords = None
         if srt_parser is not None:
             entry = srt_parser.get_entry(elapsed_time)
@@ -256,7 +324,13 @@ class Video2Dataset:
             exif_dict["GPS"] = get_gps_location(elapsed_time, gps_coords[1], gps_coords[0], gps_coords[2])
 
         exif_bytes = piexif.dump(exif_dict)
-        img.save(path, exif=exif_bytes, quality=95)
+
+        if is_jpeg:
+            # Splice the EXIF segment into the encoded JPEG, no need to decode it again
+            piexif.insert(exif_bytes, buf.tobytes(), path)
+        else:
+            img = Image.open(io.BytesIO(buf))
+            img.save(path, exif=exif_bytes, quality=95)
 
         return path
 
@@ -275,6 +349,39 @@ class Video2Dataset:
             stats["written"] if "written" in stats else "").replace(".", ","))
 
 
+def decode_frames(cap, frame_index, end, frames, stop):
+    """
+    Read frames from a video capture and put (frame_index, frame) tuples
+    in the frames queue, followed by None (or the exception that stopped the decoder)
+    """
+    def put(item):
+        while not stop.is_set():
+            try:
+                frames.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        while (cap.isOpened()):
+            ret, frame = cap.read()
+
+            if not ret:
+                break
+
+            if (end is not None and frame_index > end):
+                break
+
+            if not put((frame_index, frame)):
+                return
+            frame_index += 1
+    except Exception as e:
+        put(e)
+        return
+
+    put(None)
+
 def get_video_info(input_file):
 
     video = cv2.VideoCapture(input_file)
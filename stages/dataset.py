@@ -4,9 +4,9 @@ import json
 from opendm import context
 from opendm import io
 from opendm import types
-from opendm.photo import PhotoCorruptedException
 from opendm import log
 from opendm import system
+from opendm import photocache
 from opendm.geo import GeoFile
 from shutil import copyfile
 from opendm import progress
@@ -14,7 +14,6 @@ from opendm import boundary
 from opendm import ai
 from opendm.skyremoval.skyfilter import SkyFilter
 from opendm.bgfilter import BgFilter
-from opendm.concurrency import parallel_map
 from opendm.video.video2dataset import Parameters, Video2Dataset
 
 def save_images_database(photos, database_file):
@@ -24,11 +23,6 @@ def save_images_database(photos, database_file):
     log.ODM_INFO("Wrote images database: %s" % database_file)
 
 def load_images_database(database_file):
-    # Empty is used to create types.ODM_Photo class
-    # instances without calling __init__
-    class Empty:
-        pass
-
     result = []
 
     log.ODM_INFO("Loading images database: %s" % database_file)
@@ -36,10 +30,9 @@ def load_images_database(database_file):
     with open(database_file, 'r') as f:
         photos_json = json.load(f)
         for photo_json in photos_json:
-            p = Empty()
-            for k in photo_json:
-                setattr(p, k, photo_json[k])
-            p.__class__ = types.ODM_Photo
+            # Create types.ODM_Photo instances without calling __init__
+            p = types.ODM_Photo.__new__(types.ODM_Photo)
+            p.__dict__ = photo_json
             result.append(p)
 
     return result
@@ -142,6 +135,7 @@ class ODMLoadDatasetStage(types.ODM_Stage):
                             "use_srt": True,
                             "max_dimension": args.video_resolution,
                             "limit": args.video_limit,
+                            "max_concurrency": args.max_concurrency,
                         })
                         v2d = Video2Dataset(params)
                         frames = v2d.ProcessVideo()
@@ -166,13 +160,15 @@ class ODMLoadDatasetStage(types.ODM_Stage):
                 photos = []
                 with open(tree.dataset_list, 'w') as dataset_list:
                     log.ODM_INFO("Loading %s images" % len(path_files))
-                    for f in path_files:
-                        try:
-                            p = types.ODM_Photo(f)
+                    parsed_photos = photocache.load_photos(path_files, 
+                                                    cache_dir=photocache.default_cache_dir(tree.root_path), 
+                                                    max_workers=args.max_concurrency)
+                    for f, p in zip(path_files, parsed_photos):
+                        if p is not None:
                             p.set_mask(find_mask(f, masks))
                             photos.append(p)
                             dataset_list.write(photos[-1].filename + '\n')
-                        except PhotoCorruptedException:
+                        else:
                             log.ODM_WARNING("%s seems corrupted and will not be used" % os.path.basename(f))
 
                 # Check if a geo file is available
@@ -220,22 +216,16 @@ class ODMLoadDatasetStage(types.ODM_Stage):
                         log.ODM_INFO("Automatically generating sky masks for %s images" % len(sky_images))
                         model = ai.get_model("skyremoval", "https://github.com/OpenDroneMap/SkyRemoval/releases/download/v1.0.5/model.zip", "v1.0.5")
                         if model is not None:
-                            sf = SkyFilter(model=model)
-
-                            def parallel_sky_filter(item):
-                                try:
-                                    mask_file = sf.run_img(item['file'], images_dir)
-
-                                    # Check and set
-                                    if mask_file is not None and os.path.isfile(mask_file):
-                                        item['p'].set_mask(os.path.basename(mask_file))
-                                        log.ODM_INFO("Wrote %s" % os.path.basename(mask_file))
-                                    else:
-                                        log.ODM_WARNING("Cannot generate mask for %s" % img)
-                                except Exception as e:
-                                    log.ODM_WARNING("Cannot generate mask for %s: %s" % (img, str(e)))
+                            sf = SkyFilter(model=model, threads=args.max_concurrency)
+                            mask_files = sf.run_imgs([item['file'] for item in sky_images], images_dir, max_workers=args.max_concurrency)
 
-                            parallel_map(parallel_sky_filter, sky_images, max_workers=args.max_concurrency)
+                            for item, mask_file in zip(sky_images, mask_files):
+                                # Check and set
+                                if mask_file is not None and os.path.isfile(mask_file):
+                                    item['p'].set_mask(os.path.basename(mask_file))
+                                    log.ODM_INFO("Wrote %s" % os.path.basename(mask_file))
+                                else:
+                                    log.ODM_WARNING("Cannot generate mask for %s" % item['file'])
 
                             log.ODM_INFO("Sky masks generation completed!")
                         else:
@@ -261,22 +251,16 @@ class ODMLoadDatasetStage(types.ODM_Stage):
                         log.ODM_INFO("Automatically generating background masks for %s images" % len(bg_images))
                         model = ai.get_model("bgremoval", "https://github.com/OpenDroneMap/ODM/releases/download/v2.9.0/u2net.zip", "v2.9.0")
                         if model is not None:
-                            bg = BgFilter(model=model)
-
-                            def parallel_bg_filter(item):
-                                try:
-                                    mask_file = bg.run_img(item['file'], images_dir)
-
-                                    # Check and set
-                                    if mask_file is not None and os.path.isfile(mask_file):
-                                        item['p'].set_mask(os.path.basename(mask_file))
-                                        log.ODM_INFO("Wrote %s" % os.path.basename(mask_file))
-                                    else:
-                                        log.ODM_WARNING("Cannot generate mask for %s" % img)
-                                except Exception as e:
-                                    log.ODM_WARNING("Cannot generate mask for %s: %s" % (img, str(e)))
-
-                            parallel_map(parallel_bg_filter, bg_images, max_workers=args.max_concurrency)
+                            bg = BgFilter(model=model, threads=args.max_concurrency)
+                            mask_files = bg.run_imgs([item['file'] for item in bg_images], images_dir, max_workers=args.max_concurrency)
+
+                            for item, mask_file in zip(bg_images, mask_files):
+                                # Check and set
+                                if mask_file is not None and os.path.isfile(mask_file):
+                                    item['p'].set_mask(os.path.basename(mask_file))
+                                    log.ODM_INFO("Wrote %s" % os.path.basename(mask_file))
+                                else:
+                                    log.ODM_WARNING("Cannot generate mask for %s" % item['file'])
 
                             log.ODM_INFO("Background masks generation completed!")
                         else:
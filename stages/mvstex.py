@@ -1,4 +1,6 @@
 import os, shutil
+import threading
+import functools
 
 from opendm import log
 from opendm import io
@@ -9,6 +11,33 @@ from opendm.multispectral import get_primary_band_name
 from opendm.photo import find_largest_photo_dim
 from opendm.objpacker import obj_pack
 from opendm.gltf import obj2glb
+from opendm.fingerprint import Fingerprint
+from opendm.dag import TaskGraph
+from opendm.concurrency import get_max_memory_mb
+from opendm.point_cloud import ply_info
+from opendm.nvm import get_num_images
+
+# Rough memory usage of texrecon
+TEXTURING_BASE_MEMORY_MB = 512
+TEXTURING_FACE_MEMORY_MB = 0.002
+TEXTURING_VIEW_MEMORY_MB = 16
+
+def get_texturing_memory_mb(model, nvm_file):
+    """
+    :return estimated memory (MB) needed to texture a mesh, based on
+        its number of faces and the number of views
+    """
+    faces = views = 0
+    try:
+        faces = ply_info(model)['face_count']
+    except Exception as e:
+        log.ODM_WARNING("Cannot read face count of %s: %s" % (model, str(e)))
+    try:
+        views = get_num_images(nvm_file)
+    except Exception as e:
+        log.ODM_WARNING("Cannot read number of views of %s: %s" % (nvm_file, str(e)))
+
+    return TEXTURING_BASE_MEMORY_MB + faces * TEXTURING_FACE_MEMORY_MB + views * TEXTURING_VIEW_MEMORY_MB
 
 class ODMMvsTexStage(types.ODM_Stage):
     def process(self, args, outputs):
@@ -63,19 +92,37 @@ class ODMMvsTexStage(types.ODM_Stage):
             add_run(tree.opensfm_reconstruction_nvm)
         
         progress_per_run = 100.0 / len(nonloc.runs)
-        progress = 0.0
+        progress_lock = threading.Lock()
 
-        for r in nonloc.runs:
+        class progress:
+            value = 0.0
+
+        def texture(r):
             if not io.dir_exists(r['out_dir']):
                 system.mkdir_p(r['out_dir'])
 
             odm_textured_model_obj = os.path.join(r['out_dir'], tree.odm_textured_model_obj)
             unaligned_obj = io.related_file_path(odm_textured_model_obj, postfix="_unaligned")
 
-            if not io.file_exists(odm_textured_model_obj) or self.rerun():
+            # Computed here (and not when building the runs) since the labeling file
+            # is written by the texturing of the primary band
+            fingerprint = Fingerprint(odm_textured_model_obj, {
+                'skip_global_seam_leveling': args.texturing_skip_global_seam_leveling,
+                'skip_local_seam_leveling': args.texturing_skip_local_seam_leveling,
+                'keep_unseen_faces': args.texturing_keep_unseen_faces,
+                'nadir': r['nadir'],
+                'max_texture_size': max_texture_size,
+                'multi_camera': bool(reconstruction.multi_camera),
+                'gltf': args.gltf and r['primary'],
+                'single_material': args.texturing_single_material and r['primary'],
+            }, [r['model'], r['nvm_file']] + ([r['labeling_file']] if r['labeling_file'] else []))
+
+            if self.rerun() or not fingerprint.matches():
                 log.ODM_INFO('Writing MVS Textured file in: %s'
                               % odm_textured_model_obj)
 
+                fingerprint.invalidate()
+
                 if os.path.isfile(unaligned_obj):
                     os.unlink(unaligned_obj)
 
@@ -129,55 +176,88 @@ class ODMMvsTexStage(types.ODM_Stage):
                         '{keepUnseenFaces} '
                         '{nadirMode} '
                         '{labelingFile} '
-                        '{maxTextureSize} '.format(**kwargs))
+                        '{maxTextureSize} '.format(**kwargs), env_vars={'OMP_NUM_THREADS': r['threads']})
 
-                if r['primary'] and (not r['nadir'] or args.skip_3dmodel):
-                    # GlTF?
-                    if args.gltf:
-                        log.ODM_INFO("Generating glTF Binary")
-                        odm_textured_model_glb = os.path.join(r['out_dir'], tree.odm_textured_model_glb)
-            
-                        try:
-                            obj2glb(odm_textured_model_obj, odm_textured_model_glb, rtc=reconstruction.get_proj_offset(), _info=log.ODM_INFO)
-                        except Exception as e:
-                            log.ODM_WARNING(str(e))
-
-                    # Single material?
-                    if args.texturing_single_material:
-                        log.ODM_INFO("Packing to single material")
-
-                        packed_dir = os.path.join(r['out_dir'], 'packed')
-                        if io.dir_exists(packed_dir):
-                            log.ODM_INFO("Removing old packed directory {}".format(packed_dir))
-                            shutil.rmtree(packed_dir)
-                        
-                        try:
-                            obj_pack(os.path.join(r['out_dir'], tree.odm_textured_model_obj), packed_dir, _info=log.ODM_INFO)
-                            
-                            # Move packed/* into texturing folder
-                            system.delete_files(r['out_dir'], (".vec", ))
-                            system.move_files(packed_dir, r['out_dir'])
-                            if os.path.isdir(packed_dir):
-                                os.rmdir(packed_dir)
-                        except Exception as e:
-                            log.ODM_WARNING(str(e))
-
-
-                # Backward compatibility: copy odm_textured_model_geo.mtl to odm_textured_model.mtl
-                # for certain older WebODM clients which expect a odm_textured_model.mtl
-                # to be present for visualization
-                # We should remove this at some point in the future
-                geo_mtl = os.path.join(r['out_dir'], 'odm_textured_model_geo.mtl')
-                if io.file_exists(geo_mtl):
-                    nongeo_mtl = os.path.join(r['out_dir'], 'odm_textured_model.mtl')
-                    shutil.copy(geo_mtl, nongeo_mtl)
-
-                progress += progress_per_run
-                self.update_progress(progress)
+                r['fingerprint'] = fingerprint
             else:
                 log.ODM_WARNING('Found a valid ODM Texture file in: %s'
                                 % odm_textured_model_obj)
+
+        def post_process(r):
+            # Runs while other models are being textured
+            fingerprint = r.get('fingerprint')
+            if fingerprint is None:
+                return
+
+            odm_textured_model_obj = os.path.join(r['out_dir'], tree.odm_textured_model_obj)
+
+            if r['primary'] and (not r['nadir'] or args.skip_3dmodel):
+                # GlTF?
+                if args.gltf:
+                    log.ODM_INFO("Generating glTF Binary")
+                    odm_textured_model_glb = os.path.join(r['out_dir'], tree.odm_textured_model_glb)
         
+                    try:
+                        obj2glb(odm_textured_model_obj, odm_textured_model_glb, rtc=reconstruction.get_proj_offset(), _info=log.ODM_INFO)
+                    except Exception as e:
+                        log.ODM_WARNING(str(e))
+
+                # Single material?
+                if args.texturing_single_material:
+                    log.ODM_INFO("Packing to single material")
+
+                    packed_dir = os.path.join(r['out_dir'], 'packed')
+                    if io.dir_exists(packed_dir):
+                        log.ODM_INFO("Removing old packed directory {}".format(packed_dir))
+                        shutil.rmtree(packed_dir)
+                    
+                    try:
+                        obj_pack(os.path.join(r['out_dir'], tree.odm_textured_model_obj), packed_dir, _info=log.ODM_INFO)
+                        
+                        # Move packed/* into texturing folder
+                        system.delete_files(r['out_dir'], (".vec", ))
+                        system.move_files(packed_dir, r['out_dir'])
+                        if os.path.isdir(packed_dir):
+                            os.rmdir(packed_dir)
+                    except Exception as e:
+                        log.ODM_WARNING(str(e))
+
+
+            # Backward compatibility: copy odm_textured_model_geo.mtl to odm_textured_model.mtl
+            # for certain older WebODM clients which expect a odm_textured_model.mtl
+            # to be present for visualization
+            # We should remove this at some point in the future
+            geo_mtl = os.path.join(r['out_dir'], 'odm_textured_model_geo.mtl')
+            if io.file_exists(geo_mtl):
+                nongeo_mtl = os.path.join(r['out_dir'], 'odm_textured_model.mtl')
+                shutil.copy(geo_mtl, nongeo_mtl)
+
+            fingerprint.save()
+
+            with progress_lock:
+                progress.value += progress_per_run
+                self.update_progress(progress.value)
+
+        # Primary runs go first (secondary bands use their labeling files),
+        # each group shares the available threads
+        for primary in [True, False]:
+            group = [r for r in nonloc.runs if r['primary'] == primary]
+            for r in group:
+                r['threads'] = max(1, self.max_concurrency() // len(group))
+
+        graph = TaskGraph(self.max_concurrency(), get_max_memory_mb() * self.max_memory_share())
+        for i, r in enumerate(nonloc.runs):
+            depends_on = []
+            if r['labeling_file']:
+                # Wait for the post processing too, since packing to a single material
+                # rewrites the directory of the primary band, where the labeling file is
+                depends_on = ["post_process_%s" % j for j, p in enumerate(nonloc.runs) if p['primary'] and p['nadir'] == r['nadir']]
+
+            graph.add("texture_%s" % i, functools.partial(texture, r), depends_on=depends_on,
+                      cpus=r['threads'], memory=get_texturing_memory_mb(r['model'], r['nvm_file']))
+            graph.add("post_process_%s" % i, functools.partial(post_process, r), depends_on=["texture_%s" % i])
+        graph.run()
+
         if args.optimize_disk_space:
             for r in nonloc.runs:
                 if io.file_exists(r['model']):
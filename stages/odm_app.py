@@ -48,8 +48,11 @@ class ODMApp:
         georeferencing = ODMGeoreferencingStage('odm_georeferencing', args, progress=80.0,
                                                     gcp_file=args.gcp)
         dem = ODMDEMStage('odm_dem', args, progress=90.0,
-                            max_concurrency=args.max_concurrency)
-        orthophoto = ODMOrthoPhotoStage('odm_orthophoto', args, progress=98.0)
+                            max_concurrency=max(1, args.max_concurrency // 2),
+                            memory_share=0.5)
+        orthophoto = ODMOrthoPhotoStage('odm_orthophoto', args, progress=98.0,
+                            max_concurrency=max(1, args.max_concurrency // 2),
+                            memory_share=0.5)
         report = ODMReport('odm_report', args, progress=99.0)
         postprocess = ODMPostProcess('odm_postprocess', args, progress=100.0)
         
@@ -75,6 +78,12 @@ class ODMApp:
             .connect(orthophoto) \
             .connect(report) \
             .connect(postprocess)
+
+        # DEMs and orthophoto only need the georeferenced outputs
+        # and can be generated at the same time
+        dem.depends_on(georeferencing)
+        orthophoto.depends_on(georeferencing)
+        report.depends_on(dem, orthophoto)
                 
     def execute(self):
         try:
@@ -1,4 +1,6 @@
 import os, json, math
+import threading
+import functools
 from shutil import copyfile
 
 from opendm import io
@@ -12,6 +14,8 @@ from opendm.cropper import Cropper
 from opendm import pseudogeo
 from opendm.tiles.tiler import generate_dem_tiles
 from opendm.cogeo import convert_to_cogeo
+from opendm.dag import TaskGraph
+from opendm.fingerprint import Fingerprint
 
 
 class ODMDEMStage(types.ODM_Stage):
@@ -71,28 +75,60 @@ class ODMDEMStage(types.ODM_Stage):
         progress = 20
         self.update_progress(progress)
 
-        if args.pc_rectify:
-            commands.rectify(dem_input, False)
-
         # Do we need to process anything here?
         if (args.dsm or args.dtm) and pc_model_found:
-            dsm_output_filename = os.path.join(odm_dem_root, 'dsm.tif')
-            dtm_output_filename = os.path.join(odm_dem_root, 'dtm.tif')
-
-            if (args.dtm and not io.file_exists(dtm_output_filename)) or \
-                (args.dsm and not io.file_exists(dsm_output_filename)) or \
-                self.rerun():
-
-                products = []
+            products = []
+
+            if args.dsm or (args.dtm and args.dem_euclidean_map): products.append('dsm')
+            if args.dtm: products.append('dtm')
+
+            radius_steps = [(resolution / 100.0) / 2.0]
+            for _ in range(args.dem_gapfill_steps - 1):
+                radius_steps.append(radius_steps[-1] * math.sqrt(2)) # sqrt(2) is arbitrary, maybe there's a better value?
+
+            bounds_file_path = os.path.join(tree.odm_georeferencing, 'odm_georeferenced_model.bounds.gpkg')
+
+            def get_fingerprint(product):
+                return Fingerprint(os.path.join(odm_dem_root, "{}.tif".format(product)), {
+                    'resolution': resolution,
+                    'radiuses': radius_steps,
+                    'gapfill': args.dem_gapfill_steps,
+                    'decimation': args.dem_decimation,
+                    'euclidean_map': args.dem_euclidean_map,
+                    'crop': args.crop,
+                    'boundary': args.boundary,
+                    'pseudo_georeference': pseudo_georeference,
+                    'tiles': args.tiles,
+                    'cog': args.cog,
+                    'rectify': args.pc_rectify,
+                }, [dem_input, bounds_file_path])
+
+            fingerprints = {}
+            for product in products:
+                fingerprints[product] = get_fingerprint(product)
+
+            # Only (re)create the products whose parameters or inputs have changed
+            outdated = [p for p in products if self.rerun() or not fingerprints[p].matches()]
+
+            if len(outdated) > 0 and args.pc_rectify:
+                # Rectification modifies the input of all products,
+                # which must then all be recreated
+                commands.rectify(dem_input, False)
+                for product in products:
+                    fingerprints[product] = get_fingerprint(product)
+                outdated = products
+            products = outdated
 
-                if args.dsm or (args.dtm and args.dem_euclidean_map): products.append('dsm')
-                if args.dtm: products.append('dtm')
+            if len(products) > 0:
+                # DEM products are independent and can be created concurrently,
+                # splitting the available CPUs between them
+                product_workers = max(1, self.max_concurrency() // len(products))
+                progress_lock = threading.Lock()
 
-                radius_steps = [(resolution / 100.0) / 2.0]
-                for _ in range(args.dem_gapfill_steps - 1):
-                    radius_steps.append(radius_steps[-1] * math.sqrt(2)) # sqrt(2) is arbitrary, maybe there's a better value?
+                def create_product(product):
+                    nonlocal progress
 
-                for product in products:
+                    fingerprints[product].invalidate()
                     commands.create_dem(
                             dem_input,
                             product,
@@ -102,23 +138,23 @@ class ODMDEMStage(types.ODM_Stage):
                             outdir=odm_dem_root,
                             resolution=resolution / 100.0,
                             decimation=args.dem_decimation,
-                            max_workers=args.max_concurrency,
+                            max_workers=product_workers,
+                            max_memory=self.max_memory() / len(products),
                             keep_unfilled_copy=args.dem_euclidean_map
                         )
 
                     dem_geotiff_path = os.path.join(odm_dem_root, "{}.tif".format(product))
-                    bounds_file_path = os.path.join(tree.odm_georeferencing, 'odm_georeferenced_model.bounds.gpkg')
 
                     if args.crop > 0 or args.boundary:
                         # Crop DEM
-                        Cropper.crop(bounds_file_path, dem_geotiff_path, utils.get_dem_vars(args), keep_original=not args.optimize_disk_space)
+                        Cropper.crop(bounds_file_path, dem_geotiff_path, utils.get_dem_vars(args, product_workers), keep_original=not args.optimize_disk_space)
 
                     if args.dem_euclidean_map:
                         unfilled_dem_path = io.related_file_path(dem_geotiff_path, postfix=".unfilled")
                         
                         if args.crop > 0 or args.boundary:
                             # Crop unfilled DEM
-                            Cropper.crop(bounds_file_path, unfilled_dem_path, utils.get_dem_vars(args), keep_original=not args.optimize_disk_space)
+                            Cropper.crop(bounds_file_path, unfilled_dem_path, utils.get_dem_vars(args, product_workers), keep_original=not args.optimize_disk_space)
 
                         commands.compute_euclidean_map(unfilled_dem_path, 
                                             io.related_file_path(dem_geotiff_path, postfix=".euclideand"), 
@@ -128,14 +164,24 @@ class ODMDEMStage(types.ODM_Stage):
                         pseudogeo.add_pseudo_georeferencing(dem_geotiff_path)
 
                     if args.tiles:
-                        generate_dem_tiles(dem_geotiff_path, tree.path("%s_tiles" % product), args.max_concurrency)
+                        generate_dem_tiles(dem_geotiff_path, tree.path("%s_tiles" % product), product_workers)
                     
                     if args.cog:
-                        convert_to_cogeo(dem_geotiff_path, max_workers=args.max_concurrency)
+                        convert_to_cogeo(dem_geotiff_path, max_workers=product_workers)
+
+                    fingerprints[product].save()
 
-                    progress += 30
-                    self.update_progress(progress)
+                    with progress_lock:
+                        progress += 30
+                        self.update_progress(progress)
+
+                graph = TaskGraph(self.max_concurrency())
+                for product in products:
+                    graph.add(product, functools.partial(create_product, product), cpus=product_workers)
+                graph.run()
             else:
                 log.ODM_WARNING('Found existing outputs in: %s' % odm_dem_root)
         else:
+            if args.pc_rectify and pc_model_found:
+                commands.rectify(dem_input, False)
             log.ODM_WARNING('DEM will not be generated')
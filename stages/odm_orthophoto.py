@@ -7,11 +7,11 @@ from opendm import context
 from opendm import types
 from opendm import gsd
 from opendm import orthophoto
-from opendm.concurrency import get_max_memory
 from opendm.cutline import compute_cutline
 from opendm.utils import double_quote
 from opendm import pseudogeo
 from opendm.multispectral import get_primary_band_name
+from opendm.fingerprint import Fingerprint
 
 
 class ODMOrthoPhotoStage(types.ODM_Stage):
@@ -26,12 +26,71 @@ class ODMOrthoPhotoStage(types.ODM_Stage):
             log.ODM_WARNING("--skip-orthophoto is set, no orthophoto will be generated")
             return
 
-        if not io.file_exists(tree.odm_orthophoto_tif) or self.rerun():
+        resolution = 1.0 / (gsd.cap_resolution(args.orthophoto_resolution, tree.opensfm_reconstruction,
+                                               ignore_gsd=args.ignore_gsd,
+                                               ignore_resolution=(not reconstruction.is_georeferenced()) and args.ignore_gsd,
+                                               has_gcp=reconstruction.has_gcp()) / 100.0)
 
-            resolution = 1.0 / (gsd.cap_resolution(args.orthophoto_resolution, tree.opensfm_reconstruction,
-                                                   ignore_gsd=args.ignore_gsd,
-                                                   ignore_resolution=(not reconstruction.is_georeferenced()) and args.ignore_gsd,
-                                                   has_gcp=reconstruction.has_gcp()) / 100.0)
+        bands = ''
+        depth_idx_param = ''
+        models = []
+
+        if args.use_3dmesh:
+            base_dir = tree.odm_texturing
+        else:
+            base_dir = tree.odm_25dtexturing
+
+        model_file = tree.odm_textured_model_obj
+
+        if reconstruction.multi_camera:
+            for band in reconstruction.multi_camera:
+                primary = band['name'] == get_primary_band_name(reconstruction.multi_camera, args.primary_band)
+                subdir = ""
+                if not primary:
+                    subdir = band['name'].lower()
+                models.append(os.path.join(base_dir, subdir, model_file))
+            bands = '-bands %s' % (','.join([double_quote(b['name']) for b in reconstruction.multi_camera]))
+
+            # If a RGB band is present, 
+            # use bit depth of the first non-RGB band
+            depth_idx = None
+            all_bands = [b['name'].lower() for b in reconstruction.multi_camera]
+            for b in ['rgb', 'redgreenblue']:
+                if b in all_bands:
+                    for idx in range(len(all_bands)):
+                        if all_bands[idx] != b:
+                            depth_idx = idx
+                            break
+                    break
+
+            if depth_idx is not None:
+                depth_idx_param = '-outputDepthIdx %s' % depth_idx
+        else:
+            models.append(os.path.join(base_dir, model_file))
+
+        bounds_file_path = os.path.join(tree.odm_georeferencing, 'odm_georeferenced_model.bounds.gpkg')
+        max_concurrency = self.max_concurrency()
+        orthophoto_vars = orthophoto.get_orthophoto_vars(args, max_concurrency)
+
+        fingerprint = Fingerprint(tree.odm_orthophoto_tif, {
+            'resolution': resolution,
+            'models': models,
+            'bands': bands,
+            'depth_idx': depth_idx_param,
+            'georeferenced': reconstruction.is_georeferenced(),
+            'vars': dict([(k, orthophoto_vars[k]) for k in orthophoto_vars if k != 'NUM_THREADS']),
+            'cutline': args.orthophoto_cutline,
+            'crop': args.crop,
+            'boundary': args.boundary,
+            'tiles': args.tiles,
+            'cog': args.cog,
+            'png': args.orthophoto_png,
+            'kmz': args.orthophoto_kmz,
+            'overviews': args.build_overviews,
+        }, models + [bounds_file_path])
+
+        if self.rerun() or not fingerprint.matches():
+            fingerprint.invalidate()
 
             # odm_orthophoto definitions
             kwargs = {
@@ -40,51 +99,16 @@ class ODMOrthoPhotoStage(types.ODM_Stage):
                 'ortho': tree.odm_orthophoto_render,
                 'corners': tree.odm_orthophoto_corners,
                 'res': resolution,
-                'bands': '',
-                'depth_idx': ''
+                'bands': bands,
+                'depth_idx': depth_idx_param
             }
 
-            models = []
-
-            if args.use_3dmesh:
-                base_dir = tree.odm_texturing
-            else:
-                base_dir = tree.odm_25dtexturing
-                
-            model_file = tree.odm_textured_model_obj
-
-            if reconstruction.multi_camera:
-                for band in reconstruction.multi_camera:
-                    primary = band['name'] == get_primary_band_name(reconstruction.multi_camera, args.primary_band)
-                    subdir = ""
-                    if not primary:
-                        subdir = band['name'].lower()
-                    models.append(os.path.join(base_dir, subdir, model_file))
-                kwargs['bands'] = '-bands %s' % (','.join([double_quote(b['name']) for b in reconstruction.multi_camera]))
-
-                # If a RGB band is present, 
-                # use bit depth of the first non-RGB band
-                depth_idx = None
-                all_bands = [b['name'].lower() for b in reconstruction.multi_camera]
-                for b in ['rgb', 'redgreenblue']:
-                    if b in all_bands:
-                        for idx in range(len(all_bands)):
-                            if all_bands[idx] != b:
-                                depth_idx = idx
-                                break
-                        break
-                
-                if depth_idx is not None:
-                    kwargs['depth_idx'] = '-outputDepthIdx %s' % depth_idx
-            else:
-                models.append(os.path.join(base_dir, model_file))
-
             kwargs['models'] = ','.join(map(double_quote, models))
 
             # run odm_orthophoto
             system.run('"{odm_ortho_bin}" -inputFiles {models} '
                        '-logFile "{log}" -outputFile "{ortho}" -resolution {res} -verbose '
-                       '-outputCornerFile "{corners}" {bands} {depth_idx}'.format(**kwargs))
+                       '-outputCornerFile "{corners}" {bands} {depth_idx}'.format(**kwargs), env_vars={'OMP_NUM_THREADS': max_concurrency})
 
             # Create georeferenced GeoTiff
             geotiffcreated = False
@@ -106,8 +130,6 @@ class ODMOrthoPhotoStage(types.ODM_Stage):
                                     float(reconstruction.georef.utm_north_offset)
                 log.ODM_INFO('Creating GeoTIFF')
 
-                orthophoto_vars = orthophoto.get_orthophoto_vars(args)
-
                 kwargs = {
                     'ulx': ulx,
                     'uly': uly,
@@ -118,7 +140,7 @@ class ODMOrthoPhotoStage(types.ODM_Stage):
                     'input': tree.odm_orthophoto_render,
                     'output': tree.odm_orthophoto_tif,
                     'log': tree.odm_orthophoto_tif_log,
-                    'max_memory': get_max_memory(),
+                    'max_memory': self.max_memory(),
                 }
 
                 system.run('gdal_translate -a_ullr {ulx} {uly} {lrx} {lry} '
@@ -128,8 +150,6 @@ class ODMOrthoPhotoStage(types.ODM_Stage):
                            '--config GDAL_TIFF_INTERNAL_MASK YES '
                            '"{input}" "{output}" > "{log}"'.format(**kwargs))
 
-                bounds_file_path = os.path.join(tree.odm_georeferencing, 'odm_georeferenced_model.bounds.gpkg')
-                    
                 # Cutline computation, before cropping
                 # We want to use the full orthophoto, not the cropped one.
                 if args.orthophoto_cutline:
@@ -138,14 +158,14 @@ class ODMOrthoPhotoStage(types.ODM_Stage):
                     compute_cutline(tree.odm_orthophoto_tif, 
                                     bounds_file_path,
                                     cutline_file,
-                                    args.max_concurrency,
+                                    max_concurrency,
                                     scale=0.25)
 
                     orthophoto.compute_mask_raster(tree.odm_orthophoto_tif, cutline_file, 
                                            os.path.join(tree.odm_orthophoto, "odm_orthophoto_cut.tif"),
                                            blend_distance=20, only_max_coords_feature=True)
 
-                orthophoto.post_orthophoto_steps(args, bounds_file_path, tree.odm_orthophoto_tif, tree.orthophoto_tiles)
+                orthophoto.post_orthophoto_steps(args, bounds_file_path, tree.odm_orthophoto_tif, tree.orthophoto_tiles, max_concurrency)
 
                 # Generate feathered orthophoto also
                 if args.orthophoto_cutline:
@@ -162,6 +182,9 @@ class ODMOrthoPhotoStage(types.ODM_Stage):
                     os.replace(tree.odm_orthophoto_render, tree.odm_orthophoto_tif)
                 else:
                     log.ODM_WARNING("Could not generate an orthophoto (it did not render)")
+
+            if io.file_exists(tree.odm_orthophoto_tif):
+                fingerprint.save()
         else:
             log.ODM_WARNING('Found a valid orthophoto in: %s' % tree.odm_orthophoto_tif)
 
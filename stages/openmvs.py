@@ -11,6 +11,25 @@ from opendm.utils import get_depthmap_resolution
 from opendm.osfm import OSFMContext
 from opendm.multispectral import get_primary_band_name
 from opendm.point_cloud import fast_merge_ply
+from opendm.concurrency import get_max_memory_mb, parallel_map
+
+def estimate_fusion_memory(scene_files, num_images, depthmap_resolution):
+    """
+    Rough estimate of the memory (MB) needed to fuse the depthmaps of each sub-scene.
+    The number of images in a sub-scene is estimated from the size of its scene file
+    relative to the others (sub-scenes share the images along their borders)
+    :return dictionary of scene file --> memory estimate
+    """
+    # Depth, normal, confidence and views maps, plus the image
+    bytes_per_image = depthmap_resolution * depthmap_resolution * 0.75 * 40
+    sizes = dict([(sf, os.path.getsize(sf)) for sf in scene_files])
+    total_size = max(1, sum(sizes.values()))
+    
+    estimates = {}
+    for sf in scene_files:
+        images = min(num_images, max(1, int(math.ceil(num_images * sizes[sf] / total_size * 2))))
+        estimates[sf] = 256 + images * bytes_per_image / 1024 / 1024
+    return estimates
 
 class ODMOpenMVSStage(types.ODM_Stage):
     def process(self, args, outputs):
@@ -145,8 +164,49 @@ class ODMOpenMVSStage(types.ODM_Stage):
                     raise system.ExitException("No OpenMVS scenes found. This could be a bug, or the reconstruction could not be processed.")
 
                 log.ODM_INFO("Fusing depthmaps for %s scenes" % len(scene_files))
-                
+
+                def fuse_scene(sf, max_threads):
+                    """
+                    :return False if the fusion ran out of memory, True otherwise
+                    """
+                    p, _ = os.path.splitext(sf)
+                    scene_ply_unfiltered = p + "_dense.ply"
+                    scene_ply = p + "_dense_dense_filtered.ply"
+                    scene_dense_mvs = p + "_dense.mvs"
+
+                    # Fuse
+                    config = [
+                        '--resolution-level %s' % int(resolution_level),
+                        '--max-resolution %s' % int(outputs['undist_image_max_size']),
+                        '--dense-config-file "%s"' % subscene_densify_ini_file,
+                        '--number-views-fuse %s' % number_views_fuse,
+                        '--max-threads %s' % max_threads,
+                        '-w "%s"' % depthmaps_dir,
+                        '-v 0',
+                    ]
+
+                    try:
+                        system.run('"%s" "%s" %s' % (context.omvs_densify_path, sf, ' '.join(config + gpu_config + extra_config)))
+                    except system.SubprocessException as e:
+                        if e.errorCode == 137 or e.errorCode == 3221226505:
+                            return False
+                        log.ODM_WARNING("Sub-scene %s could not be reconstructed, skipping..." % sf)
+                    except:
+                        log.ODM_WARNING("Sub-scene %s could not be reconstructed, skipping..." % sf)
+
+                    if io.file_exists(scene_ply_unfiltered):
+                        # Filter
+                        if args.pc_filter > 0:
+                            system.run('"%s" "%s" --filter-point-cloud %s -v 0 %s' % (context.omvs_densify_path, scene_dense_mvs, filter_point_th, ' '.join(gpu_config)))
+                        else:
+                            # Just rename
+                            log.ODM_INFO("Skipped filtering, %s --> %s" % (scene_ply_unfiltered, scene_ply))
+                            os.rename(scene_ply_unfiltered, scene_ply)
+                    
+                    return True
+
                 scene_ply_files = []
+                pending_scenes = []
 
                 for sf in scene_files:
                     p, _ = os.path.splitext(sf)
@@ -158,36 +218,39 @@ class ODMOpenMVSStage(types.ODM_Stage):
                     scene_ply_files.append(scene_ply)
 
                     if not io.file_exists(scene_ply) or self.rerun():
-                        # Fuse
-                        config = [
-                            '--resolution-level %s' % int(resolution_level),
-                            '--max-resolution %s' % int(outputs['undist_image_max_size']),
-                            '--dense-config-file "%s"' % subscene_densify_ini_file,
-                            '--number-views-fuse %s' % number_views_fuse,
-                            '--max-threads %s' % args.max_concurrency,
-                            '-w "%s"' % depthmaps_dir,
-                            '-v 0',
-                        ]
-
-                        try:
-                            system.run('"%s" "%s" %s' % (context.omvs_densify_path, sf, ' '.join(config + gpu_config + extra_config)))
-                        except:
-                            log.ODM_WARNING("Sub-scene %s could not be reconstructed, skipping..." % sf)
-
-                        if not io.file_exists(scene_ply_unfiltered):
-                            scene_ply_files.pop()
-                            log.ODM_WARNING("Could not compute PLY for subscene %s" % sf)
-                        else:
-                            # Filter
-                            if args.pc_filter > 0:
-                                system.run('"%s" "%s" --filter-point-cloud %s -v 0 %s' % (context.omvs_densify_path, scene_dense_mvs, filter_point_th, ' '.join(gpu_config)))
-                            else:
-                                # Just rename
-                                log.ODM_INFO("Skipped filtering, %s --> %s" % (scene_ply_unfiltered, scene_ply))
-                                os.rename(scene_ply_unfiltered, scene_ply)
+                        pending_scenes.append(sf)
                     else:
                         log.ODM_WARNING("Found existing dense scene file %s" % scene_ply)
 
+                if pending_scenes:
+                    # Run as many fusions concurrently as memory allows,
+                    # splitting the available threads between them
+                    memory_estimates = estimate_fusion_memory(pending_scenes, len(photos), depthmap_resolution)
+                    max_parallel = int(get_max_memory_mb() // max(memory_estimates.values()))
+                    parallel_fusions = max(1, min(len(pending_scenes), args.max_concurrency, max_parallel))
+                    threads_per_fusion = max(1, args.max_concurrency // parallel_fusions)
+                    log.ODM_INFO("Running %s fusions in parallel (%s threads each)" % (parallel_fusions, threads_per_fusion))
+
+                    fused = parallel_map(lambda sf: fuse_scene(sf, threads_per_fusion), pending_scenes, parallel_fusions, 
+                                         single_thread_fallback=False,
+                                         memory_estimate=lambda sf: memory_estimates[sf])
+
+                    # Requeue scenes that ran out of memory, one at a time
+                    for sf, ok in zip(pending_scenes, fused):
+                        if not ok:
+                            if parallel_fusions > 1:
+                                log.ODM_WARNING("Sub-scene %s ran out of memory, retrying with no other fusions running" % sf)
+                                ok = fuse_scene(sf, args.max_concurrency)
+                            if not ok:
+                                log.ODM_WARNING("Sub-scene %s could not be reconstructed (out of memory), skipping..." % sf)
+
+                for sf in scene_files:
+                    p, _ = os.path.splitext(sf)
+                    scene_ply = p + "_dense_dense_filtered.ply"
+                    if not io.file_exists(scene_ply):
+                        scene_ply_files.remove(scene_ply)
+                        log.ODM_WARNING("Could not compute PLY for subscene %s" % sf)
+
                 # Merge
                 log.ODM_INFO("Merging %s scene files" % len(scene_ply_files))
                 if len(scene_ply_files) == 0:
@@ -116,7 +116,8 @@ class ODMOpenSfMStage(types.ODM_Stage):
             if photo.is_thermal():
                 return thermal.dn_to_temperature(photo, image, tree.dataset_raw)
             else:
-                return multispectral.dn_to_reflectance(photo, image, use_sun_sensor=args.radiometric_calibration=="camera+sun")
+                return multispectral.dn_to_reflectance(photo, image, use_sun_sensor=args.radiometric_calibration=="camera+sun",
+                                                       cache_dir=octx.path("vignetting"))
 
 
         def align_to_primary_band(shot_id, image):
@@ -165,7 +166,8 @@ class ODMOpenSfMStage(types.ODM_Stage):
                 s2p, p2s = multispectral.compute_band_maps(reconstruction.multi_camera, primary_band_name)
                 
                 if not args.skip_band_alignment:
-                    alignment_info = multispectral.compute_alignment_matrices(reconstruction.multi_camera, primary_band_name, tree.dataset_raw, s2p, p2s, max_concurrency=args.max_concurrency)
+                    alignment_info = multispectral.compute_alignment_matrices(reconstruction.multi_camera, primary_band_name, tree.dataset_raw, s2p, p2s, max_concurrency=args.max_concurrency,
+                                                                                  cache_dir=multispectral.default_alignment_cache_dir(tree.root_path))
                 else:
                     log.ODM_WARNING("Skipping band alignment")
                     alignment_info = {}
@@ -13,7 +13,7 @@ from opendm.dem import pdal, utils
 from opendm.dem.merge import euclidean_merge_dems
 from opensfm.large import metadataset
 from opendm.cropper import Cropper
-from opendm.concurrency import get_max_memory
+from opendm.concurrency import get_max_memory, get_max_memory_mb, parallel_map
 from opendm.remote import LocalRemoteExecutor
 from opendm.shots import merge_geojson_shots
 from opendm import point_cloud
@@ -22,6 +22,54 @@ from opendm.tiles.tiler import generate_dem_tiles
 from opendm.cogeo import convert_to_cogeo
 from opendm import multispectral
 
+# Rough memory needed to process a submodel with the full toolchain
+SUBMODEL_BASE_MEMORY_MB = 1024
+SUBMODEL_IMAGE_MEMORY_MB = 32
+
+# Minimum number of CPUs to give to each submodel
+SUBMODEL_MIN_CPUS = 4
+
+def get_submodel_memory_mb(submodel_path):
+    images_dir = os.path.join(submodel_path, "..", "images")
+    num_images = len(os.listdir(images_dir)) if os.path.isdir(images_dir) else 0
+    return SUBMODEL_BASE_MEMORY_MB + num_images * SUBMODEL_IMAGE_MEMORY_MB
+
+def get_submodel_concurrency(submodel_paths, max_concurrency):
+    """
+    :return number of submodels that can be processed concurrently,
+        based on the number of CPUs and the memory needed by each submodel
+    """
+    if len(submodel_paths) <= 1:
+        return 1
+
+    by_cpus = max_concurrency // SUBMODEL_MIN_CPUS
+    by_memory = int(get_max_memory_mb() // max(get_submodel_memory_mb(sp) for sp in submodel_paths))
+
+    return max(1, min(len(submodel_paths), by_cpus, by_memory))
+
+def run_submodel_toolchain(args, submodels_path, submodel_path, max_concurrency=None, rerun=False):
+    """
+    Run the ODM toolchain on a submodel, unless it has already been
+    processed (marked by toolchain_completed.txt)
+    """
+    sp_octx = OSFMContext(submodel_path)
+    done_file = os.path.abspath(sp_octx.path("..", "toolchain_completed.txt"))
+
+    if io.file_exists(done_file) and not rerun:
+        log.ODM_WARNING("Submodel %s has already been processed" % sp_octx.name())
+        return
+    
+    log.ODM_INFO("========================")
+    log.ODM_INFO("Processing %s" % sp_octx.name()) 
+    log.ODM_INFO("========================")
+
+    argv = get_submodel_argv(args, submodels_path, sp_octx.name(), max_concurrency=max_concurrency)
+
+    # Re-run the ODM toolchain on the submodel
+    system.run(" ".join(map(double_quote, map(str, argv))), env_vars=os.environ.copy())
+    sp_octx.touch(done_file)
+    log.ODM_INFO("Finished processing %s" % sp_octx.name())
+
 class ODMSplitStage(types.ODM_Stage):
     def process(self, args, outputs):
         tree = outputs['tree']
@@ -128,13 +176,29 @@ class ODMSplitStage(types.ODM_Stage):
                 self.update_progress(25)
 
                 if local_workflow:
-                    for sp in submodel_paths:
+                    submodel_concurrency = get_submodel_concurrency(submodel_paths, args.max_concurrency)
+                    if submodel_concurrency > 1:
+                        log.ODM_INFO("Processing up to %s submodels concurrently" % submodel_concurrency)
+
+                    def reconstruct_submodel(sp):
                         log.ODM_INFO("Reconstructing %s" % sp)
                         local_sp_octx = OSFMContext(sp)
+
+                        # Each reconstruction gets a slice of the available CPUs
+                        if submodel_concurrency > 1:
+                            local_sp_octx.update_config({'processes': max(1, args.max_concurrency // submodel_concurrency)})
+
                         local_sp_octx.create_tracks(self.rerun())
                         local_sp_octx.reconstruct(args.rolling_shutter, self.rerun())
+
+                    parallel_map(reconstruct_submodel, submodel_paths, submodel_concurrency, 
+                                 single_thread_fallback=False, memory_estimate=get_submodel_memory_mb)
                 else:
-                    lre = LocalRemoteExecutor(args.sm_cluster, args.rolling_shutter, self.rerun())
+                    # Local slots share the CPUs of this machine
+                    local_slots = get_submodel_concurrency(submodel_paths, args.max_concurrency)
+                    lre = LocalRemoteExecutor(args.sm_cluster, args.rolling_shutter, self.rerun(),
+                                              local_slots=local_slots,
+                                              local_max_concurrency=max(1, args.max_concurrency // local_slots) if local_slots > 1 else None)
                     lre.set_projects([os.path.abspath(os.path.join(p, "..")) for p in submodel_paths])
                     lre.run_reconstruction()
 
@@ -179,17 +243,17 @@ class ODMSplitStage(types.ODM_Stage):
 
                 # Run ODM toolchain for each submodel
                 if local_workflow:
-                    for sp in submodel_paths:
-                        sp_octx = OSFMContext(sp)
-
-                        log.ODM_INFO("========================")
-                        log.ODM_INFO("Processing %s" % sp_octx.name()) 
-                        log.ODM_INFO("========================")
+                    # Each submodel gets a slice of the available CPUs
+                    submodel_concurrency = get_submodel_concurrency(submodel_paths, args.max_concurrency)
+                    submodel_max_concurrency = max(1, args.max_concurrency // submodel_concurrency)
 
-                        argv = get_submodel_argv(args, tree.submodels_path, sp_octx.name())
+                    def process_submodel(sp):
+                        run_submodel_toolchain(args, tree.submodels_path, sp, 
+                                               max_concurrency=submodel_max_concurrency if submodel_concurrency > 1 else None,
+                                               rerun=self.rerun())
 
-                        # Re-run the ODM toolchain on the submodel
-                        system.run(" ".join(map(double_quote, map(str, argv))), env_vars=os.environ.copy())
+                    parallel_map(process_submodel, submodel_paths, submodel_concurrency, 
+                                 single_thread_fallback=False, memory_estimate=get_submodel_memory_mb)
                 else:
                     lre.set_projects([os.path.abspath(os.path.join(p, "..")) for p in submodel_paths])
                     lre.run_toolchain()
@@ -265,7 +329,7 @@ class ODMMergeStage(types.ODM_Stage):
                             os.remove(tree.odm_orthophoto_tif)
 
                         orthophoto_vars = orthophoto.get_orthophoto_vars(args)
-                        orthophoto.merge(all_orthos_and_ortho_cuts, tree.odm_orthophoto_tif, orthophoto_vars)
+                        orthophoto.merge(all_orthos_and_ortho_cuts, tree.odm_orthophoto_tif, orthophoto_vars, max_workers=args.max_concurrency)
                         orthophoto.post_orthophoto_steps(args, merged_bounds_file, tree.odm_orthophoto_tif, tree.orthophoto_tiles)
                     elif len(all_orthos_and_ortho_cuts) == 1:
                         # Simply copy
@@ -297,7 +361,7 @@ class ODMMergeStage(types.ODM_Stage):
                     if human_name == "DTM":
                         eu_map_source = "dsm"
 
-                    euclidean_merge_dems(all_dems, dem_file, dem_vars, euclidean_map_source=eu_map_source)
+                    euclidean_merge_dems(all_dems, dem_file, dem_vars, euclidean_map_source=eu_map_source, max_workers=args.max_concurrency)
 
                     if io.file_exists(dem_file):
                         # Crop
@@ -0,0 +1,34 @@
+import unittest
+import numpy as np
+
+from opendm import ai
+
+class TestAi(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_batch_inference(self):
+        batches = []
+        def preprocess(item):
+            if item == 3:
+                return None # Skipped
+            if item == 5:
+                raise Exception("Cannot read")
+            return np.full(2, item), item * 10
+
+        def infer(inputs):
+            batches.append(len(inputs))
+            return [i * 2 for i in inputs]
+
+        def postprocess(output, ctx):
+            return int(output.sum()) + ctx
+
+        items = list(range(10))
+        for workers in [1, 4]:
+            batches = []
+            results = ai.batch_inference(items, preprocess, infer, postprocess, batch_size=4, max_workers=workers)
+            self.assertEqual(results, [None if i in [3, 5] else i * 4 + i * 10 for i in items])
+            self.assertEqual(batches, [3, 3, 2])
+
+if __name__ == '__main__':
+    unittest.main()
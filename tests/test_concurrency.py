@@ -0,0 +1,85 @@
+import unittest
+import os
+import threading
+from opendm.concurrency import parallel_map
+
+# Held by the test process while process workers run
+held_lock = threading.Lock()
+
+def _acquire_held_lock():
+    acquired = held_lock.acquire(timeout=5)
+    if acquired:
+        held_lock.release()
+    return acquired
+
+class TestConcurrency(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_results_order(self):
+        self.assertEqual(parallel_map(lambda x: x * 2, range(20), max_workers=4), [x * 2 for x in range(20)])
+        self.assertEqual(parallel_map(lambda x: x * 2, range(20), max_workers=1), [x * 2 for x in range(20)])
+        self.assertEqual(parallel_map(lambda x: x, [], max_workers=4), [])
+
+    def test_processes(self):
+        offset = 10
+        def worker(x):
+            return (x + offset, os.getpid())
+        
+        results = parallel_map(worker, range(8), max_workers=2, use_processes=True)
+        self.assertEqual([r[0] for r in results], [x + offset for x in range(8)])
+        self.assertTrue(os.getpid() not in [r[1] for r in results])
+
+    def test_processes_not_forked(self):
+        # A forked worker would inherit the lock in its acquired state
+        def worker(x):
+            return _acquire_held_lock()
+        
+        with held_lock:
+            results = parallel_map(worker, range(2), max_workers=2, use_processes=True)
+        self.assertEqual(results, [True, True])
+
+    def test_errors(self):
+        def fail_on_three(x):
+            if x == 3:
+                raise ValueError("three")
+            return x
+        
+        self.assertRaises(ValueError, parallel_map, fail_on_three, range(8), max_workers=4, single_thread_fallback=False)
+        self.assertRaises(ValueError, parallel_map, fail_on_three, range(8), max_workers=4, use_processes=True, single_thread_fallback=False)
+
+        # Only the failed task is retried
+        calls = []
+        lock = threading.Lock()
+        attempts = {'count': 0}
+        def fail_once(x):
+            with lock:
+                calls.append(x)
+                if x == 5 and attempts['count'] == 0:
+                    attempts['count'] += 1
+                    raise MemoryError()
+            return x
+        
+        self.assertEqual(parallel_map(fail_once, range(8), max_workers=4), list(range(8)))
+        self.assertEqual(sorted(calls), sorted(list(range(8)) + [5]))
+    
+    def test_memory_estimate(self):
+        running = {'now': 0, 'max': 0}
+        lock = threading.Lock()
+        def worker(x):
+            with lock:
+                running['now'] += 1
+                running['max'] = max(running['max'], running['now'])
+            for i in range(10000):
+                pass
+            with lock:
+                running['now'] -= 1
+            return x
+
+        # Each task needs more memory than what's available, 
+        # so they must run one at a time
+        self.assertEqual(parallel_map(worker, range(10), max_workers=4, memory_estimate=1024 * 1024 * 1024), list(range(10)))
+        self.assertEqual(running['max'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
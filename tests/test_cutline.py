@@ -0,0 +1,63 @@
+import unittest
+import os
+import shutil
+import numpy as np
+import rasterio
+import fiona
+from rasterio.transform import from_origin
+from shapely.geometry import box, mapping, shape
+
+from opendm import cutline
+from opendm.cutline import compute_cutline
+
+class TestCutline(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists("tests/assets/output"):
+            shutil.rmtree("tests/assets/output")
+        os.makedirs("tests/assets/output")
+
+    def test_compute_cutline(self):
+        np.random.seed(5)
+        size = 512
+        arr = np.zeros((size, size), dtype=np.uint8)
+        for i in range(60):
+            x, y, r = np.random.randint(0, size, 2).tolist() + [np.random.randint(5, 30)]
+            arr[max(0, y - r):y + r, max(0, x - r):x + r] = np.random.randint(50, 255)
+
+        ortho = "tests/assets/output/ortho.tif"
+        with rasterio.open(ortho, 'w', driver='GTiff', width=size, height=size, count=1, dtype='uint8', 
+                           crs='EPSG:32615', transform=from_origin(500000, 4000000 + size, 1, 1)) as f:
+            f.write(arr, 1)
+
+        crop_area = "tests/assets/output/crop.gpkg"
+        meta = {'crs': {'init': 'epsg:32615'}, 'driver': 'GPKG', 'schema': {'properties': {}, 'geometry': 'Polygon'}}
+        with fiona.open(crop_area, 'w', **meta) as sink:
+            sink.write({'geometry': mapping(box(500005, 4000005, 500000 + size - 5, 4000000 + size - 5)), 'properties': {}})
+
+        cutlines = []
+        for max_concurrency in [1, 3]:
+            cutline_file = "tests/assets/output/cutline_%s.gpkg" % max_concurrency
+            compute_cutline(ortho, crop_area, cutline_file, max_concurrency)
+
+            with fiona.open(cutline_file, 'r') as f:
+                cutlines.append(shape(next(iter(f))['geometry']))
+
+            # Temporary cost maps are removed
+            self.assertFalse(any([p.endswith("_cost.bin") for p in os.listdir("tests/assets/output")]))
+        
+        self.assertTrue(cutlines[0].area > 0)
+        self.assertTrue(cutlines[0].equals(cutlines[1]))
+
+        # Also when routing fails
+        parallel_map = cutline.concurrency.parallel_map
+        def fail(*args, **kwargs):
+            raise MemoryError("Out of memory")
+        cutline.concurrency.parallel_map = fail
+        try:
+            self.assertRaises(MemoryError, compute_cutline, ortho, crop_area, "tests/assets/output/cutline_failed.gpkg", 3)
+        finally:
+            cutline.concurrency.parallel_map = parallel_map
+        self.assertFalse(any([p.endswith("_cost.bin") for p in os.listdir("tests/assets/output")]))
+
+if __name__ == '__main__':
+    unittest.main()
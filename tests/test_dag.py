@@ -0,0 +1,83 @@
+import unittest
+import threading
+import time
+from opendm.dag import TaskGraph
+
+class TestDag(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_dependencies(self):
+        order = []
+        lock = threading.Lock()
+        def task(name):
+            def run():
+                time.sleep(0.01)
+                with lock:
+                    order.append(name)
+            return run
+
+        g = TaskGraph(4)
+        g.add("a", task("a"))
+        g.add("b", task("b"), depends_on=["a"])
+        g.add("c", task("c"), depends_on=["a"])
+        g.add("d", task("d"), depends_on=["b", "c"])
+        g.run()
+
+        self.assertEqual(order[0], "a")
+        self.assertEqual(sorted(order[1:3]), ["b", "c"])
+        self.assertEqual(order[3], "d")
+
+        self.assertRaises(ValueError, g.add, "a", task("a"))
+        self.assertRaises(ValueError, g.add, "e", task("e"), depends_on=["nonexistent"])
+
+    def test_concurrency(self):
+        class nonloc:
+            running = 0
+            max_running = 0
+        lock = threading.Lock()
+
+        def task():
+            with lock:
+                nonloc.running += 1
+                nonloc.max_running = max(nonloc.max_running, nonloc.running)
+            time.sleep(0.05)
+            with lock:
+                nonloc.running -= 1
+        
+        # Independent tasks run at the same time
+        g = TaskGraph(4)
+        for i in range(4):
+            g.add(str(i), task)
+        g.run()
+        self.assertEqual(nonloc.max_running, 4)
+
+        # CPU budget
+        nonloc.max_running = 0
+        g = TaskGraph(4)
+        for i in range(4):
+            g.add(str(i), task, cpus=2)
+        g.run()
+        self.assertEqual(nonloc.max_running, 2)
+
+        # Memory budget
+        nonloc.max_running = 0
+        g = TaskGraph(4, max_memory=100)
+        for i in range(4):
+            g.add(str(i), task, memory=60)
+        g.run()
+        self.assertEqual(nonloc.max_running, 1)
+
+    def test_errors(self):
+        ran = []
+        def fail():
+            raise RuntimeError("failed")
+
+        g = TaskGraph(2)
+        g.add("a", fail)
+        g.add("b", lambda: ran.append("b"), depends_on=["a"])
+        self.assertRaises(RuntimeError, g.run)
+        self.assertEqual(ran, [])
+
+if __name__ == '__main__':
+    unittest.main()
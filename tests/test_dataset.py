@@ -0,0 +1,109 @@
+import unittest
+import os
+import shutil
+import json
+import time
+import random
+
+from opendm import log
+from opendm import types
+from opendm.photo import ODM_Photo
+from stages.dataset import save_images_database, load_images_database
+
+def synthetic_photo(i):
+    p = ODM_Photo.__new__(ODM_Photo)
+    p.filename = "IMG_%06d_%s.tif" % (i // 5, i % 5 + 1)
+    p.mask = None
+    p.width = 1280
+    p.height = 960
+    p.camera_make = 'MicaSense'
+    p.camera_model = 'Altum'
+    p.latitude = 46.84 + i * 1e-6
+    p.longitude = -91.99 - i * 1e-6
+    p.altitude = 198.5
+    p.band_name = ['Blue', 'Green', 'Red', 'NIR', 'RedEdge'][i % 5]
+    p.band_index = i % 5
+    p.capture_uuid = "uuid-%s" % (i // 5)
+    p.black_level = [4800, 4800, 4800, 4800]
+    p.vignetting_polynomial = [-0.0001, 0.000001, -0.00000001]
+    p.irradiance_scale_to_si = None
+    p.focal_ratio = 0.7136
+    p.is_test = True
+    return p
+
+def save_columns(photos, database_file):
+    # Column oriented layout (one array per field), the alternative
+    # to images.json measured by the benchmark
+    fields = list(photos[0].__dict__.keys())
+    with open(database_file, 'w') as f:
+        f.write(json.dumps({k: [p.__dict__.get(k) for p in photos] for k in fields}))
+
+def load_columns(database_file):
+    with open(database_file, 'r') as f:
+        columns = json.load(f)
+
+    result = []
+    fields = list(columns.keys())
+    for values in zip(*columns.values()):
+        p = ODM_Photo.__new__(ODM_Photo)
+        p.__dict__ = dict(zip(fields, values))
+        result.append(p)
+    return result
+
+class TestDataset(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists("tests/assets/output"):
+            shutil.rmtree("tests/assets/output")
+        os.makedirs("tests/assets/output")
+
+    def test_images_database(self):
+        photos = [synthetic_photo(i) for i in range(10)]
+        database_file = "tests/assets/output/images.json"
+        save_images_database(photos, database_file)
+
+        loaded = load_images_database(database_file)
+        self.assertEqual(len(loaded), 10)
+        for a, b in zip(photos, loaded):
+            self.assertTrue(isinstance(b, ODM_Photo))
+            self.assertEqual(a.__dict__, b.__dict__)
+
+    @unittest.skipUnless(os.environ.get('ODM_BENCHMARK'), "set ODM_BENCHMARK=1 to run benchmarks")
+    def test_images_database_benchmark(self):
+        n = 50000
+        photos = [synthetic_photo(i) for i in range(n)]
+        json_file = "tests/assets/output/images.json"
+        columns_file = "tests/assets/output/images_columns.json"
+
+        save_images_database(photos, json_file)
+        save_columns(photos, columns_file)
+
+        start = time.time()
+        self.assertEqual(len(load_images_database(json_file)), n)
+        json_load_time = time.time() - start
+
+        start = time.time()
+        self.assertEqual(len(load_columns(columns_file)), n)
+        columns_load_time = time.time() - start
+
+        # Lookup cost, linear scan vs. index
+        recon = types.ODM_Reconstruction(photos)
+        lookups = [random.choice(photos).filename for i in range(200)]
+
+        start = time.time()
+        for filename in lookups:
+            next(p for p in recon.photos if p.filename == filename)
+        scan_time = (time.time() - start) / len(lookups)
+
+        start = time.time()
+        for filename in lookups:
+            self.assertEqual(recon.get_photo(filename).filename, filename)
+        index_time = (time.time() - start) / len(lookups)
+
+        log.ODM_INFO("%s photos: images.json %.3fs (%s bytes), column layout %.3fs (%s bytes)" %
+                     (n, json_load_time, os.path.getsize(json_file), columns_load_time, os.path.getsize(columns_file)))
+        log.ODM_INFO("get_photo: linear scan %.6fs/call, index %.8fs/call" % (scan_time, index_time))
+
+        self.assertTrue(index_time < scan_time)
+
+if __name__ == '__main__':
+    unittest.main()
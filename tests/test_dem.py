@@ -0,0 +1,187 @@
+import unittest
+import os
+import shutil
+import numpy as np
+import laspy
+import rasterio
+from rasterio.transform import from_origin
+from scipy import ndimage
+
+from opendm.dem import commands, grid, pdal
+from opendm.dem import merge
+from opendm.dem.merge import euclidean_merge_dems
+
+def write_point_cloud(filename, n=2000):
+    np.random.seed(2)
+    header = laspy.LasHeader(point_format=3, version="1.2")
+    header.scales = [0.001, 0.001, 0.001]
+    header.offsets = [0, 0, 0]
+    las = laspy.LasData(header)
+    las.x = np.random.rand(n) * 30 + 1000
+    las.y = np.random.rand(n) * 20 + 2000
+    las.z = np.random.rand(n) * 10
+    las.classification = np.where(np.arange(n) % 3 == 0, 2, 1).astype(np.uint8)
+    las.write(filename)
+    return las
+
+def bounds_of(las):
+    return {'minx': las.x.min(), 'maxx': las.x.max(), 'miny': las.y.min(), 'maxy': las.y.max()}
+
+def reference_grid(las, output_type, radius, resolution, bounds, classification=None, decimation=None):
+    """ Brute force gridding, one cell at a time """
+    x, y, z = np.asarray(las.x), np.asarray(las.y), np.asarray(las.z)
+    keep = np.ones(len(x), dtype=bool)
+    if decimation is not None:
+        keep &= np.arange(len(x)) % decimation == 0
+    if classification is not None:
+        keep &= np.asarray(las.classification) == classification
+    x, y, z = x[keep] - bounds['minx'], y[keep] - bounds['miny'], z[keep]
+
+    width, height = grid.grid_size(bounds, resolution)
+    out = np.full((height, width), grid.NODATA, dtype=np.float64)
+    for j in range(height):
+        for i in range(width):
+            d = np.hypot(x - (i + 0.5) * resolution, y - (j + 0.5) * resolution)
+            m = d < radius
+            if not np.any(m):
+                continue
+            if output_type == 'max':
+                v = z[m].max()
+            elif output_type == 'mean':
+                v = z[m].mean()
+            elif output_type == 'idw':
+                dm, zm = d[m], z[m]
+                v = zm[dm == 0][-1] if np.any(dm == 0) else np.sum(zm / dm) / np.sum(1.0 / dm)
+            out[height - 1 - j, i] = v
+    return out.astype(np.float32)
+
+class TestDem(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists("tests/assets/output"):
+            shutil.rmtree("tests/assets/output")
+        os.makedirs("tests/assets/output")
+
+    def test_median_smoothing(self):
+        nodata = -9999.0
+        np.random.seed(1)
+        arr = np.random.rand(700, 1000).astype(np.float32) * 100
+        arr[100:150, 200:260] = nodata
+        arr[:, 990:] = nodata
+
+        dem = "tests/assets/output/dem.tif"
+        with rasterio.open(dem, 'w', driver='GTiff', width=arr.shape[1], height=arr.shape[0], count=1,
+                           dtype='float32', nodata=nodata, transform=from_origin(0, 700, 1, 1),
+                           tiled=True, blockxsize=256, blockysize=256, compress='deflate') as f:
+            f.write(arr, 1)
+
+        # Reference: filter the entire raster in memory
+        expected = arr
+        for i in range(2):
+            nodata_locs = expected == nodata
+            expected = ndimage.median_filter(expected, size=9, output='float32', mode='nearest')
+            expected[nodata_locs] = nodata
+
+        smoothed = "tests/assets/output/dem.smoothed.tif"
+        commands.median_smoothing(dem, smoothed, smoothing_iterations=2, window_size=128, num_workers=4)
+
+        with rasterio.open(smoothed) as f:
+            self.assertEqual(f.nodatavals[0], nodata)
+            self.assertTrue(np.array_equal(f.read(1), expected))
+        
+
+        # Intermediate iterations are removed
+        self.assertEqual(sorted(os.listdir("tests/assets/output")), ["dem.smoothed.tif", "dem.tif"])
+
+    def test_grid(self):
+        las = write_point_cloud("tests/assets/output/points.laz")
+        bounds = bounds_of(las)
+        output = "tests/assets/output/grid.tif"
+
+        for output_type in ['max', 'mean', 'idw']:
+            for classification, decimation in [(None, None), (2, 2)]:
+                grid.create_grid("tests/assets/output/points.laz", output, output_type, ['0.6'], 0.5, bounds,
+                                classification=classification, decimation=decimation)
+                expected = reference_grid(las, output_type, 0.6, 0.5, bounds, classification, decimation)
+                with rasterio.open(output) as f:
+                    self.assertEqual(f.transform.c, bounds['minx'])
+                    self.assertTrue(np.allclose(f.read(1), expected, rtol=0, atol=1e-4))
+
+        # Multiple radiuses, smallest radius wins
+        grid.create_grid("tests/assets/output/points.laz", output, 'max', ['1.2', '0.3'], 0.5, bounds)
+        small = reference_grid(las, 'max', 0.3, 0.5, bounds)
+        large = reference_grid(las, 'max', 1.2, 0.5, bounds)
+        expected = np.where(small == grid.NODATA, large, small)
+        with rasterio.open(output) as f:
+            self.assertTrue(np.allclose(f.read(1), expected, rtol=0, atol=1e-4))
+
+        # Multiple bands of rows
+        grid.create_grid("tests/assets/output/points.laz", output, 'max', ['0.6'], 0.05, bounds, max_memory_mb=0.1)
+        with rasterio.open(output) as f:
+            banded = f.read(1)
+        grid.create_grid("tests/assets/output/points.laz", output, 'max', ['0.6'], 0.05, bounds)
+        with rasterio.open(output) as f:
+            self.assertTrue(np.array_equal(f.read(1), banded))
+
+    def test_euclidean_merge_dems(self):
+        np.random.seed(4)
+        size = 300
+        mosaic = np.full((size * 2, size * 2), -9999, dtype=np.float32)
+        dems = []
+
+        # 2x2 non overlapping DEMs, with some nodata
+        for ty in range(2):
+            for tx in range(2):
+                arr = (np.random.rand(size, size) * 10 + 100).astype(np.float32)
+                arr[:20, :] = -9999
+                mosaic[ty * size:(ty + 1) * size, tx * size:(tx + 1) * size] = arr
+
+                profile = dict(driver='GTiff', width=size, height=size, count=1, dtype='float32', nodata=-9999,
+                               transform=from_origin(tx * size, size * 2 - ty * size, 1, 1))
+                dem = "tests/assets/output/dsm_%s_%s.tif" % (tx, ty)
+                with rasterio.open(dem, 'w', **profile) as f:
+                    f.write(arr, 1)
+
+                profile['nodata'] = None
+                with rasterio.open("tests/assets/output/dsm_%s_%s.euclideand.tif" % (tx, ty), 'w', **profile) as f:
+                    f.write(ndimage.distance_transform_edt(arr != -9999).astype(np.float32), 1)
+                dems.append(dem)
+
+        euclidean_merge_dems(dems, "tests/assets/output/merged.tif", {'BLOCKXSIZE': 256, 'BLOCKYSIZE': 256})
+        euclidean_merge_dems(dems, "tests/assets/output/merged_parallel.tif", {'BLOCKXSIZE': 256, 'BLOCKYSIZE': 256}, max_workers=3)
+
+        # Low open files limit, sources are closed and reopened as needed
+        max_open_files = merge.max_open_files
+        merge.max_open_files = lambda: 4
+        try:
+            euclidean_merge_dems(dems, "tests/assets/output/merged_few_files.tif", {'BLOCKXSIZE': 256, 'BLOCKYSIZE': 256}, max_workers=3)
+        finally:
+            merge.max_open_files = max_open_files
+
+        with rasterio.open("tests/assets/output/merged.tif") as a, rasterio.open("tests/assets/output/merged_parallel.tif") as b, \
+             rasterio.open("tests/assets/output/merged_few_files.tif") as c:
+            merged = a.read(1)
+            self.assertTrue(np.allclose(merged, mosaic))
+            self.assertTrue(np.array_equal(merged, b.read(1)))
+            self.assertTrue(np.array_equal(merged, c.read(1)))
+
+    @unittest.skipUnless(shutil.which('pdal'), "pdal is not available")
+    def test_grid_pdal(self):
+        las = write_point_cloud("tests/assets/output/points.laz")
+        bounds = bounds_of(las)
+
+        for output_type in ['max', 'idw']:
+            pdal_output = "tests/assets/output/pdal.tif"
+            d = pdal.json_gdal_base(pdal_output, output_type, 0.6, 0.5, bounds)
+            pdal.json_add_readers(d, ["tests/assets/output/points.laz"])
+            pdal.run_pipeline(d)
+
+            output = "tests/assets/output/grid.tif"
+            grid.create_grid("tests/assets/output/points.laz", output, output_type, ['0.6'], 0.5, bounds)
+
+            with rasterio.open(pdal_output) as a, rasterio.open(output) as b:
+                self.assertEqual(a.shape, b.shape)
+                self.assertTrue(np.allclose(a.transform, b.transform))
+                self.assertTrue(np.allclose(a.read(1), b.read(1), rtol=0, atol=1e-4))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+import os
+import shutil
+import time
+
+from opendm.fingerprint import Fingerprint
+
+class TestFingerprint(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists("tests/assets/output"):
+            shutil.rmtree("tests/assets/output")
+        os.makedirs("tests/assets/output")
+
+    def write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def test_fingerprint(self):
+        input_file = "tests/assets/output/input.txt"
+        output_file = "tests/assets/output/output.txt"
+        self.write(input_file, "input")
+
+        fp = Fingerprint(output_file, {'resolution': 5}, [input_file])
+        self.assertFalse(fp.matches())
+
+        self.write(output_file, "output")
+        fp.save()
+        self.assertTrue(Fingerprint(output_file, {'resolution': 5}, [input_file]).matches())
+
+        # Parameters changed
+        self.assertFalse(Fingerprint(output_file, {'resolution': 10}, [input_file]).matches())
+
+        # Input changed
+        time.sleep(0.01)
+        self.write(input_file, "modified input")
+        self.assertFalse(Fingerprint(output_file, {'resolution': 5}, [input_file]).matches())
+
+        # Input removed (e.g. --optimize-disk-space)
+        os.remove(input_file)
+        self.assertTrue(Fingerprint(output_file, {'resolution': 5}, [input_file]).matches())
+
+        # Incomplete output
+        fp.invalidate()
+        self.assertFalse(Fingerprint(output_file, {'resolution': 5}, [input_file]).matches())
+
+    def test_legacy_output(self):
+        output_file = "tests/assets/output/output.txt"
+        self.write(output_file, "output")
+
+        # Outputs without a fingerprint are regenerated
+        self.assertFalse(Fingerprint(output_file, {'resolution': 5}).matches())
+        self.assertFalse(os.path.isfile(os.path.join("tests/assets/output", ".output.txt.fingerprint")))
+
+if __name__ == '__main__':
+    unittest.main()
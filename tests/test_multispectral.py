@@ -0,0 +1,117 @@
+import unittest
+import os
+import shutil
+import numpy as np
+
+from opendm import multispectral
+
+class PhotoMock:
+    filename = "IMG_0001_1.tif"
+    width = 64
+    height = 48
+    camera_make = "MicaSense"
+    exposure_time = 0.002
+    gain_adjustment = 1.1
+    vignetting_center = "30.5 25.2"
+    vignetting_polynomial = "-1e-4 2e-7 -1e-10"
+
+    def is_thermal(self):
+        return False
+
+    def get_radiometric_calibration(self):
+        return [2.5e-4, 1e-5, 5e-5]
+
+    def get_dark_level(self):
+        return 4800.0
+
+    def get_gain(self):
+        return 2.0
+
+    def get_photometric_exposure(self):
+        return None
+
+    def get_bit_depth_max(self):
+        return 65536.0
+
+    def get_vignetting_center(self):
+        return list(map(float, self.vignetting_center.split(" ")))
+
+    def get_vignetting_polynomial(self):
+        coeffs = list(map(float, self.vignetting_polynomial.split(" ")))
+        coeffs.reverse()
+        return coeffs
+
+class TestMultispectral(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists("tests/assets/output"):
+            shutil.rmtree("tests/assets/output")
+        os.makedirs("tests/assets/output")
+        multispectral.vignette_cache.clear()
+
+    def test_dn_to_radiance(self):
+        photo = PhotoMock()
+        np.random.seed(9)
+        image = np.random.randint(4000, 30000, size=(photo.height, photo.width, 1)).astype(np.uint16)
+
+        # Reference, step by step
+        a1, a2, a3 = photo.get_radiometric_calibration()
+        x, y = np.meshgrid(np.arange(photo.width), np.arange(photo.height))
+        r = np.hypot(x - 30.5, y - 25.2)
+        V = 1.0 / np.polyval(np.array(photo.get_vignetting_polynomial() + [1.0]), r)
+        R = 1.0 / (1.0 + a2 * y / photo.exposure_time - a3 * y)
+        expected = (image[:,:,0].astype(np.float64) - 4800.0) / 65536.0 * V * R
+        expected[expected < 0] = 0
+        expected = expected / (2.0 * photo.exposure_time) * a1 * 1.1
+
+        radiance = multispectral.dn_to_radiance(photo, image, cache_dir="tests/assets/output/vignetting")
+        self.assertEqual(radiance.dtype, np.float32)
+        self.assertTrue(np.allclose(radiance[:,:,0], expected, rtol=1e-5))
+
+        # Maps are computed once per calibration
+        self.assertEqual(len(multispectral.vignette_cache), 1)
+        self.assertTrue(multispectral.vignette_map(photo) is multispectral.vignette_map(PhotoMock()))
+        self.assertEqual(len(os.listdir("tests/assets/output/vignetting")), 1)
+
+        # And reused from disk
+        multispectral.vignette_cache.clear()
+        v = multispectral.vignette_map(photo, "tests/assets/output/vignetting")
+        self.assertTrue(np.allclose(v, V, rtol=1e-6))
+
+        photo.vignetting_center = "10 10"
+        self.assertFalse(np.allclose(multispectral.vignette_map(photo), V))
+        self.assertEqual(len(multispectral.vignette_cache), 2)
+
+    def test_alignment(self):
+        # Every prefix is spread over the whole range
+        order = multispectral.stratified_order(100)
+        self.assertEqual(sorted(order), list(range(100)))
+        self.assertEqual(order[:4], [0, 50, 25, 75])
+        self.assertEqual(multispectral.stratified_order(1), [0])
+
+        # Outliers don't affect the choice of matrix
+        np.random.seed(10)
+        matrices = []
+        for i in range(9):
+            m = np.eye(3)
+            m[0,2] = 5 + np.random.rand()
+            m[1,2] = -3 + np.random.rand()
+            matrices.append({'warp_matrix': m, 'dimension': (64, 48), 'algo': 'ecc'})
+        outlier = np.eye(3)
+        outlier[0,0] = 2.0
+        matrices.insert(3, {'warp_matrix': outlier, 'dimension': (64, 48), 'algo': 'features'})
+        best = multispectral.best_alignment_matrix(matrices)
+        self.assertTrue(best['warp_matrix'][0,0] == 1.0)
+        self.assertTrue(multispectral.warp_distance(best, matrices[0]) < 2)
+
+        # Remap is equivalent to warpPerspective
+        import cv2
+        image = np.random.randint(0, 65535, size=(48, 64)).astype(np.uint16)
+        m = np.array([[1.01, 0.02, 3.5], [-0.01, 0.99, -2.25], [1e-5, -2e-5, 1.0]])
+        aligned = multispectral.align_image(image, m, (64, 48))
+        expected = cv2.warpPerspective(image, m, (64, 48))
+        self.assertTrue(np.abs(aligned.astype(np.float64) - expected).max() <= 1)
+        self.assertTrue(multispectral.align_image(image, m, (64, 48)) is not aligned)
+        self.assertEqual(len(multispectral.warp_maps_cache), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+import os
+import shutil
+import threading
+import argparse
+
+from opendm import types
+from stages import mvstex
+
+class ReconstructionMock:
+    photos = []
+    multi_camera = [{'name': 'RGB'}, {'name': 'NIR'}]
+
+    def get_proj_offset(self):
+        return (0, 0)
+
+class TestMvsTex(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists("tests/assets/output"):
+            shutil.rmtree("tests/assets/output")
+        os.makedirs("tests/assets/output")
+
+    def test_multispectral_run_graph(self):
+        args = argparse.Namespace(skip_3dmodel=True, use_3dmesh=False, primary_band='auto',
+                                  texturing_skip_global_seam_leveling=False, texturing_skip_local_seam_leveling=False,
+                                  texturing_keep_unseen_faces=False, texturing_single_material=True, gltf=False,
+                                  optimize_disk_space=False, max_concurrency=8,
+                                  rerun=None, rerun_all=False, rerun_from=None)
+        tree = types.ODM_Tree("tests/assets/output")
+        stage = mvstex.ODMMvsTexStage('mvs_texturing', args, progress=70.0, max_concurrency=4, memory_share=0.5)
+
+        events = []
+        threads = []
+        lock = threading.Lock()
+        secondary_started = threading.Event()
+        budgets = []
+
+        class TaskGraph(mvstex.TaskGraph):
+            def __init__(self, max_cpus, max_memory=None):
+                budgets.append((max_cpus, max_memory))
+
+                # Only dependencies decide the order
+                super().__init__(1000)
+
+        def run(cmd, env_vars={}):
+            out_dir = os.path.dirname(cmd.split('"')[7])
+            with open(os.path.join(out_dir, tree.odm_textured_model_obj), 'w') as f:
+                f.write("")
+            with lock:
+                events.append(('texture', os.path.basename(out_dir)))
+                threads.append(env_vars['OMP_NUM_THREADS'])
+            if out_dir.endswith("nir"):
+                secondary_started.set()
+
+        def obj_pack(obj_file, packed_dir, _info=None):
+            # Give a secondary band that does not wait for packing a chance to start
+            secondary_started.wait(1)
+            os.makedirs(packed_dir)
+            with open(os.path.join(packed_dir, "odm_textured_model_geo.obj"), 'w') as f:
+                f.write("")
+            with lock:
+                events.append(('pack', os.path.basename(os.path.dirname(obj_file))))
+
+        system_run, mvstex_obj_pack, find_largest_photo_dim, task_graph, get_max_memory_mb = \
+            mvstex.system.run, mvstex.obj_pack, mvstex.find_largest_photo_dim, mvstex.TaskGraph, mvstex.get_max_memory_mb
+        try:
+            mvstex.system.run = run
+            mvstex.obj_pack = obj_pack
+            mvstex.find_largest_photo_dim = lambda photos: 4000
+            mvstex.TaskGraph = TaskGraph
+            mvstex.get_max_memory_mb = lambda: 1000
+            stage.process(args, {'tree': tree, 'reconstruction': ReconstructionMock()})
+        finally:
+            mvstex.system.run, mvstex.obj_pack, mvstex.find_largest_photo_dim, mvstex.TaskGraph, mvstex.get_max_memory_mb = \
+                system_run, mvstex_obj_pack, find_largest_photo_dim, task_graph, get_max_memory_mb
+
+        # The secondary band is textured with the labeling file of the primary band,
+        # only after the primary band has been packed
+        self.assertEqual(events, [('texture', 'odm_texturing_25d'),
+                                  ('pack', 'odm_texturing_25d'),
+                                  ('texture', 'nir')])
+
+        # Tools use the stage's budget
+        self.assertEqual(budgets, [(4, 500)])
+        self.assertEqual(threads, [4, 4])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+import os
+import shutil
+import numpy as np
+
+from opendm import objio
+
+OBJ = """mtllib model.mtl
+v 0.5 1.25 -3
+v 10 20 30
+v -1.5 2 3.75
+v 4 5 6
+vt 0 0
+vt 1 0
+vt 0.5 1
+vt 0.25 0.75
+vn 0 0 1
+vn 0 1 0
+f 1/1/1 2/2/1 3/3/2
+usemtl material0000
+f 2/2/1 3/3/1 4/4/2
+f 1/1/1 3/3/1 4/4/1
+usemtl material0001
+f 4/4/2 2/2/2 1/1/2
+usemtl material0000
+f 3/3/1 1/1/1 2/2/1
+"""
+
+class TestObjIO(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists("tests/assets/output"):
+            shutil.rmtree("tests/assets/output")
+        os.makedirs("tests/assets/output")
+
+        self.obj_file = "tests/assets/output/model.obj"
+        with open(self.obj_file, "w") as f:
+            f.write(OBJ)
+
+    def test_read_obj(self):
+        obj = objio.read_obj(self.obj_file)
+        self.assertEqual(obj['mtllibs'], ['model.mtl'])
+        self.assertEqual(obj['face_format'], ('v', 'vt', 'vn'))
+        self.assertTrue(np.array_equal(obj['vertices'], [[0.5, 1.25, -3], [10, 20, 30], [-1.5, 2, 3.75], [4, 5, 6]]))
+        self.assertTrue(np.array_equal(obj['uvs'][3], [0.25, 0.75]))
+        self.assertEqual(obj['normals'].shape, (2, 3))
+
+        # Faces are grouped by material, in order of appearance
+        self.assertEqual(list(obj['faces'].keys()), ['_', 'material0000', 'material0001'])
+        self.assertTrue(np.array_equal(obj['faces']['material0000'][:,:,0], [[1, 2, 3], [0, 2, 3], [2, 0, 1]]))
+        self.assertTrue(np.array_equal(obj['faces']['material0001'][0], [[3, 3, 1], [1, 1, 1], [0, 0, 1]]))
+        self.assertTrue(np.array_equal(obj['face_ids']['material0000'], [1, 2, 4]))
+
+        # Same results when reading in small chunks
+        chunked = objio.read_obj(self.obj_file, chunk_size=16)
+        for k in ['vertices', 'uvs', 'normals']:
+            self.assertTrue(np.array_equal(obj[k], chunked[k]))
+        for k in obj['faces']:
+            self.assertTrue(np.array_equal(obj['faces'][k], chunked['faces'][k]))
+
+        self.assertEqual(len(objio.read_obj(self.obj_file, elements=('v', ))['uvs']), 0)
+
+    def test_rewrite_obj(self):
+        output = "tests/assets/output/rewritten.obj"
+        vertices = np.arange(12, dtype=np.float64).reshape((4, 3)) / 3.0
+        uvs = np.full((4, 2), np.nan)
+        uvs[1] = [0.125, 0.1]
+
+        def replace_line(line):
+            if line.startswith("usemtl"):
+                return "# \n"
+
+        objio.rewrite_obj(self.obj_file, output, vertices=vertices, uvs=uvs, replace_line=replace_line, chunk_size=32)
+
+        with open(output) as f:
+            lines = f.read().split("\n")
+        expected = OBJ.split("\n")
+        self.assertEqual(lines[1], "v 0.0 %r %r" % (1 / 3.0, 2 / 3.0))
+        self.assertEqual(lines[5], "vt 0 0")
+        self.assertEqual(lines[6], "vt 0.125 0.1")
+        self.assertEqual(lines[12:], [("# " if l.startswith("usemtl") else l) for l in expected[12:]])
+
+        obj = objio.read_obj(output)
+        self.assertTrue(np.array_equal(obj['vertices'], vertices))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+import os
+import re
+import shutil
+import threading
+import argparse
+
+from opendm import types
+from opendm import system
+from stages import openmvs
+
+class ReconstructionMock:
+    photos = [None] * 10
+
+class TestOpenMVS(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists("tests/assets/output"):
+            shutil.rmtree("tests/assets/output")
+        os.makedirs("tests/assets/output")
+
+    def test_estimate_fusion_memory(self):
+        scenes = []
+        for i, size in enumerate([1000, 3000]):
+            sf = "tests/assets/output/scene_%04d.mvs" % i
+            with open(sf, 'wb') as f:
+                f.write(b'\0' * size)
+            scenes.append(sf)
+
+        bytes_per_image = 1000 * 1000 * 0.75 * 40
+        estimates = openmvs.estimate_fusion_memory(scenes, 10, 1000)
+
+        # Images are split by scene file size (plus the shared borders)
+        self.assertAlmostEqual(estimates[scenes[0]], 256 + 5 * bytes_per_image / 1024 / 1024)
+        self.assertAlmostEqual(estimates[scenes[1]], 256 + 10 * bytes_per_image / 1024 / 1024)
+
+        # Never more than the number of images, never less than one
+        self.assertAlmostEqual(openmvs.estimate_fusion_memory(scenes[:1], 10, 1000)[scenes[0]], 256 + 10 * bytes_per_image / 1024 / 1024)
+        with open(scenes[1], 'wb') as f:
+            f.write(b'\0' * 1000000)
+        self.assertAlmostEqual(openmvs.estimate_fusion_memory(scenes, 10, 1000)[scenes[0]], 256 + bytes_per_image / 1024 / 1024)
+
+    def test_fusion_retries(self):
+        args = argparse.Namespace(max_concurrency=4, pc_tile=True, pc_skip_geometric=False, pc_filter=0,
+                                  optimize_disk_space=False, rerun=None, rerun_all=False, rerun_from=None)
+        tree = types.ODM_Tree("tests/assets/output")
+        os.makedirs(tree.openmvs)
+        with open(os.path.join(tree.openmvs, "scene.mvs"), 'w') as f:
+            f.write("")
+
+        stage = openmvs.ODMOpenMVSStage('openmvs', args, progress=60.0)
+
+        fusions = []
+        merged = []
+        lock = threading.Lock()
+
+        def run(cmd, env_vars={}):
+            if "--sub-scene-area" in cmd:
+                for i in range(3):
+                    with open(os.path.join(tree.openmvs, "scene_%04d.mvs" % i), 'w') as f:
+                        f.write("")
+                return
+
+            scene = re.search(r'(scene_\d{4})\.mvs', cmd)
+            if scene is None:
+                # Depthmap estimation
+                return
+
+            scene = scene.group(1)
+            with lock:
+                fusions.append((scene, int(re.search(r'--max-threads (\d+)', cmd).group(1))))
+
+            if scene == "scene_0000":
+                with open(os.path.join(tree.openmvs, "scene_0000_dense.ply"), 'w') as f:
+                    f.write("")
+            elif scene == "scene_0001":
+                raise system.SubprocessException("Killed", 137)
+            else:
+                raise system.SubprocessException("Failed", 1)
+
+        system_run, get_depthmap_resolution, has_gpu, get_max_memory_mb, fast_merge_ply = \
+            openmvs.system.run, openmvs.get_depthmap_resolution, openmvs.has_gpu, openmvs.get_max_memory_mb, openmvs.fast_merge_ply
+        try:
+            openmvs.system.run = run
+            openmvs.get_depthmap_resolution = lambda args, photos: 640
+            openmvs.has_gpu = lambda args: False
+            openmvs.get_max_memory_mb = lambda: 1024 * 1024
+            openmvs.fast_merge_ply = lambda files, output: merged.append(files)
+            stage.process(args, {'tree': tree, 'reconstruction': ReconstructionMock(), 'undist_image_max_size': 2000})
+        finally:
+            openmvs.system.run, openmvs.get_depthmap_resolution, openmvs.has_gpu, openmvs.get_max_memory_mb, openmvs.fast_merge_ply = \
+                system_run, get_depthmap_resolution, has_gpu, get_max_memory_mb, fast_merge_ply
+
+        # Scenes are first fused in parallel, splitting the threads.
+        # The scene that ran out of memory is retried alone with all threads,
+        # then skipped. Other failures are not retried
+        self.assertEqual(sorted(fusions[:3]), [("scene_0000", 1), ("scene_0001", 1), ("scene_0002", 1)])
+        self.assertEqual(fusions[3:], [("scene_0001", 4)])
+
+        # Only the fused scene is used
+        self.assertEqual(merged, [])
+        self.assertTrue(os.path.isfile(tree.openmvs_model))
+
+if __name__ == '__main__':
+    unittest.main()
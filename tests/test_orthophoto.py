@@ -0,0 +1,45 @@
+import unittest
+import os
+import shutil
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from opendm import orthophoto
+
+class TestOrthophoto(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists("tests/assets/output"):
+            shutil.rmtree("tests/assets/output")
+        os.makedirs("tests/assets/output")
+
+    def test_merge(self):
+        np.random.seed(3)
+        size = 300
+        mosaic = np.zeros((4, size * 3, size * 3), dtype=np.uint8)
+        inputs = []
+
+        # 3x3 non overlapping tiles, each block of the output
+        # intersects only some of them
+        for ty in range(3):
+            for tx in range(3):
+                arr = np.random.randint(1, 255, (4, size, size)).astype(np.uint8)
+                arr[3] = 255
+                mosaic[:, ty * size:(ty + 1) * size, tx * size:(tx + 1) * size] = arr
+
+                profile = dict(driver='GTiff', width=size, height=size, count=4, dtype='uint8', 
+                               transform=from_origin(tx * size, size * 3 - ty * size, 1, 1))
+                for prefix in ['ortho', 'cut']:
+                    with rasterio.open("tests/assets/output/%s_%s_%s.tif" % (prefix, tx, ty), 'w', **profile) as f:
+                        f.write(arr)
+                inputs.append(("tests/assets/output/ortho_%s_%s.tif" % (tx, ty), "tests/assets/output/cut_%s_%s.tif" % (tx, ty)))
+
+        output = "tests/assets/output/merged.tif"
+        orthophoto.merge(inputs, output, {'BLOCKXSIZE': 256, 'BLOCKYSIZE': 256}, max_workers=4)
+
+        with rasterio.open(output) as f:
+            self.assertEqual(f.shape, (size * 3, size * 3))
+            self.assertTrue(np.array_equal(f.read(), mosaic))
+
+if __name__ == '__main__':
+    unittest.main()
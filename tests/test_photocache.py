@@ -0,0 +1,137 @@
+import unittest
+import os
+import shutil
+import piexif
+from PIL import Image
+
+from opendm import photocache
+from opendm import cache
+
+class TestPhotoCache(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists("tests/assets/output"):
+            shutil.rmtree("tests/assets/output")
+        os.makedirs("tests/assets/output")
+
+        self.image = "tests/assets/output/DJI_0002.JPG"
+        self.write_image(self.image)
+        self.cache_dir = "tests/assets/output/cache/photos"
+
+    def write_image(self, path):
+        exif = piexif.dump({
+            "0th": {piexif.ImageIFD.Make: b"DJI", piexif.ImageIFD.Model: b"FC300S"},
+            "Exif": {piexif.ExifIFD.DateTimeOriginal: b"2023:01:06 18:56:48"},
+        })
+        Image.new("RGB", (64, 48), (120, 80, 40)).save(path, "JPEG", exif=exif)
+
+    def load(self):
+        return photocache.load_photos([self.image], cache_dir=self.cache_dir)[0]
+
+    def test_hit_and_miss(self):
+        c = photocache.PhotoCache(self.cache_dir)
+        key = c.key(self.image)
+        self.assertTrue(c.get(key, self.image) is None)
+
+        p = self.load()
+        cached = c.get(key, self.image)
+        self.assertTrue(cached is not None)
+        self.assertEqual(cached.filename, "DJI_0002.JPG")
+        self.assertEqual(cached.camera_make, "DJI")
+        self.assertEqual(cached.__dict__, p.__dict__)
+
+        # Missing files have no key
+        self.assertTrue(c.key("tests/assets/output/missing.JPG") is None)
+        self.assertTrue(c.get(None, self.image) is None)
+
+    def test_invalidation(self):
+        c = photocache.PhotoCache(self.cache_dir)
+        self.load()
+        key = c.key(self.image)
+        st = os.stat(self.image)
+
+        # Modification time
+        os.utime(self.image, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        self.assertNotEqual(c.key(self.image), key)
+        os.utime(self.image, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(c.key(self.image), key)
+
+        # Header contents, with the same size and modification time
+        with open(self.image, 'r+b') as f:
+            f.seek(100)
+            b = f.read(1)
+            f.seek(100)
+            f.write(bytes([(b[0] + 1) % 256]))
+        os.utime(self.image, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertNotEqual(c.key(self.image), key)
+        self.assertTrue(c.get(c.key(self.image), self.image) is None)
+
+        # Size
+        self.write_image(self.image)
+        with open(self.image, 'ab') as f:
+            f.write(b"\0")
+        self.assertNotEqual(c.key(self.image), key)
+
+    def test_cache_version(self):
+        c = photocache.PhotoCache(self.cache_dir)
+        self.load()
+        key = c.key(self.image)
+        self.assertTrue(c.get(key, self.image) is not None)
+
+        version = photocache.CACHE_VERSION
+        try:
+            photocache.CACHE_VERSION = version + 1
+            self.assertTrue(c.get(c.key(self.image), self.image) is None)
+        finally:
+            photocache.CACHE_VERSION = version
+
+    def test_read_only(self):
+        # Cannot create the cache directory
+        with open("tests/assets/output/cache", 'w') as f:
+            f.write("")
+
+        c = photocache.PhotoCache(self.cache_dir)
+        p = photocache.parse_photo(self.image)
+        c.put(c.key(self.image), p)
+        self.assertTrue(c.write_failed)
+        self.assertTrue(c.get(c.key(self.image), self.image) is None)
+
+        # Photos are still loaded
+        self.assertEqual(self.load().__dict__, p.__dict__)
+
+    def test_bad_entry(self):
+        c = photocache.PhotoCache(self.cache_dir)
+        p = photocache.parse_photo(self.image)
+        p.bad_field = object()
+        c.put("bad", p)
+        self.assertFalse(c.write_failed)
+
+        del p.bad_field
+        c.put(c.key(self.image), p)
+        self.assertTrue(c.get(c.key(self.image), self.image) is not None)
+
+    def test_prune(self):
+        for i in range(10):
+            entry = os.path.join(self.cache_dir, "%s.json" % i)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(entry, 'wb') as f:
+                f.write(b"\0" * 1024 * 200)
+            os.utime(entry, ns=(i * 1000000000, i * 1000000000))
+
+        self.assertEqual(cache.prune(self.cache_dir, 1), 5)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ["%s.json" % i for i in range(5, 10)])
+
+    def test_cache_dir(self):
+        env = os.environ.get('ODM_CACHE_DIR')
+        try:
+            os.environ.pop('ODM_CACHE_DIR', None)
+            self.assertEqual(photocache.default_cache_dir("/datasets/project"), os.path.join("/datasets/project", "cache", "photos"))
+            os.environ['ODM_CACHE_DIR'] = "/var/cache/odm"
+            self.assertEqual(photocache.default_cache_dir("/datasets/project"), os.path.join("/var/cache/odm", "photos"))
+        finally:
+            if env is None:
+                os.environ.pop('ODM_CACHE_DIR', None)
+            else:
+                os.environ['ODM_CACHE_DIR'] = env
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import unittest
+import os
+import shutil
+import numpy as np
+
+from opendm import point_cloud
+
+def write_ply(filename, vertices, properties=['x', 'y', 'z']):
+    header = "ply\nformat binary_little_endian 1.0\ncomment test\nelement vertex %s\n" % len(vertices)
+    header += "".join(["property float %s\n" % p for p in properties])
+    header += "end_header\n"
+    with open(filename, 'wb') as f:
+        f.write(header.encode('utf8'))
+        f.write(vertices.astype('<f4').tobytes())
+
+class TestPointCloud(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists("tests/assets/output"):
+            shutil.rmtree("tests/assets/output")
+        os.makedirs("tests/assets/output")
+
+    def test_fast_merge_ply(self):
+        np.random.seed(6)
+        parts = [np.random.rand(n, 3) for n in [1000, 1, 2500]]
+        inputs = []
+        for i, p in enumerate(parts):
+            inputs.append("tests/assets/output/part%s.ply" % i)
+            write_ply(inputs[-1], p)
+        
+        output = "tests/assets/output/merged.ply"
+        point_cloud.fast_merge_ply(inputs, output)
+
+        info = point_cloud.ply_info(output)
+        self.assertEqual(info['vertex_count'], 3501)
+        self.assertEqual(info['vertex_properties'], ['float x', 'float y', 'float z'])
+        with open(output, 'rb') as f:
+            f.seek(info['header_bytes'])
+            merged = np.frombuffer(f.read(), dtype='<f4').reshape((-1, 3))
+        self.assertTrue(np.array_equal(merged, np.vstack(parts).astype('<f4')))
+
+        # Copy in small chunks
+        with open(inputs[2], 'rb') as fin, open("tests/assets/output/copy.bin", 'wb') as fout:
+            point_cloud.copy_file_range(fin.fileno(), fout.fileno(), 10, 1000, chunk_size=7)
+        with open(inputs[2], 'rb') as f, open("tests/assets/output/copy.bin", 'rb') as c:
+            self.assertEqual(f.read()[10:1010], c.read())
+
+        # Vertex layouts must match
+        write_ply("tests/assets/output/normals.ply", np.random.rand(10, 6), ['x', 'y', 'z', 'nx', 'ny', 'nz'])
+        with self.assertRaises(IOError):
+            point_cloud.fast_merge_ply(inputs + ["tests/assets/output/normals.ply"], output)
+
+
+    def test_get_metadata(self):
+        np.random.seed(7)
+        vertices = (np.random.rand(5000, 3) * 100).astype('<f4')
+        ply = "tests/assets/output/cloud.ply"
+        write_ply(ply, vertices)
+
+        meta = point_cloud.get_metadata(ply, stats=True)
+        self.assertEqual(meta['count'], 5000)
+        self.assertAlmostEqual(meta['bounds']['minx'], vertices[:,0].min(), places=4)
+        self.assertAlmostEqual(meta['bounds']['maxz'], vertices[:,2].max(), places=4)
+        s = meta['statistic'][1]
+        self.assertEqual(s['name'], 'Y')
+        self.assertAlmostEqual(s['average'], vertices[:,1].astype(np.float64).mean(), places=6)
+        self.assertAlmostEqual(s['variance'], vertices[:,1].astype(np.float64).var(ddof=1), places=4)
+        self.assertTrue(os.path.isfile("tests/assets/output/.cloud.ply.meta.json"))
+        self.assertEqual(point_cloud.get_extent(ply), meta['bounds'])
+
+        import laspy
+        las = laspy.create(point_format=3, file_version="1.2")
+        las.header.scales = [0.001, 0.001, 0.001]
+        las.x, las.y, las.z = vertices[:,0], vertices[:,1], vertices[:,2]
+        las.write("tests/assets/output/cloud.las")
+
+        meta = point_cloud.get_metadata("tests/assets/output/cloud.las")
+        self.assertEqual(meta['count'], 5000)
+        self.assertFalse('statistic' in meta)
+        self.assertAlmostEqual(meta['bounds']['maxy'], vertices[:,1].max(), places=2)
+
+        meta = point_cloud.get_metadata("tests/assets/output/cloud.las", stats=True)
+        self.assertAlmostEqual(meta['statistic'][0]['minimum'], meta['bounds']['minx'])
+
+    def test_get_convex_hull(self):
+        from scipy.spatial import ConvexHull
+        np.random.seed(8)
+        vertices = (np.random.rand(10000, 3) * 100).astype('<f4')
+        ply = "tests/assets/output/cloud.ply"
+        write_ply(ply, vertices)
+
+        # Chunked computation matches the hull of all (decimated) points
+        expected = vertices[::7,:2].astype(np.float64)
+        expected = expected[ConvexHull(expected).vertices]
+        hull = point_cloud.get_convex_hull(ply, decimation=7, chunk_size=333)
+        self.assertEqual(sorted(map(tuple, hull)), sorted(map(tuple, expected)))
+
+        # Hexbin growth
+        grown = point_cloud.get_convex_hull(ply, decimation=7, hexbin_edge_size=1)
+        self.assertAlmostEqual(grown[:,0].min(), expected[:,0].min() - 1)
+        self.assertAlmostEqual(grown[:,0].max(), expected[:,0].max() + 1)
+
+    def test_ply_info_faces(self):
+        mesh = "tests/assets/output/mesh.ply"
+        with open(mesh, 'w') as f:
+            f.write("ply\nformat ascii 1.0\nelement vertex 3\nproperty float x\nproperty float y\nproperty float z\n"
+                    "element face 1\nproperty list uchar int vertex_indices\nend_header\n0 0 0\n1 0 0\n0 1 0\n3 0 1 2\n")
+
+        info = point_cloud.ply_info(mesh)
+        self.assertEqual(info['vertex_count'], 3)
+        self.assertEqual(info['face_count'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
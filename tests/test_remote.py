@@ -2,6 +2,10 @@ import time
 import unittest
 import threading
 import random
+import os
+import shutil
+import zipfile
+from opendm import remote
 from opendm.remote import LocalRemoteExecutor, Task, NodeTaskLimitReachedException
 from pyodm import Node, exceptions
 from pyodm.types import TaskStatus
@@ -102,5 +106,80 @@ class TestRemote(unittest.TestCase):
         with self.assertRaises(exceptions.TaskFailedError):
             self.lre.run(TaskMock)
 
+    def test_seed_payload(self):
+        project = "tests/assets/output/submodel_0000"
+        if os.path.exists("tests/assets/output"):
+            shutil.rmtree("tests/assets/output")
+        os.makedirs(os.path.join(project, "opensfm", "exif"))
+        with open(os.path.join(project, "opensfm", "exif", "1.jpg.exif"), "w") as f:
+            f.write("{}" * 1000)
+        with open(os.path.join(project, "opensfm", "features.npz"), "wb") as f:
+            f.write(os.urandom(1000))
+
+        task = Task(project, None, {})
+        seed = task.create_seed_payload(["opensfm/exif", "opensfm/features.npz", "opensfm/missing.json"], 
+                                         touch_files=["opensfm/split_merge_stop_at_reconstruction.txt"])
+        with zipfile.ZipFile(seed) as zf:
+            infos = {i.filename: i for i in zf.infolist()}
+            self.assertEqual(sorted(infos.keys()), ["opensfm/exif/1.jpg.exif", "opensfm/features.npz", "opensfm/split_merge_stop_at_reconstruction.txt"])
+            self.assertEqual(infos["opensfm/exif/1.jpg.exif"].compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(infos["opensfm/features.npz"].compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(zf.read("opensfm/exif/1.jpg.exif"), b"{}" * 1000)
+
+    def test_straggler(self):
+        self.lre.node_online = True
+        self.lre.set_projects(['/submodels/submodel_0000', '/submodels/submodel_0001', '/submodels/submodel_0002'])
+
+        uploaded = {'submodel_0001': threading.Event(), 'submodel_0002': threading.Event()}
+
+        class RemoteTaskMock:
+            uuid = 'xxxxx-xxxxx-xxxxx-xxxxx-xxxx'
+            def __init__(self):
+                self.removed = threading.Event()
+
+            def remove(self):
+                self.removed.set()
+                return True
+
+        class TaskMock(Task):
+            def process_local(self):
+                # Keep the local slot busy until both remaining tasks went to the node
+                if str(self) == 'submodel_0000':
+                    for e in uploaded.values():
+                        if not e.wait(10):
+                            raise Exception("Timed out waiting for uploads")
+            
+            def process_remote(self, done):
+                remote_task = self.remote_task = RemoteTaskMock()
+                self.params['tasks'].append(remote_task)
+                uploaded[str(self)].set()
+
+                def monitor():
+                    # The node never finishes 0001 until it's taken over
+                    if str(self) == 'submodel_0001':
+                        remote_task.removed.wait(10)
+                    done()
+                
+                t = threading.Thread(target=monitor)
+                self.params['threads'].append(t)
+                t.start()
+        
+        # Any remote task still running once another task
+        # has completed is a straggler
+        straggler_factor = remote.STRAGGLER_FACTOR
+        remote.STRAGGLER_FACTOR = 0
+        try:
+            self.lre.run(TaskMock)
+        finally:
+            remote.STRAGGLER_FACTOR = straggler_factor
+
+        # 0001 started remotely and was finished by the local slot,
+        # the late result from the node is ignored
+        metrics = {(m['task'], m['local']): m for m in self.lre.metrics}
+        self.assertTrue(('submodel_0001', True) in metrics)
+        self.assertFalse(('submodel_0001', False) in metrics)
+        self.assertTrue(('submodel_0002', False) in metrics)
+        self.assertEqual(len(self.lre.metrics), 3)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
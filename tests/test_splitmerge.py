@@ -0,0 +1,77 @@
+import unittest
+import os
+import shutil
+
+from stages import splitmerge
+
+class TestSplitMerge(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists("tests/assets/output"):
+            shutil.rmtree("tests/assets/output")
+        os.makedirs("tests/assets/output")
+
+    def create_submodels(self, count, images=10):
+        submodel_paths = []
+        for i in range(count):
+            sp = os.path.abspath("tests/assets/output/submodels/submodel_%04d/opensfm" % i)
+            images_dir = os.path.join(sp, "..", "images")
+            os.makedirs(sp)
+            os.makedirs(images_dir)
+            for j in range(images):
+                with open(os.path.join(images_dir, "%s.JPG" % j), 'w') as f:
+                    f.write("")
+            submodel_paths.append(sp)
+        return submodel_paths
+
+    def test_get_submodel_concurrency(self):
+        submodel_paths = self.create_submodels(4)
+        submodel_memory = splitmerge.get_submodel_memory_mb(submodel_paths[0])
+        self.assertEqual(submodel_memory, splitmerge.SUBMODEL_BASE_MEMORY_MB + 10 * splitmerge.SUBMODEL_IMAGE_MEMORY_MB)
+
+        get_max_memory_mb = splitmerge.get_max_memory_mb
+        try:
+            splitmerge.get_max_memory_mb = lambda: submodel_memory * 100
+            self.assertEqual(splitmerge.get_submodel_concurrency(submodel_paths[:1], 64), 1)
+            self.assertEqual(splitmerge.get_submodel_concurrency(submodel_paths, 64), 4)
+            self.assertEqual(splitmerge.get_submodel_concurrency(submodel_paths, 8), 2)
+            self.assertEqual(splitmerge.get_submodel_concurrency(submodel_paths, 2), 1)
+
+            # Limited by memory
+            splitmerge.get_max_memory_mb = lambda: submodel_memory * 3
+            self.assertEqual(splitmerge.get_submodel_concurrency(submodel_paths, 64), 3)
+            splitmerge.get_max_memory_mb = lambda: submodel_memory / 2
+            self.assertEqual(splitmerge.get_submodel_concurrency(submodel_paths, 64), 1)
+        finally:
+            splitmerge.get_max_memory_mb = get_max_memory_mb
+
+    def test_resume_toolchain(self):
+        submodel_paths = self.create_submodels(3, images=0)
+        with open(os.path.join(submodel_paths[1], "..", "toolchain_completed.txt"), 'w') as f:
+            f.write("Done!\n")
+
+        commands = []
+        run, get_submodel_argv = splitmerge.system.run, splitmerge.get_submodel_argv
+        try:
+            splitmerge.system.run = lambda cmd, env_vars={}: commands.append(cmd)
+            splitmerge.get_submodel_argv = lambda args, submodels_path, name, max_concurrency=None: ["run.py", name, max_concurrency]
+
+            for sp in submodel_paths:
+                splitmerge.run_submodel_toolchain(None, "submodels", sp, max_concurrency=2)
+
+            # Completed submodels are skipped, the others are marked as completed
+            self.assertEqual(commands, ['run.py submodel_0000 2', 'run.py submodel_0002 2'])
+            for sp in submodel_paths:
+                self.assertTrue(os.path.isfile(os.path.join(sp, "..", "toolchain_completed.txt")))
+
+            commands.clear()
+            for sp in submodel_paths:
+                splitmerge.run_submodel_toolchain(None, "submodels", sp)
+            self.assertEqual(commands, [])
+
+            splitmerge.run_submodel_toolchain(None, "submodels", submodel_paths[1], rerun=True)
+            self.assertEqual(commands, ['run.py submodel_0001 None'])
+        finally:
+            splitmerge.system.run, splitmerge.get_submodel_argv = run, get_submodel_argv
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,10 @@
 import unittest
+import threading
+import argparse
+import datetime
 from opendm import types
+from opendm import log
+from opendm.dag import TaskGraph
 
 class ODMPhotoMock:
     def __init__(self, filename, band_name, band_index):
@@ -46,5 +51,116 @@ class TestTypes(unittest.TestCase):
         recon = types.ODM_Reconstruction(photos)
         self.assertTrue(recon.multi_camera is None)
 
+        # Photos are indexed by filename
+        self.assertEqual(recon.get_photo('DJI_0021.JPG').filename, 'DJI_0021.JPG')
+        self.assertTrue(recon.get_photo('DJI_0100.JPG') is None)
+        recon.photos = photos[:2]
+        self.assertTrue(recon.get_photo('DJI_0021.JPG') is None)
+
+    def test_stages_graph(self):
+        class Args:
+            max_concurrency = 4
+            end_with = 'e'
+            rerun = None
+            rerun_all = False
+            rerun_from = None
+        
+        order = []
+        class StageMock(types.ODM_Stage):
+            def process(self, args, outputs):
+                order.append(self.name)
+                outputs['tree'] = True
+                if self.name == 'b' and self.params.get('cut'):
+                    self.next_stage = self.last_stage()
+            
+            def update_progress(self, progress):
+                pass
+        
+        def build(**params):
+            a = StageMock('a', Args)
+            b = StageMock('b', Args, **params)
+            c = StageMock('c', Args, max_concurrency=2, memory_share=0.5)
+            d = StageMock('d', Args, max_concurrency=2, memory_share=0.5)
+            e = StageMock('e', Args)
+            f = StageMock('f', Args)
+            a.connect(b).connect(c).connect(d).connect(e).connect(f)
+            c.depends_on(b)
+            d.depends_on(b)
+            e.depends_on(c, d)
+            return a
+
+        build().run({})
+        self.assertEqual(order[:2], ['a', 'b'])
+        self.assertEqual(sorted(order[2:4]), ['c', 'd'])
+        self.assertEqual(order[4:], ['e'])
+
+        # Stages can shorten the chain
+        order.clear()
+        build(cut=True).run({})
+        self.assertEqual(order, ['a', 'b'])
+
+    def test_concurrent_stages_progress(self):
+        class Args:
+            max_concurrency = 4
+        
+        class StageMock(types.ODM_Stage):
+            pass
+        
+        a = StageMock('a', Args, progress=80.0)
+        b = StageMock('b', Args, progress=90.0)
+        c = StageMock('c', Args, progress=98.0)
+        a.connect(b).connect(c)
+        self.assertEqual(c.max_concurrency(), 4)
+
+        sent = []
+        send_update = types.progressbc.send_update
+        types.progressbc.send_update = sent.append
+        try:
+            with types.progress_lock:
+                types.running_stages.clear()
+                types.running_stages[b] = 0.0
+                types.running_stages[c] = 0.0
+            
+            # Progress is monotonic even if the stages report in any order
+            c.update_progress(50)
+            b.update_progress(50)
+            c.update_progress(100)
+            b.update_progress(100)
+            self.assertEqual(sent, [84.0, 89.0, 93.0, 98.0])
+        finally:
+            types.progressbc.send_update = send_update
+            types.running_stages.clear()
+
+    def test_stage_log(self):
+        logger = log.logger
+        json, json_stages = logger.json, logger.json_stages
+        logger.init_json_output(["/dev/null"], argparse.Namespace())
+        logger.json_stages = {}
+
+        def run_stage(name):
+            logger.log_json_stage_run(name, datetime.datetime.now())
+            logger.info("message from %s" % name)
+            graph = TaskGraph(2)
+            graph.add("task", lambda: logger.info("task of %s" % name))
+            graph.run()
+        
+        try:
+            threads = [threading.Thread(target=run_stage, args=(n, )) for n in ["dem", "orthophoto"]]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            logger.log_json_stage_end("dem")
+            logger.log_json_stage_error("failed", 1)
+
+            stages = dict([(s['name'], s) for s in logger.json['stages']])
+        finally:
+            logger.json, logger.json_stages = json, json_stages
+
+        # Messages and timings are tracked separately for each stage
+        for n in ["dem", "orthophoto"]:
+            self.assertEqual([m['message'] for m in stages[n]['messages']], ["message from %s" % n, "task of %s" % n])
+            self.assertTrue('totalTime' in stages[n])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,157 @@
+import unittest
+import os
+import shutil
+import cv2
+import datetime
+import numpy as np
+import piexif
+
+from opendm.video.video2dataset import Parameters, Video2Dataset
+from opendm.video.checkers import BlackFrameChecker
+from opendm.video.srtparser import SrtFileParser
+
+class IdentityTransformer:
+    def TransformPoint(self, x, y, z=0):
+        return (x, y, z)
+
+class TestVideo(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists("tests/assets/output"):
+            shutil.rmtree("tests/assets/output")
+        os.makedirs("tests/assets/output")
+
+    def write_video(self, video):
+        np.random.seed(11)
+        base = cv2.resize((np.random.rand(60, 160, 3) * 255).astype(np.uint8), (640, 240))
+        w = cv2.VideoWriter(video, cv2.VideoWriter_fourcc(*'MJPG'), 30, (320, 240))
+        for i in range(40):
+            frame = base[:, i*8:i*8+320].copy()
+            if i % 10 == 3:
+                frame[:] = 0
+            w.write(frame)
+        w.release()
+
+    def test_process_video(self):
+        video = "tests/assets/output/synth.avi"
+        self.write_video(video)
+
+        results = []
+        for max_concurrency in [1, 3]:
+            output = "tests/assets/output/frames_%s" % max_concurrency
+            stats_file = "tests/assets/output/stats_%s.csv" % max_concurrency
+            frames = Video2Dataset(Parameters({
+                "input": [video],
+                "output": output,
+                "blur_threshold": 10,
+                "distance_threshold": 10,
+                "black_ratio_threshold": 0.98,
+                "pixel_black_threshold": 0.30,
+                "stats_file": stats_file,
+                "max_concurrency": max_concurrency
+            })).ProcessVideo()
+
+            self.assertTrue(len(frames) > 0)
+            self.assertTrue(all([os.path.isfile(f) for f in frames]))
+            with open(stats_file) as f:
+                stats = f.read()
+            results.append(([os.path.basename(f) for f in frames], stats))
+
+        # Same frames, in the same order, regardless of concurrency
+        self.assertEqual(results[0], results[1])
+
+        frame_indexes = [int(os.path.splitext(f)[0].split("_")[-1]) for f in results[0][0]]
+        self.assertEqual(frame_indexes, sorted(frame_indexes))
+        self.assertFalse(any([i % 10 == 3 for i in frame_indexes]))
+        self.assertEqual(len(results[0][1].strip().split("\n")), 41)
+
+    def test_black_frame_checker(self):
+        video = "tests/assets/output/synth.avi"
+        self.write_video(video)
+
+        expected = BlackFrameChecker(0.98, 0.30)
+        expected.PreProcess(video, 0, None)
+
+        # Statistics collected while decoding match those of a separate pass
+        checker = BlackFrameChecker(0.98, 0.30, warmup_frames=5)
+        self.assertFalse(checker.NeedPreProcess())
+        cap = cv2.VideoCapture(video)
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            self.assertEqual(checker.IsReady(), checker.frames_seen >= 5)
+            checker.Update(*cv2.minMaxLoc(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))[:2])
+        cap.release()
+
+        self.assertEqual(checker.absolute_threshold, expected.absolute_threshold)
+        self.assertTrue(checker.IsBlack(np.zeros((24, 32), dtype=np.uint8), 0))
+        self.assertFalse(checker.IsBlack(np.full((24, 32), 200, dtype=np.uint8), 0))
+
+    def write_srt(self, srt, frames):
+        # DJI mavic air 2 format, one entry per frame at 30 fps
+        with open(srt, 'w') as f:
+            for i in range(frames):
+                start = datetime.datetime(1900, 1, 1) + datetime.timedelta(seconds=i / 30.0)
+                end = datetime.datetime(1900, 1, 1) + datetime.timedelta(seconds=(i + 1) / 30.0)
+                f.write("%s\n%s --> %s\n" % (i + 1, start.strftime("%H:%M:%S,%f")[:-3], end.strftime("%H:%M:%S,%f")[:-3]))
+                f.write("<font size=\"36\">SrtCnt : %s, DiffTime : 33ms\n2023-01-06 18:56:48,380,821\n" % (i + 1))
+                f.write("[iso : %s] [shutter : 1/60.0] [fnum : 280] [ev : 0] [ct : 3925] [color_md : default] [focal_len : 240] "
+                        "[latitude: %.6f] [longitude: %.6f] [altitude: 100.000000] </font>\n\n" % (100 + i, 46.0 + i * 0.0001, 13.0 + (i // 2) * 0.0001))
+
+    def test_srt_parser(self):
+        srt = "tests/assets/output/synth.SRT"
+        self.write_srt(srt, 40)
+
+        parser = SrtFileParser(srt)
+        parser.parse()
+        self.assertEqual(len(parser.data), 40)
+
+        # Same entries as a linear scan
+        for ms in range(-10, 1400, 7):
+            timestamp = datetime.datetime(1900, 1, 1) + datetime.timedelta(milliseconds=ms)
+            expected = None
+            for entry in parser.data:
+                if entry["start"] <= timestamp and entry["end"] >= timestamp:
+                    expected = entry
+                    break
+            self.assertTrue(parser.get_entry(timestamp) is expected)
+
+        # Shared boundaries return the first entry
+        self.assertEqual(parser.get_entry(parser.data[5]["end"])["iso"], 105)
+
+        # Positions are interpolated between samples
+        parser.ll_to_utm = parser.utm_to_ll = IdentityTransformer()
+        lon, lat, alt = parser.get_gps(parser.data[4]["start"])
+        self.assertAlmostEqual(lat, 46.0004)
+        self.assertAlmostEqual(lon, 13.0002)
+        lon, lat, alt = parser.get_gps(parser.data[1]["start"] + datetime.timedelta(seconds=1 / 60.0))
+        self.assertAlmostEqual(lat, 46.00015, places=5)
+        self.assertTrue(parser.get_gps(datetime.datetime(1900, 1, 1, 0, 1)) is None)
+
+    def test_frame_exif(self):
+        video = "tests/assets/output/synth.avi"
+        self.write_video(video)
+        self.write_srt("tests/assets/output/synth.SRT", 40)
+
+        frames = Video2Dataset(Parameters({
+            "input": [video],
+            "output": "tests/assets/output/frames",
+            "use_srt": True
+        })).ProcessVideo()
+        self.assertEqual(len(frames), 40)
+
+        with open(frames[7], 'rb') as f:
+            data = f.read()
+        self.assertEqual(data[:2], b"\xff\xd8")
+        self.assertEqual(cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR).shape, (240, 320, 3))
+
+        exif = piexif.load(frames[7])
+        self.assertEqual(exif["Exif"][piexif.ExifIFD.ISOSpeedRatings], 107)
+        self.assertEqual(exif["Exif"][piexif.ExifIFD.FNumber], (14, 5))
+        self.assertEqual(exif["Exif"][piexif.ExifIFD.PixelXDimension], 320)
+        self.assertEqual(exif["0th"][piexif.ImageIFD.Software], b"ODM")
+        self.assertEqual(exif["GPS"][piexif.GPSIFD.GPSLatitudeRef], b"N")
+        self.assertEqual(exif["GPS"][piexif.GPSIFD.GPSLatitude][0], (46, 1))
+
+if __name__ == '__main__':
+    unittest.main()